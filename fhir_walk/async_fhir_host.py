@@ -0,0 +1,295 @@
+"""Asyncio flavor of the FhirHost
+
+Rather than duplicating the configuration and authentication logic, an
+AsyncFhirHost wraps an already configured FhirHost and borrows its headers
+and credentials. The surface (get/post/patch/update/delete_by_record_id) is the
+same, except that each of them must be awaited.
+
+Pagination within a single search is still serial (we need the 'next' link
+before we can ask for the next page), but any number of searches can be in
+flight at once, with at most max_connections requests outstanding against the
+host at any given time.
+
+The host's cassette (record/replay), local store (load_bulk_export) and
+response cache apply here just as they do to the FhirHost itself. So does the
+retry policy of its PooledTransport (see fhir_walk.transport), or the default
+one when the host doesn't have one, so a transient 5xx or dropped connection
+doesn't fail an entire gather.
+
+    host = FhirHost.host(cfg=cfg)
+    async with AsyncFhirHost(host, max_connections=16) as ahost:
+        patients = await Patient.PatientsByStudyAsync(study_id, ahost)
+
+Dependencies: aiohttp
+"""
+import asyncio
+import json
+import time
+from functools import partial
+from pprint import pformat
+
+from fhir_walk.cassette import RecordingTransport
+from fhir_walk.fhir_host import FhirResult
+from fhir_walk.transport import FhirRequestError, PooledTransport, idempotent_methods
+
+def _aiohttp():
+    try:
+        import aiohttp
+        return aiohttp
+    except ImportError:
+        raise ImportError("AsyncFhirHost requires aiohttp. Please install it with: pip install fhir-walk[async]")
+
+class AsyncFhirHost:
+    def __init__(self, host, max_connections=10):
+        # The synchronous host is still what the model objects hold on to for
+        # anything they load lazily after the fact
+        self.host = host
+        self.target_service_url = host.target_service_url
+        self.max_connections = max_connections
+
+        # Only the retry settings are used, we never send anything through it
+        self.retry_policy = host.pooled_transport
+        if self.retry_policy is None:
+            self.retry_policy = PooledTransport()
+
+        self._session = None
+        self._limit = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def session(self):
+        """Return the cached aiohttp session, creating it if necessary"""
+        if self._session is None:
+            aiohttp = _aiohttp()
+
+            auth = None
+            basic = self.host.auth()
+            if basic is not None:
+                auth = aiohttp.BasicAuth(*basic)
+
+            connector = aiohttp.TCPConnector(limit_per_host=self.max_connections)
+            self._session = aiohttp.ClientSession(connector=connector, auth=auth)
+            self._limit = asyncio.Semaphore(self.max_connections)
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _headers(self, content_headers=False):
+        # Token refreshes block, so keep them off of the event loop
+        loop = asyncio.get_running_loop()
+        if content_headers:
+            return await loop.run_in_executor(None, self.host.get_login_header, {})
+        return await loop.run_in_executor(None, self.host._search_headers)
+
+    async def _request(self, method, url, **kwargs):
+        """Send the request with aiohttp, returning the response along with its (decoded) content
+
+        Retries just as the PooledTransport would, without holding a connection
+        slot while waiting. Connection errors and timeouts on the final attempt are
+        raised as is."""
+        aiohttp = _aiohttp()
+        session = self.session()
+        policy = self.retry_policy
+        method = method.upper()
+
+        attempt = 0
+        while True:
+            delay = None
+            async with self._limit:
+                try:
+                    async with session.request(method, url, **kwargs) as response:
+                        repeatable = response.status == 429 or method in idempotent_methods
+                        if response.status not in policy.retry_statuses or attempt >= policy.retries or not repeatable:
+                            try:
+                                content = await response.json(content_type=None)
+                            except ValueError:
+                                content = await response.text()
+                            return response, content
+                        delay = policy.retry_delay(method, url, attempt, f"status {response.status}", response)
+                except aiohttp.ClientConnectorError as e:
+                    # We never connected, so the server can't have seen it
+                    if attempt >= policy.retries:
+                        raise
+                    delay = policy.retry_delay(method, url, attempt, type(e).__name__)
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                    if attempt >= policy.retries or method not in idempotent_methods:
+                        raise
+                    delay = policy.retry_delay(method, url, attempt, type(e).__name__)
+
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def _conditional_get(self, url, **kwargs):
+        """GET by way of the host's response cache (see FhirHost._conditional_get)"""
+        cache = self.host.response_cache
+        cached = cache.lookup(self.target_service_url, url)
+
+        if cached is not None and cache.is_fresh(cached):
+            cache.fresh_hits += 1
+            return True, {'status_code': 200, 'request_url': url, 'response': cached['body'], 'cached': True}
+
+        headers = dict(kwargs.pop('headers', None) or {})
+        if cached is not None:
+            headers.update(cache.validators(cached))
+
+        response, content = await self._request("GET", url, headers=headers, **kwargs)
+        if response.status == 304 and cached is not None:
+            cache.revalidated += 1
+            cache.touch(self.target_service_url, url)
+            return True, {'status_code': 200, 'request_url': url, 'response': cached['body']}
+
+        cache.misses += 1
+        success = response.status in (200, 201, 204)
+        if success:
+            cache.store(self.target_service_url, url, response.headers, content)
+        return success, {'status_code': response.status, 'request_url': url, 'response': content, 'bytes': response.content_length}
+
+    async def send_request(self, method, url, **kwargs):
+        """Mirrors FhirApiClient.send_request, returning a (success, result) tuple"""
+        transport = self.host.transport
+        if transport is not None and not isinstance(transport, RecordingTransport):
+            # Replaying or answering from a local store. Neither touches the network,
+            # so a worker thread is plenty
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, partial(transport.send_request, method, url, **kwargs))
+
+        if method.upper() == "GET" and transport is None and self.host.response_cache is not None:
+            return await self._conditional_get(url, **kwargs)
+
+        start = time.perf_counter()
+        response, content = await self._request(method, url, **kwargs)
+        result = {
+            'status_code': response.status,
+            'request_url': url,
+            'response': content,
+            'bytes': response.content_length
+        }
+        success = response.status in (200, 201, 204)
+
+        if transport is not None:
+            transport.write(method, url, kwargs.get('json'), time.perf_counter() - start, success, result)
+        return success, result
+
+    async def iter_pages(self, resource, recurse=True, no_count=False):
+        """Asynchronously yield one FhirResult per page"""
+
+        # Metrics hooks and reads are shared with the synchronous host
+        record = self.host._start_call(resource)
+        try:
+            key = self.host._read_key(resource)
+            if key is not None:
+                cached = self.host.resource_cache.get(key)
+                if cached is not None:
+                    if record is not None:
+                        record.cache_hits += 1
+                        record.entries += 1
+                    yield FhirResult({'response': cached})
+                    return
+
+            cheaders = await self._headers()
+            url = self.host._search_url(resource, no_count)
+
+            resource_type = None
+            if not no_count:
+                resource_type = self.host._resource_type(resource)
+            sizer = self.host.page_sizer
+
+            while url is not None:
+                start = time.perf_counter()
+                success, result = await self.send_request("GET", url, headers=cheaders)
+
+                if not success:
+                    print("There was a problem with the request for the GET")
+                    print(pformat(result))
+                    raise FhirRequestError(url, result, resume_url=url)
+
+                page = FhirResult(result)
+                self.host.resource_cache.add_entries(page.entries)
+
+                if result.get('cached'):
+                    if record is not None:
+                        record.cache_hits += 1
+                    yield page
+                    url = None
+                    if recurse:
+                        url = self.host._next_url(page, resource_type)
+                    continue
+
+                adapt = sizer.adaptive and resource_type is not None and page.response.get('resourceType') == 'Bundle'
+                if record is not None or adapt:
+                    latency = time.perf_counter() - start
+                    size = result.get('bytes')
+                    if size is None:
+                        size = len(json.dumps(page.response))
+
+                    if record is not None:
+                        record.add_page(latency, size, len(page.matches))
+                    if adapt:
+                        sizer.observe(resource_type, latency, size, len(page.matches))
+                yield page
+
+                url = None
+                if recurse:
+                    url = self.host._next_url(page, resource_type)
+        finally:
+            self.host._finish_call(record)
+
+    async def iter_entries(self, resource, no_count=False):
+        async for page in self.iter_pages(resource, no_count=no_count):
+            for entry in page.entries:
+                yield entry
+
+    async def get(self, resource, recurse=True, no_count=False):
+        content = None
+        async for page in self.iter_pages(resource, recurse=recurse, no_count=no_count):
+            if content is None:
+                content = page
+            else:
+                content.extend(page)
+        return content
+
+    async def gather(self, resources, recurse=True, no_count=False):
+        """Perform several GETs concurrently, returning the FhirResults in the same order"""
+        return await asyncio.gather(*[self.get(resource, recurse=recurse, no_count=no_count) for resource in resources])
+
+    async def delete_by_record_id(self, resource, id):
+        cheaders = await self._headers(content_headers=True)
+        endpoint = f"{self.target_service_url}/{resource}/{id}"
+        self.host.resource_cache.invalidate(f"{resource}/{id}")
+        success, result = await self.send_request("DELETE", endpoint, headers=cheaders)
+        if not success:
+            print(pformat(result))
+        return result
+
+    async def update(self, resource, id, data):
+        cheaders = await self._headers(content_headers=True)
+        endpoint = f"{self.target_service_url}/{resource}/{id}"
+        self.host.resource_cache.invalidate(f"{resource}/{id}")
+        success, result = await self.send_request("PUT", endpoint, json=data, headers=cheaders)
+        return result
+
+    async def patch(self, resource, id, data):
+        cheaders = await self._headers(content_headers=True)
+        cheaders['Content-Type'] = 'application/json-patch+json'
+        endpoint = f"{self.target_service_url}/{resource}/{id}"
+        self.host.resource_cache.invalidate(f"{resource}/{id}")
+        success, result = await self.send_request("PATCH", endpoint, json=data, headers=cheaders)
+        return result
+
+    async def post(self, resource, data, validate_only=False):
+        """validate_only will append the $validate to the end of the final url"""
+        cheaders = await self._headers(content_headers=True)
+
+        endpoint = f"{self.target_service_url}/{resource}"
+        if validate_only:
+            endpoint += "/$validate"
+
+        success, result = await self.send_request("POST", endpoint, json=data, headers=cheaders)
+        return result
@@ -0,0 +1,146 @@
+"""End to end benchmarks of the walker against a synthetic study
+
+For each study size, a synthetic study is served by the LocalFhirServer and each
+scenario is run in a fresh (spawned) process so that the peak RSS reported
+belongs to that scenario alone:
+
+    * studies  - ResearchStudy.Studies
+    * patients - ResearchStudy.Patients()
+    * hydrate  - Patients() followed by parents, specimens (and their tissue
+                 status and variants), diseases and phenotypes for each patient
+    * observations - every Observation on the server, via iter_entries
+
+Each result reports the wall time, throughput (count per second), the number of 
+requests the server answered, the bytes it sent and the peak RSS of the walker 
+process. Each scenario can be run in more than one mode (sets of host options), 
+such as paged (each page decoded in full), streamed (stream_entries) and parallel
+(hydrating patients on a thread pool, under a max_concurrency of 8), so they can
+be compared side by side.
+
+    results = run_benchmarks(sizes=[100, 1000], scenarios=['patients', 'hydrate'], modes=['paged', 'streamed'])
+    print(format_results(results))
+"""
+import multiprocessing
+import resource
+import sys
+import time
+
+from fhir_walk.synthetic import SyntheticStudy
+from fhir_walk.local_server import ResourceStore, LocalFhirServer
+
+scenarios = ['studies', 'patients', 'hydrate', 'observations']
+
+# Host options for each mode
+mode_options = {
+    'paged': {},
+    'streamed': {'stream_entries': True},
+    'parallel': {'max_concurrency': 8}
+}
+
+def peak_rss_mb():
+    # Linux carries ru_maxrss across the fork/exec that spawns our worker (so it 
+    # would include the server's memory). VmHWM belongs to this process alone
+    try:
+        with open("/proc/self/status", 'rt') as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Linux reports kilobytes, macOS reports bytes
+    if sys.platform == 'darwin':
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+def _run_scenario(url, scenario, host_options, limit, results):
+    """Runs inside of the spawned process"""
+    from fhir_walk.fhir_host import FhirHost
+    from fhir_walk.model.research_study import ResearchStudy
+    from fhir_walk.model.patient import Patient
+
+    host = FhirHost(target_service_url=url, username='bench', password='bench', **host_options)
+
+    start = time.perf_counter()
+    if scenario == 'observations':
+        count = sum(1 for entry in host.iter_entries("Observation"))
+        studies = {}
+    else:
+        studies = ResearchStudy.Studies(host)
+        count = len(studies)
+
+    if scenario in ('patients', 'hydrate'):
+        study = list(studies.values())[0]
+        patients = study.Patients()
+        count = len(patients)
+
+        if scenario == 'hydrate':
+            hydrated = list(patients.values())
+            if limit is not None:
+                hydrated = hydrated[:limit]
+            if host.max_concurrency is not None:
+                Patient.Hydrate(hydrated, workers=host.max_concurrency)
+            else:
+                for patient in hydrated:
+                    patient.hydrate()
+            count = len(hydrated)
+
+    wall_time = time.perf_counter() - start
+    results.put({
+        'wall_time': wall_time,
+        'count': count,
+        'throughput': count / wall_time if wall_time > 0 else 0,
+        'peak_rss_mb': peak_rss_mb()
+    })
+
+def run_scenario(server, scenario, host_options=None, limit=None):
+    """Run a single scenario against a running server in a fresh process"""
+    if host_options is None:
+        host_options = {}
+
+    ctx = multiprocessing.get_context('spawn')
+    results = ctx.Queue()
+
+    server.reset_stats()
+    worker = ctx.Process(target=_run_scenario, args=(server.url, scenario, host_options, limit, results))
+    worker.start()
+    result = results.get()
+    worker.join()
+
+    result['scenario'] = scenario
+    result['requests'] = server.requests
+    result['bytes'] = server.bytes_sent
+    return result
+
+def run_benchmarks(sizes=(100, 1000, 10000), scenarios=scenarios, host_options=None, limit=None,
+                   latency=0, seed=1, progress=None, modes=('paged',)):
+    """Run each scenario, in each mode, against a synthetic study of each size. Returns a list of result dicts"""
+    results = []
+    for size in sizes:
+        store = ResourceStore(SyntheticStudy(subjects=size, seed=seed).resources())
+
+        with LocalFhirServer(store, latency=latency) as server:
+            for scenario in scenarios:
+                for mode in modes:
+                    options = dict(host_options or {})
+                    options.update(mode_options[mode])
+
+                    result = run_scenario(server, scenario, host_options=options, limit=limit)
+                    result['size'] = size
+                    result['mode'] = mode
+                    results.append(result)
+
+                    if progress:
+                        progress(result)
+    return results
+
+def format_results(results):
+    lines = [f"{'Subjects':>9} {'Scenario':<12} {'Mode':<9} {'Count':>8} {'Wall (s)':>10} {'Rate (/s)':>10} "
+             f"{'Requests':>9} {'MB Sent':>9} {'Peak RSS (MB)':>14}"]
+    for result in results:
+        lines.append(f"{result['size']:>9} {result['scenario']:<12} {result.get('mode', 'paged'):<9} {result['count']:>8} "
+                     f"{result['wall_time']:>10.2f} {result['throughput']:>10.0f} "
+                     f"{result['requests']:>9} {result['bytes'] / (1024 * 1024):>9.1f} {result['peak_rss_mb']:>14.1f}")
+    return "\n".join(lines)
@@ -0,0 +1,172 @@
+"""FHIR Bulk Data $export
+
+For whole study work, a handful of large sequential downloads beats thousands of
+paged searches. The flow is the one laid out by the Bulk Data Access spec:
+
+    1. kick_off() asks the server to start the export (Prefer: respond-async)
+       and remembers the status url the server hands back
+    2. wait() polls that url, honoring Retry-After, until the manifest is ready
+    3. iter_resources() streams each NDJSON file, one resource at a time
+
+Most of the time, FhirHost.load_bulk_export is all that is needed. It runs the
+export, loads everything into a ResourceStore (which joins the resources on
+their references) and answers all further reads and searches from it, so the
+model classes work exactly as they would against the server:
+
+    host.load_bulk_export(['ResearchStudy', 'ResearchSubject', 'Patient', 'Specimen', 'Observation'])
+    studies = ResearchStudy.Studies(host)
+"""
+import json
+import logging
+import time
+
+from fhir_walk.transport import FhirRequestError
+
+logger = logging.getLogger(__name__)
+
+# Everything the model classes look at
+default_types = ['ResearchStudy', 'ResearchSubject', 'Patient', 'Specimen', 'Condition',
+                 'Observation', 'DocumentReference', 'Task']
+
+def _error(response, url):
+    try:
+        content = response.json()
+    except ValueError:
+        content = response.text
+    return FhirRequestError(url, {'status_code': response.status_code, 'request_url': url, 'response': content})
+
+class BulkExport:
+    def __init__(self, host, resource_types=None, since=None, type_filters=None, group=None,
+                 poll_interval=5, max_wait=None):
+        self.host = host
+        self.resource_types = resource_types
+        if self.resource_types is None:
+            self.resource_types = default_types
+        self.since = since
+        self.type_filters = type_filters or []
+
+        # Export a single Group's patients (and their compartments) rather than the whole server
+        self.group = group
+
+        # Seconds between polls when the server doesn't send a Retry-After, and
+        # the most we'll wait overall (None waits forever)
+        self.poll_interval = poll_interval
+        self.max_wait = max_wait
+
+        self.status_url = None
+        self.manifest = None
+        self.progress = None
+        self._retry_after = None
+
+    def _headers(self, accept="application/fhir+json"):
+        headers = self.host._search_headers()
+        headers.pop('Content-Type', None)
+        headers['Accept'] = accept
+        return headers
+
+    def kick_off(self):
+        url = f"{self.host.target_service_url}/$export"
+        if self.group is not None:
+            url = f"{self.host.target_service_url}/Group/{self.group}/$export"
+
+        params = {
+            '_outputFormat': 'application/fhir+ndjson',
+            '_type': ",".join(self.resource_types)
+        }
+        if self.since is not None:
+            params['_since'] = self.since
+        if len(self.type_filters) > 0:
+            params['_typeFilter'] = self.type_filters
+
+        headers = self._headers()
+        headers['Prefer'] = 'respond-async'
+
+        response = self.host._http("GET", url, params=params, headers=headers)
+        if response.status_code != 202:
+            raise _error(response, url)
+
+        self.status_url = response.headers['Content-Location']
+        return self.status_url
+
+    def status(self):
+        """Poll once. Returns the manifest when the export is complete and None while it's still running"""
+        if self.manifest is not None:
+            return self.manifest
+
+        response = self.host._http("GET", self.status_url, headers=self._headers())
+        if response.status_code == 202:
+            self.progress = response.headers.get('X-Progress')
+            self._retry_after = response.headers.get('Retry-After')
+            return None
+
+        if response.status_code != 200:
+            raise _error(response, self.status_url)
+
+        self.manifest = response.json()
+        return self.manifest
+
+    def wait(self, progress=None):
+        """Poll until the export completes, returning the manifest. progress(export) is called after each poll"""
+        start = time.time()
+        while self.status() is None:
+            if progress:
+                progress(self)
+
+            delay = self.poll_interval
+            try:
+                delay = float(self._retry_after)
+            except (TypeError, ValueError):
+                pass
+
+            if self.max_wait is not None and time.time() - start + delay > self.max_wait:
+                raise TimeoutError(f"Export at {self.status_url} didn't complete within {self.max_wait} seconds")
+            time.sleep(delay)
+
+        if progress:
+            progress(self)
+        for error in self.manifest.get('error', []):
+            logger.warning(f"Export reported errors in {error['url']}")
+        return self.manifest
+
+    @property
+    def outputs(self):
+        if self.manifest is None:
+            return []
+        return self.manifest.get('output', [])
+
+    def iter_resources(self, resource_type=None):
+        """Stream the exported resources, optionally only those of resource_type"""
+        requires_token = self.manifest.get('requiresAccessToken', True)
+
+        for output in self.outputs:
+            if resource_type is not None and output['type'] != resource_type:
+                continue
+
+            # Files handed out without a token are often signed urls on some other
+            # host, which won't appreciate our credentials
+            headers = {'Accept': 'application/fhir+ndjson'}
+            if requires_token:
+                headers = self._headers(accept='application/fhir+ndjson')
+
+            response = self.host._http("GET", output['url'], auth=requires_token, headers=headers, stream=True)
+            if response.status_code != 200:
+                raise _error(response, output['url'])
+
+            try:
+                for line in response.iter_lines():
+                    if line:
+                        yield json.loads(line)
+            finally:
+                response.close()
+
+    def load(self, store=None):
+        """Load every exported resource into store (a new ResourceStore by default)"""
+        if store is None:
+            from fhir_walk.local_server import ResourceStore
+            store = ResourceStore()
+        store.add_all(self.iter_resources())
+        return store
+
+    def cancel(self):
+        if self.status_url is not None:
+            self.host._http("DELETE", self.status_url, headers=self._headers())
@@ -0,0 +1,133 @@
+"""Record and replay the traffic between a FhirHost and its server
+
+A cassette is a plain JSON lines file where each line captures a single request
+(method, url, body) along with the response (success, result) and how long the
+server took to answer. Pagination links are part of the recorded bodies, so a
+replayed walk follows exactly the same pages as the original.
+
+URLs are stored relative to the host's target_service_url, which allows a
+cassette recorded against one environment to be replayed while configured for
+another.
+
+    host.record("walk.jsonl")       # talk to the server, writing everything down
+    host.replay("walk.jsonl", latency='recorded')   # no network required
+
+Replay latency can be:
+    * None (the default), which answers immediately
+    * a number of seconds added to every request
+    * 'recorded', which sleeps for as long as the server originally took
+    * a callable, latency(method, url, recorded_elapsed) => seconds
+
+latency_scale multiplies whatever latency is chosen, which makes it easy to
+model a slower (or faster) production server.
+"""
+import copy
+import json
+import threading
+import time
+from collections import deque
+
+def relative_url(base_url, url):
+    if base_url and url.startswith(base_url):
+        return url[len(base_url):]
+    return url
+
+class RecordingTransport:
+    def __init__(self, transport, path, base_url=None):
+        self.transport = transport
+        self.path = path
+        self.base_url = base_url
+
+        self._lock = threading.Lock()
+        self._file = open(path, 'wt')
+
+    def send_request(self, method, url, **kwargs):
+        start = time.perf_counter()
+        success, result = self.transport.send_request(method, url, **kwargs)
+        self.write(method, url, kwargs.get('json'), time.perf_counter() - start, success, result)
+        return success, result
+
+    def write(self, method, url, body, elapsed, success, result):
+        """Add an interaction to the cassette (AsyncFhirHost sends its own requests and writes them here)"""
+        interaction = {
+            'method': method.upper(),
+            'url': relative_url(self.base_url, url),
+            'body': body,
+            'elapsed': elapsed,
+            'success': success,
+            'result': result
+        }
+
+        with self._lock:
+            self._file.write(json.dumps(interaction) + "\n")
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+class ReplayTransport:
+    # Nothing we do while replaying requires the real server (or credentials)
+    offline = True
+
+    def __init__(self, path, base_url=None, latency=None, latency_scale=1.0):
+        self.path = path
+        self.base_url = base_url
+        self.latency = latency
+        self.latency_scale = latency_scale
+
+        self._lock = threading.Lock()
+
+        # Identical requests are answered in the order they were recorded. Once we
+        # run out, we'll keep handing back the last one
+        self.interactions = {}
+        with open(path, 'rt') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    interaction = json.loads(line)
+                    key = (interaction['method'], interaction['url'])
+                    self.interactions.setdefault(key, deque()).append(interaction)
+
+        self.requests = 0
+        self.unmatched = 0
+
+    def _delay(self, method, url, interaction):
+        latency = self.latency
+        if latency is None:
+            return 0
+        if latency == 'recorded':
+            delay = interaction['elapsed']
+        elif callable(latency):
+            delay = latency(method, url, interaction['elapsed'])
+        else:
+            delay = float(latency)
+        return delay * self.latency_scale
+
+    def send_request(self, method, url, **kwargs):
+        key = (method.upper(), relative_url(self.base_url, url))
+
+        with self._lock:
+            self.requests += 1
+            queue = self.interactions.get(key)
+            if queue is None:
+                self.unmatched += 1
+                return False, {
+                    'status_code': 404,
+                    'request_url': url,
+                    'response': {'resourceType': 'OperationOutcome',
+                                 'issue': [{'severity': 'error', 'diagnostics': f"No recorded response for {key[0]} {key[1]}"}]}
+                }
+
+            interaction = queue[0]
+            if len(queue) > 1:
+                queue.popleft()
+
+        delay = self._delay(method, url, interaction)
+        if delay > 0:
+            time.sleep(delay)
+
+        # The same interaction may be handed out again, so callers get their own copy
+        return interaction['success'], copy.deepcopy(interaction['result'])
+
+    def close(self):
+        pass
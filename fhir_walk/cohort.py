@@ -0,0 +1,199 @@
+"""Local cohort queries over a loaded study
+
+CohortIndex gives every patient in a study a bit position and keeps an
+inverted index from each (field, value) pair to a bitmap (a plain Python int)
+of the patients having it. A compound query is then a few bitwise ANDs and
+ORs over those ints, no matter how many patients the study has:
+
+    cohort = study.cohort_index()
+    cohort.query(sex='female', disease=['MONDO:0005015', 'MONDO:0005148'],
+                 exclude={'phenotype': 'HP:0001250'})
+
+While the index is being built, each (field, value) only collects the
+positions of its patients. Its bitmap is built from those in one go the first
+time a query needs it, rather than growing a cohort sized int with every add.
+
+Within a field, a list of values matches any of them. Across fields, every
+criterion must match. The fields indexed are:
+
+    sex, race, eth, dbgap_study_id      - from the Patient
+    disease                             - each Disease.code
+    phenotype, absent_phenotype         - each HPO code observed present (or absent)
+    tissue_affected_status              - from any of the patient's specimens
+                                          (the coding system Specimen reports,
+                                          see values() for those in the study)
+
+ethnicity, dbgap_study and tissue_status work too. For anything more involved,
+bitmap() returns the raw ints, which combine with &, | and ~ (mask the result
+of a ~ with all()) before being turned back into ids with ids().
+"""
+
+from itertools import compress
+
+patient_fields = ['sex', 'race', 'eth', 'dbgap_study_id']
+fields = patient_fields + ['disease', 'phenotype', 'absent_phenotype', 'tissue_affected_status']
+
+aliases = {
+    'ethnicity': 'eth',
+    'dbgap_study': 'dbgap_study_id',
+    'tissue_status': 'tissue_affected_status'
+}
+
+# Turns a bitmap's binary digits into the 0/1 bytes itertools.compress selects by
+_selectors = bytes.maketrans(b"01", b"\x00\x01")
+
+def to_bitmap(positions):
+    """Build the int with the bit at each of positions set"""
+    if len(positions) == 0:
+        return 0
+    flags = bytearray(max(positions) // 8 + 1)
+    for position in positions:
+        flags[position >> 3] |= 1 << (position & 7)
+    return int.from_bytes(flags, 'little')
+
+def bit_count(bits):
+    if hasattr(bits, 'bit_count'):
+        return bits.bit_count()
+    return bin(bits).count("1")
+
+class CohortIndex:
+    def __init__(self):
+        self.patient_ids = []
+        self._positions = {}
+
+        # field => value => [patient positions], and the bitmaps built from them
+        self.rows = dict((field, {}) for field in fields)
+        self.index = dict((field, {}) for field in fields)
+
+    def __len__(self):
+        return len(self.patient_ids)
+
+    def _position(self, patient_id):
+        position = self._positions.get(patient_id)
+        if position is None:
+            position = len(self.patient_ids)
+            self._positions[patient_id] = position
+            self.patient_ids.append(patient_id)
+        return position
+
+    def add(self, patient_id, field, value):
+        """Record that patient_id has value for field"""
+        position = self._position(patient_id)
+        if value is None or value == "":
+            return
+        field = aliases.get(field, field)
+        self.rows[field].setdefault(value, []).append(position)
+
+        # Any bitmap already built for it is out of date
+        self.index[field].pop(value, None)
+
+    def add_patient(self, patient):
+        """Index a Patient along with its diseases, phenotypes and specimens"""
+        self._position(patient.id)
+        for field in patient_fields:
+            self.add(patient.id, field, getattr(patient, field))
+
+        for disease in patient.diseases().values():
+            self.add(patient.id, 'disease', disease.code)
+
+        present, absent = patient.phenotypes()
+        for code in present:
+            self.add(patient.id, 'phenotype', code)
+        for code in absent:
+            self.add(patient.id, 'absent_phenotype', code)
+
+        for specimen in patient.specimens().values():
+            self.add(patient.id, 'tissue_affected_status', specimen.tissue_affected_status)
+
+    @classmethod
+    def from_patients(cls, patients, progress=None):
+        """Build the index from Patient objects (a list or the dict PatientsByStudy returns)"""
+        if isinstance(patients, dict):
+            patients = patients.values()
+
+        index = cls()
+        for count, patient in enumerate(patients, 1):
+            index.add_patient(patient)
+            if progress:
+                progress(count, patient)
+        return index
+
+    @classmethod
+    def from_study(cls, study, progress=None):
+        """Walk the study's patients, pulling their children alongside each page"""
+        return cls.from_patients(study.IterPatients(children=True), progress=progress)
+
+    @classmethod
+    def from_snapshot(cls, path):
+        """Build the index from a snapshot's patients, conditions, phenotypes and specimens"""
+        from fhir_walk.snapshot import load_snapshot
+        tables = load_snapshot(path, tables=['patients', 'conditions', 'phenotypes', 'specimens'])
+
+        index = cls()
+        for row in tables['patients'].select(['id'] + patient_fields).to_pylist():
+            index._position(row['id'])
+            for field in patient_fields:
+                index.add(row['id'], field, row[field])
+
+        for row in tables['conditions'].select(['patient_id', 'code']).to_pylist():
+            index.add(row['patient_id'], 'disease', row['code'])
+        for row in tables['phenotypes'].select(['patient_id', 'code', 'present']).to_pylist():
+            index.add(row['patient_id'], 'phenotype' if row['present'] else 'absent_phenotype', row['code'])
+        for row in tables['specimens'].select(['patient_id', 'tissue_affected_status']).to_pylist():
+            index.add(row['patient_id'], 'tissue_affected_status', row['tissue_affected_status'])
+        return index
+
+    def all(self):
+        """The bitmap with every patient's bit set"""
+        return (1 << len(self.patient_ids)) - 1
+
+    def values(self, field):
+        """Return a dict of value => number of patients for field"""
+        field = aliases.get(field, field)
+        return dict((value, bit_count(self._bitmap(field, value))) for value in self.rows[field])
+
+    def _bitmap(self, field, value):
+        bits = self.index[field].get(value)
+        if bits is None:
+            bits = to_bitmap(self.rows[field].get(value, []))
+            if value in self.rows[field]:
+                self.index[field][value] = bits
+        return bits
+
+    def bitmap(self, field, value):
+        """The bitmap of patients with value (or any of a list of values) for field"""
+        field = aliases.get(field, field)
+        if field not in self.index:
+            raise KeyError(f"Unknown cohort field, '{field}'")
+
+        if isinstance(value, (list, tuple, set, frozenset)):
+            bits = 0
+            for item in value:
+                bits |= self._bitmap(field, item)
+            return bits
+        return self._bitmap(field, value)
+
+    def select(self, exclude=None, **criteria):
+        """The bitmap of patients matching every one of criteria and none of exclude (a dict of field => value)"""
+        bits = self.all()
+        for field, value in criteria.items():
+            bits &= self.bitmap(field, value)
+            if bits == 0:
+                return 0
+
+        for field, value in (exclude or {}).items():
+            bits &= ~self.bitmap(field, value)
+        return bits
+
+    def ids(self, bits):
+        """Turn a bitmap back into the set of patient ids"""
+        # Reversed, so that position i in the string is bit i
+        return set(compress(self.patient_ids, bin(bits)[:1:-1].encode().translate(_selectors)))
+
+    def query(self, exclude=None, **criteria):
+        """Return the set of patient ids matching every one of criteria and none of exclude"""
+        return self.ids(self.select(exclude=exclude, **criteria))
+
+    def count(self, exclude=None, **criteria):
+        """The number of patients matching the query, without building the set of their ids"""
+        return bit_count(self.select(exclude=exclude, **criteria))
@@ -11,7 +11,20 @@ Dependencies: ncpi_fhir_utility
 import logging
 logger = logging.getLogger(__name__)
 from ncpi_fhir_utility.client import FhirApiClient
+from fhir_walk.resource_cache import ResourceCache
+from fhir_walk.response_cache import ResponseCache
+from fhir_walk.cassette import RecordingTransport, ReplayTransport
+from fhir_walk.metrics import CallRecord, RequestMetrics
+from fhir_walk.page_size import PageSizer
+from fhir_walk.transport import PooledTransport, FhirRequestError
+import requests
+import json
+import re
+import time
 import subprocess
+import threading
+from collections import deque
+from contextlib import nullcontext
 from pprint import pformat
 
 
@@ -53,8 +66,167 @@ class FhirResult:
         self.entries += self.response['entry']
         self.entry_count = len(self.entries)   
 
-# TODO: This is just a hasty solution, but if there is real interest, this should be turned into
-# an iterable class rather than bulk capture of entire list of data
+    @property
+    def matches(self):
+        """Entries that matched the search itself, as opposed to those pulled in by _include/_revinclude"""
+        return [entry for entry in self.entries if entry.get('search', {}).get('mode', 'match') == 'match']
+
+    def included(self, resource_type=None):
+        """Return the _include/_revinclude resources as a dict keyed by ResourceType/id"""
+        included = {}
+        for entry in self.entries:
+            if entry.get('search', {}).get('mode') == 'include' and 'resource' in entry:
+                resource = entry['resource']
+                if resource_type is None or resource['resourceType'] == resource_type:
+                    included[f"{resource['resourceType']}/{resource['id']}"] = resource
+        return included
+
+    def extend(self, page):
+        """Merge a subsequent page (another FhirResult) into this one"""
+        self.response = page.response
+        self.next = page.next
+
+        # Empty pages come back without an entry list, in which case
+        # FhirResult will have wrapped the bundle itself
+        # A new list, since self.entries may be the first page's own entry list
+        if 'entry' in page.response:
+            self.entries = self.entries + page.entries
+        self.entry_count = len(self.entries)
+
+def reference_key(ref):
+    """Reduce a reference (possibly absolute or versioned) down to ResourceType/id"""
+    ref = ref.split("/_history/")[0]
+    return "/".join(ref.rstrip("/").split("/")[-2:])
+
+# ResourceType/id, as reference_key leaves a resolvable reference
+resource_key_regex = re.compile(r"^[A-Z][A-Za-z]+/[A-Za-z0-9\-.]{1,64}$")
+
+def is_resource_key(key):
+    return resource_key_regex.match(key) is not None
+
+class ReferenceLoader:
+    """Gather up references and resolve them all at once, DataLoader style
+
+    Callers load() each reference they will eventually need, then either dispatch() 
+    explicitly or simply ask for one of them, which dispatches anything pending. 
+    Duplicates are only ever pulled once and each resource type costs one 
+    _id=a,b,c search per batch rather than a GET per reference. 
+    """
+    def __init__(self, host, batch_size=None):
+        self.host = host
+        self.batch_size = batch_size
+        self.pending = set()
+        self.resolved = {}
+
+    def load(self, ref):
+        if ref not in self.resolved:
+            self.pending.add(ref)
+
+    def load_many(self, refs):
+        for ref in refs:
+            self.load(ref)
+
+    def dispatch(self):
+        if len(self.pending) > 0:
+            resolved = self.host.resolve_references(self.pending, batch_size=self.batch_size)
+            for ref in self.pending:
+                self.resolved[ref] = resolved.get(ref)
+            self.pending = set()
+
+    def get(self, ref):
+        """Return the resource for ref, or None if the server doesn't have it"""
+        if ref not in self.resolved:
+            self.load(ref)
+            self.dispatch()
+        return self.resolved[ref]
+
+    def __getitem__(self, ref):
+        return self.get(ref)
+
+class PagePrefetcher:
+    """Fetch pages on a background thread while the caller works through the current one
+
+    The worker stays at most depth pages ahead of the consumer and, if max_entries is 
+    set, stops reading ahead once that many entries are sitting in the buffer. Either
+    way, the memory held is bounded regardless of how many pages the search returns. 
+    Any error raised by the worker is re-raised to the consumer in page order.
+    """
+    def __init__(self, fetch, next_url, url, depth=2, max_entries=None):
+        self.fetch = fetch
+        self.next_url = next_url
+        self.depth = max(1, depth)
+        self.max_entries = max_entries
+
+        self._pages = deque()
+        self._buffered = 0
+        self._done = False
+        self._closed = False
+        self._error = None
+        self._cond = threading.Condition()
+
+        self._worker = threading.Thread(target=self._run, args=(url,), daemon=True)
+        self._worker.start()
+
+    def _has_room(self):
+        if len(self._pages) >= self.depth:
+            return False
+
+        # Always permit at least one page, otherwise a single huge page would stall us
+        if self.max_entries is not None and len(self._pages) > 0:
+            return self._buffered < self.max_entries
+        return True
+
+    def _run(self, url):
+        try:
+            while url is not None:
+                with self._cond:
+                    while not self._closed and not self._has_room():
+                        self._cond.wait()
+                    if self._closed:
+                        return
+
+                page = self.fetch(url)
+                url = self.next_url(page)
+
+                with self._cond:
+                    self._pages.append(page)
+                    self._buffered += page.entry_count
+                    self._cond.notify_all()
+        except BaseException as e:
+            with self._cond:
+                self._error = e
+        finally:
+            with self._cond:
+                self._done = True
+                self._cond.notify_all()
+
+    def close(self):
+        """Stop reading ahead. Pages already in flight are simply dropped"""
+        with self._cond:
+            self._closed = True
+            self._pages.clear()
+            self._buffered = 0
+            self._cond.notify_all()
+
+    def __iter__(self):
+        try:
+            while True:
+                with self._cond:
+                    while len(self._pages) == 0 and not self._done:
+                        self._cond.wait()
+
+                    if len(self._pages) == 0:
+                        if self._error is not None:
+                            raise self._error
+                        return
+
+                    page = self._pages.popleft()
+                    self._buffered -= page.entry_count
+                    self._cond.notify_all()
+                yield page
+        finally:
+            self.close()
+
 class FhirHost:
     # Singleton. For use with kf ingestion, we can configure this prior to passing control to 
     # load function. 
@@ -81,6 +253,58 @@ class FhirHost:
         self.google_identity = False
         self._client = None         # Cache the client so we don't have to rebuild it between calls
 
+        # Anything with a send_request, such as a recording or replay transport. When
+        # this is None, requests go straight through the FhirApiClient (or the 
+        # pooled transport, when there is one)
+        self.transport = None
+        self.pooled_transport = None
+
+        # Settings for the pooled, retrying transport (see fhir_walk.transport). Either
+        # True, for the defaults, or a dict of PooledTransport arguments
+        pooled_transport = kwargs.get('pooled_transport')
+
+        replay_from = None
+        record_to = None
+
+        # Callables handed a CallRecord (see fhir_walk.metrics) as each call completes
+        self.hooks = []
+        self.metrics = None
+
+        # Look-ahead for paginated searches. 0 keeps the pagination strictly serial
+        self.prefetch_depth = int(kwargs.get('prefetch_depth', 0))
+        self.prefetch_max_entries = kwargs.get('prefetch_max_entries')
+
+        # _count for searches, for the host as a whole and by resource type. With 
+        # adaptive_page_size, the count for each type is tuned from the latency and
+        # size of the pages the server hands back (see fhir_walk.page_size)
+        page_size = int(kwargs.get('page_size', 250))
+        page_sizes = kwargs.get('page_sizes')
+        adaptive_page_size = kwargs.get('adaptive_page_size', False)
+        max_page_size = int(kwargs.get('max_page_size', 1000))
+
+        # Parse search pages incrementally in iter_entries, rather than decoding each
+        # page in full (see fhir_walk.stream_parse). Requires ijson
+        self.stream_entries = kwargs.get('stream_entries', False)
+
+        # Max number of ids combined into a single _id=a,b,c search when resolving references
+        self.reference_batch_size = int(kwargs.get('reference_batch_size', 100))
+
+        # Most requests we'll have outstanding against the server at once, however many
+        # threads are making them (None for no limit)
+        max_concurrency = kwargs.get('max_concurrency')
+
+        # Whether the loaders should ask the server for _include/_revinclude. Set this
+        # to false for servers that don't support them
+        self.supports_include = kwargs.get('supports_include', True)
+
+        # Identity map for resources we've already seen. A size of 0 disables it
+        resource_cache_size = int(kwargs.get('resource_cache_size', 10000))
+        resource_cache_ttl = kwargs.get('resource_cache_ttl')
+
+        # Optional persistent cache of GET responses (path to a sqlite file)
+        response_cache = kwargs.get('response_cache')
+        response_cache_max_age = kwargs.get('response_cache_max_age', 0)
+
         if cfg is not None:
             if 'host_desc' in cfg:
                 self.host_desc = cfg['host_desc']
@@ -106,6 +330,72 @@ class FhirHost:
             if 'target_service_url' in cfg:
                 self.target_service_url = cfg['target_service_url']
 
+            if 'prefetch_depth' in cfg:
+                self.prefetch_depth = int(cfg['prefetch_depth'])
+            if 'prefetch_max_entries' in cfg:
+                self.prefetch_max_entries = cfg['prefetch_max_entries']
+            if 'page_size' in cfg:
+                page_size = int(cfg['page_size'])
+            if 'page_sizes' in cfg:
+                page_sizes = cfg['page_sizes']
+            if 'adaptive_page_size' in cfg:
+                adaptive_page_size = cfg['adaptive_page_size']
+            if 'max_page_size' in cfg:
+                max_page_size = int(cfg['max_page_size'])
+            if 'stream_entries' in cfg:
+                self.stream_entries = cfg['stream_entries']
+            if 'reference_batch_size' in cfg:
+                self.reference_batch_size = int(cfg['reference_batch_size'])
+            if 'max_concurrency' in cfg:
+                max_concurrency = cfg['max_concurrency']
+            if 'supports_include' in cfg:
+                self.supports_include = cfg['supports_include']
+            if 'resource_cache_size' in cfg:
+                resource_cache_size = int(cfg['resource_cache_size'])
+            if 'resource_cache_ttl' in cfg:
+                resource_cache_ttl = cfg['resource_cache_ttl']
+
+            if 'response_cache' in cfg:
+                response_cache = cfg['response_cache']
+            if 'response_cache_max_age' in cfg:
+                response_cache_max_age = cfg['response_cache_max_age']
+
+            if 'pooled_transport' in cfg:
+                pooled_transport = cfg['pooled_transport']
+
+            if 'replay_from' in cfg:
+                replay_from = cfg['replay_from']
+            if 'record_to' in cfg:
+                record_to = cfg['record_to']
+
+        self.set_max_concurrency(max_concurrency)
+
+        if pooled_transport:
+            options = pooled_transport
+            if not isinstance(options, dict):
+                options = {}
+            self.use_pooled_transport(**options)
+
+        # Recording wraps whichever transport we'd otherwise be using
+        if replay_from is not None:
+            self.replay(replay_from, latency=cfg.get('replay_latency'))
+        elif record_to is not None:
+            self.record(record_to)
+
+        self.page_sizer = PageSizer(default=page_size, 
+                                    per_type=page_sizes, 
+                                    adaptive=adaptive_page_size, 
+                                    max_count=max(max_page_size, page_size))
+
+        self.resource_cache = ResourceCache(max_size=resource_cache_size, ttl=resource_cache_ttl)
+
+        self.response_cache = None
+        if response_cache is not None:
+            self.use_response_cache(response_cache, max_age=response_cache_max_age)
+
+        if kwargs.get('metrics') or (cfg is not None and cfg.get('metrics')):
+            self.enable_metrics()
+
         self.is_valid = self.target_service_url is not None and (
                 (self.username is not None and self.password is not None)  or
                 (self.cookie is not None) or self.google_identity)
@@ -127,6 +417,85 @@ class FhirHost:
             )
         return self._client
 
+    @property
+    def offline(self):
+        """True when replaying, in which case we don't need (or try) to authenticate"""
+        return getattr(self.transport, 'offline', False)
+
+    def use_pooled_transport(self, **kwargs):
+        """Send requests through a PooledTransport (keep-alive, retries and timeouts) rather than the FhirApiClient"""
+        if self.max_concurrency is not None:
+            # No point keeping more connections than we'll ever use at once
+            kwargs.setdefault('pool_size', self.max_concurrency)
+        self.pooled_transport = PooledTransport(auth=self.auth(), **kwargs)
+        return self.pooled_transport
+
+    def set_max_concurrency(self, limit):
+        """Allow at most limit requests in flight at once across every thread (None for no limit)"""
+        self.max_concurrency = None
+        self._concurrency = None
+        if limit is not None:
+            self.max_concurrency = int(limit)
+            self._concurrency = threading.BoundedSemaphore(self.max_concurrency)
+
+    def _request_slot(self):
+        """Hold one of the max_concurrency slots for the duration of a request"""
+        if self._concurrency is None:
+            return nullcontext()
+        return self._concurrency
+
+    def _base_transport(self):
+        if self.pooled_transport is not None:
+            return self.pooled_transport
+        return self.client()
+
+    def record(self, path):
+        """Write every request and response to the cassette at path"""
+        transport = self.transport
+        if transport is None:
+            transport = self._base_transport()
+        self.transport = RecordingTransport(transport, path, base_url=self.target_service_url)
+        return self.transport
+
+    def replay(self, path, latency=None, latency_scale=1.0):
+        """Answer every request from the cassette at path rather than the server (see fhir_walk.cassette)"""
+        self.transport = ReplayTransport(path, base_url=self.target_service_url, latency=latency, latency_scale=latency_scale)
+        return self.transport
+
+    def add_hook(self, hook):
+        """hook(record) is called with a CallRecord each time a read or search completes"""
+        self.hooks.append(hook)
+        return hook
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def enable_metrics(self):
+        """Aggregate every call by search pattern. Returns the RequestMetrics"""
+        if self.metrics is None:
+            self.metrics = self.add_hook(RequestMetrics())
+        return self.metrics
+
+    def _start_call(self, resource):
+        """A CallRecord for resource, or None if nobody is listening"""
+        if len(self.hooks) > 0:
+            return CallRecord(resource)
+
+    def _finish_call(self, record):
+        if record is not None:
+            for hook in list(self.hooks):
+                try:
+                    hook(record)
+                except Exception:
+                    logger.exception("Metrics hook failed")
+
+    def _send(self, method, url, **kwargs):
+        transport = self.transport
+        if transport is None:
+            transport = self._base_transport()
+        with self._request_slot():
+            return transport.send_request(method, url, **kwargs)
+
     def get_login_header(self, headers = {}):
         # Slip authentication details into header
         if "Content-Type" not in headers:
@@ -135,7 +504,7 @@ class FhirHost:
         # Deal with the cookie stuff, if it's appropriate
         if self.cookie:
             headers['cookie'] = self.cookie
-        if self.google_identity:
+        if self.google_identity and not self.offline:
             headers['Authorization'] = self.get_google_identity()
 
         return headers
@@ -143,7 +512,8 @@ class FhirHost:
     def delete_by_record_id(self, resource, id):
         cheaders = self.get_login_header()
         endpoint = f"{self.target_service_url}/{resource}/{id}"
-        success, result = self.client().send_request("delete", endpoint, headers=cheaders )
+        self.resource_cache.invalidate(f"{resource}/{id}")
+        success, result = self._send("delete", endpoint, headers=cheaders )
         if not success:
             self.logger.error(pformat(result))
         return result
@@ -152,12 +522,13 @@ class FhirHost:
     def update(self, resource, id, data):
         cheaders = self.get_login_header()
         endpoint = f"{self.target_service_url}/{resource}/{id}"
+        self.resource_cache.invalidate(f"{resource}/{id}")
 
         print(cheaders['Content-Type'])
         #pdb.set_trace()
 
         #pdb.set_trace()
-        success, result = self.client().send_request(
+        success, result = self._send(
                                 "put", endpoint, 
                                 json=data, 
                                 headers=cheaders)
@@ -168,8 +539,9 @@ class FhirHost:
         cheaders = self.get_login_header()
         cheaders['Content-Type'] = 'application/json-patch+json'
         endpoint = f"{self.target_service_url}/{resource}/{id}"
+        self.resource_cache.invalidate(f"{resource}/{id}")
         #pdb.set_trace()
-        success, result = self.client().send_request(
+        success, result = self._send(
                                 "patch", endpoint, 
                                 json=data, 
                                 headers=cheaders)
@@ -194,7 +566,7 @@ class FhirHost:
                 'json': data
             }
 
-            success, result = self.client().send_request(
+            success, result = self._send(
                                 "POST", 
                                 endpoint, 
                                 json=data, 
@@ -209,46 +581,370 @@ class FhirHost:
         #token = token.decode('utf8').strip()
         return "Bearer " + token
 
-    def get(self, resource, recurse=True, no_count=False):
-        """Default to recurse down the chain of 'next' links
-
-        Please note that this is currently not very robust and works with our CMG data. 
-        """
+    def _search_headers(self):
         cheaders = self.client()._fhir_version_headers()
         if self.cookie:
             cheaders['cookie'] = self.cookie
 
-        #print(self.google_identity)
-        if self.google_identity:
+        if self.google_identity and not self.offline:
             cheaders['Authorization'] = self.get_google_identity()
+        return cheaders
+
+    def _resource_type(self, resource):
+        return resource.strip("/").split("?")[0].split("/")[0]
 
+    def _search_url(self, resource, no_count=False):
         count=""
-        if not no_count:
-            count = "?_count=250"
+        if not no_count and "_count=" not in resource:
+            page_size = self.page_sizer.count_for(self._resource_type(resource))
+            count = f"?_count={page_size}"
 
             if "?" in resource:
-                count = "&_count=250"
+                count = f"&_count={page_size}"
+
+        return f"{self.target_service_url}/{resource}{count}"
+
+    def use_response_cache(self, path, max_age=0):
+        """Keep GET responses in a sqlite file at path, revalidating them on subsequent runs"""
+        self.response_cache = ResponseCache(path, max_age=max_age)
+        return self.response_cache
+
+    def _http(self, method, url, auth=True, **kwargs):
+        """Plain HTTP, for when we need the status and headers rather than just the body. Returns a requests.Response"""
+        with self._request_slot():
+            if self.pooled_transport is not None:
+                if not auth:
+                    # None would fall back to the session's credentials
+                    kwargs['auth'] = lambda request: request
+                return self.pooled_transport.request(method, url, **kwargs)
+
+            if auth:
+                kwargs['auth'] = self.auth()
+            return requests.request(method, url, **kwargs)
+
+    def bulk_export(self, resource_types=None, **kwargs):
+        """Start a Bulk Data $export (see fhir_walk.bulk_export). Returns the BulkExport"""
+        from fhir_walk.bulk_export import BulkExport
+        export = BulkExport(self, resource_types=resource_types, **kwargs)
+        export.kick_off()
+        return export
+
+    def load_bulk_export(self, resource_types=None, progress=None, **kwargs):
+        """Pull everything down via $export and answer all subsequent reads and searches locally
+
+        The exported resources are held in a ResourceStore, which joins them on their
+        references, so the model classes work just as they would against the server.
+        Returns the store.
+        """
+        from fhir_walk.local_server import StoreTransport
+
+        export = self.bulk_export(resource_types=resource_types, **kwargs)
+        export.wait(progress=progress)
+        store = export.load()
+        self.transport = StoreTransport(store, base_url=self.target_service_url)
+        return store
+
+    def _conditional_get(self, url, cheaders):
+        """GET by way of the response cache, returning the same (success, result) as send_request"""
+        cache = self.response_cache
+        cached = cache.lookup(self.target_service_url, url)
+
+        if cached is not None and cache.is_fresh(cached):
+            cache.fresh_hits += 1
+            return True, {'status_code': 200, 'request_url': url, 'response': cached['body'], 'cached': True}
+
+        headers = dict(cheaders)
+        if cached is not None:
+            headers.update(cache.validators(cached))
+
+        try:
+            response = self._http("GET", url, headers=headers)
+        except requests.exceptions.RequestException as e:
+            return False, {'status_code': None, 'request_url': url, 'response': str(e)}
+
+        if response.status_code == 304 and cached is not None:
+            cache.revalidated += 1
+            cache.touch(self.target_service_url, url)
+            return True, {'status_code': 200, 'request_url': url, 'response': cached['body']}
+
+        cache.misses += 1
+        size = len(response.content)
+        try:
+            content = response.json()
+        except ValueError:
+            content = response.text
+
+        success = response.status_code in (200, 201, 204)
+        if success:
+            cache.store(self.target_service_url, url, response.headers, content)
+
+        return success, {'status_code': response.status_code, 'request_url': url, 'response': content, 'bytes': size}
+
+    def _fetch_page(self, url, cheaders, record=None, resource_type=None):
+        start = time.perf_counter()
+        if self.response_cache is not None and self.transport is None:
+            success, result = self._conditional_get(url, cheaders)
+        else:
+            success, result = self._send("GET", url, headers=cheaders)
 
-        url = f"{self.target_service_url}/{resource}{count}"
-        success, result = self.client().send_request("GET", f"{url}", headers=cheaders)
-       
         if not success:
             print("There was a problem with the request for the GET")
             print(pformat(result))
 
-        # For now, let's just give up if there was a problem
-        assert(success)
-        content = FhirResult(result)
+            # Whatever came before this page has already been handed out, so
+            # this is where the caller can pick things back up
+            raise FhirRequestError(url, result, resume_url=url)
+        page = FhirResult(result)
+        self.resource_cache.add_entries(page.entries)
+
+        if result.get('cached'):
+            if record is not None:
+                record.cache_hits += 1
+            return page
+
+        adapt = self.page_sizer.adaptive and resource_type is not None and page.response.get('resourceType') == 'Bundle'
+        if record is not None or adapt:
+            latency = time.perf_counter() - start
+
+            # Transports hand back parsed json, so unless they know better, the
+            # size is that of the re-serialized body
+            size = result.get('bytes')
+            if size is None:
+                size = len(json.dumps(page.response))
+            matches = len(page.matches)
+
+            if record is not None:
+                record.add_page(latency, size, matches)
+            if adapt:
+                self.page_sizer.observe(resource_type, latency, size, matches)
+        return page
+
+    def _read_key(self, resource):
+        """If resource is a simple read (ResourceType/id), return that key. Otherwise None"""
+        if "?" in resource:
+            return None
+        parts = resource.strip("/").split("/")
+        if len(parts) != 2:
+            return None
+        return "/".join(parts)
+
+    def _next_url(self, page, resource_type=None):
+        if page.next is None:
+            return None
+        params = page.next.split("?")[1]
+        url = f"{self.target_service_url}?{params}"
+
+        if resource_type is not None:
+            url = self.page_sizer.apply(url, resource_type)
+        return url
+
+    def iter_pages(self, resource, recurse=True, no_count=False, prefetch=None, resume_from=None):
+        """Yield one FhirResult per page, following the 'next' links only as the caller asks for more
+
+        Nothing is accumulated here, so only the current page is held in memory and the 
+        first page is available after a single round trip. 
+
+        prefetch is the number of pages a background worker may fetch ahead of the 
+        caller (defaults to the host's prefetch_depth). With it, the server is working
+        on page N+1 while the caller is still parsing page N. 
+
+        If a page fails, a FhirRequestError is raised. Passing its resume_url back as 
+        resume_from continues the search from that page.
+        """
+        if prefetch is None:
+            prefetch = self.prefetch_depth
+
+        record = self._start_call(resource)
+        try:
+            # No need to go to the server for a resource we've already seen
+            key = self._read_key(resource)
+            if key is not None and resume_from is None:
+                cached = self.resource_cache.get(key)
+                if cached is not None:
+                    if record is not None:
+                        record.cache_hits += 1
+                        record.entries += 1
+                    yield FhirResult({'response': cached})
+                    return
+
+            cheaders = self._search_headers()
+            url = self._search_url(resource, no_count)
+            if resume_from is not None:
+                url = resume_from
+
+            # Searches we sized are the ones we may resize as we go
+            resource_type = None
+            if not no_count:
+                resource_type = self._resource_type(resource)
+
+            if recurse and prefetch > 0:
+                prefetcher = PagePrefetcher(lambda page_url: self._fetch_page(page_url, cheaders, record, resource_type), 
+                                            lambda page: self._next_url(page, resource_type), 
+                                            url, 
+                                            depth=prefetch, 
+                                            max_entries=self.prefetch_max_entries)
+                yield from prefetcher
+                return
+
+            while url is not None:
+                page = self._fetch_page(url, cheaders, record, resource_type)
+                yield page
+
+                url = None
+                if recurse:
+                    url = self._next_url(page, resource_type)
+        finally:
+            self._finish_call(record)
+
+    def _streams(self, resource):
+        """Whether iter_entries should parse the pages for resource incrementally"""
+        return (self.stream_entries and self.transport is None and self.response_cache is None
+                    and self._read_key(resource) is None)
+
+    def _stream_entries(self, resource, no_count=False, resume_from=None):
+        """Yield each entry as it is parsed, without ever holding a full page"""
+        from fhir_walk.stream_parse import BundleStream
+
+        record = self._start_call(resource)
+        try:
+            cheaders = self._search_headers()
+            url = self._search_url(resource, no_count)
+            if resume_from is not None:
+                url = resume_from
+
+            resource_type = None
+            if not no_count:
+                resource_type = self._resource_type(resource)
+
+            while url is not None:
+                start = time.perf_counter()
+                try:
+                    response = self._http("GET", url, headers=cheaders, stream=True)
+                except requests.exceptions.RequestException as e:
+                    raise FhirRequestError(url, {'status_code': None, 'request_url': url, 'response': str(e)}, resume_url=url)
+
+                if response.status_code != 200:
+                    result = {'status_code': response.status_code, 'request_url': url, 'response': response.text}
+                    response.close()
+                    print("There was a problem with the request for the GET")
+                    print(pformat(result))
+                    raise FhirRequestError(url, result, resume_url=url)
+
+                # Time spent by whoever is consuming the entries isn't ours
+                busy = time.perf_counter() - start
+                response.raw.decode_content = True
+                bundle = BundleStream(response.raw)
+                entries = iter(bundle)
+                try:
+                    while True:
+                        start = time.perf_counter()
+                        entry = next(entries, None)
+                        busy += time.perf_counter() - start
+                        if entry is None:
+                            break
+
+                        self.resource_cache.add_entries([entry])
+                        yield entry
+                finally:
+                    response.close()
+
+                if record is not None:
+                    record.add_page(busy, bundle.bytes, bundle.match_count)
+                if resource_type is not None and self.page_sizer.adaptive:
+                    self.page_sizer.observe(resource_type, busy, bundle.bytes, bundle.match_count)
+                url = self._next_url(bundle, resource_type)
+        finally:
+            self._finish_call(record)
+
+    def iter_entries(self, resource, no_count=False, prefetch=None, resume_from=None):
+        """Yield each entry across all pages, one page at a time
+
+        With stream_entries, the entries are handed out as each page is parsed rather
+        than once it has been decoded in full (prefetch doesn't apply).
+        """
+        if self._streams(resource):
+            yield from self._stream_entries(resource, no_count=no_count, resume_from=resume_from)
+            return
 
-        # Follow paginated results if so desired
-        while recurse and content.next is not None:
-            params = content.next.split("?")[1]
+        for page in self.iter_pages(resource, no_count=no_count, prefetch=prefetch, resume_from=resume_from):
+            for entry in page.entries:
+                yield entry
 
-            success, result = self.client().send_request("GET", f"{self.target_service_url}?{params}", headers=cheaders)
-            assert(success)
-            content.append(result)
+    def get(self, resource, recurse=True, no_count=False, prefetch=None, resume_from=None):
+        """Default to recurse down the chain of 'next' links
+
+        Please note that this is currently not very robust and works with our CMG data. 
+        For large searches, consider iter_entries which doesn't hold every page in memory.
+
+        Should a page fail, the FhirRequestError carries whatever was gathered before it
+        as partial, so the caller can resume_from its resume_url and extend() the two.
+        """
+        content = None
+        try:
+            for page in self.iter_pages(resource, recurse=recurse, no_count=no_count, prefetch=prefetch, resume_from=resume_from):
+                if content is None:
+                    content = page
+                else:
+                    content.extend(page)
+        except FhirRequestError as e:
+            e.partial = content
+            raise
         return content
 
+    def resolve_references(self, refs, batch_size=None):
+        """Pull the resources for a collection of references in bulk
+
+        References are deduplicated and grouped by resource type, and each group is
+        pulled using _id=a,b,c searches of at most batch_size ids. Returns a dict 
+        mapping each of the original references to its resource. Anything the server
+        didn't return will simply be missing from the dict, as will references that
+        can't be searched for by id (contained #id and urn:uuid: references).
+        """
+        if batch_size is None:
+            batch_size = self.reference_batch_size
+
+        resolved = {}
+        by_key = {}
+        cache_hits = {}
+        for ref in refs:
+            key = reference_key(ref)
+            if not is_resource_key(key):
+                logger.debug(f"Unable to resolve reference {ref}")
+                continue
+            cached = self.resource_cache.get(key)
+            if cached is not None:
+                resolved[ref] = cached
+                resource_type = key.split("/")[0]
+                cache_hits[resource_type] = cache_hits.get(resource_type, 0) + 1
+            else:
+                by_key.setdefault(key, []).append(ref)
+
+        # Let the hooks know about the round trips the cache saved us
+        for resource_type, hits in cache_hits.items():
+            record = self._start_call(f"{resource_type}?_id=")
+            if record is not None:
+                record.cache_hits = hits
+                record.entries = hits
+                self._finish_call(record)
+
+        by_type = {}
+        for key in by_key:
+            resource_type, id = key.split("/")
+            by_type.setdefault(resource_type, []).append(id)
+
+        for resource_type in sorted(by_type):
+            ids = sorted(by_type[resource_type])
+            for i in range(0, len(ids), batch_size):
+                id_list = ",".join(ids[i:i + batch_size])
+
+                for entry in self.iter_entries(f"{resource_type}?_id={id_list}"):
+                    if 'resource' in entry:
+                        resource = entry['resource']
+                        key = f"{resource['resourceType']}/{resource['id']}"
+                        for ref in by_key.get(key, []):
+                            resolved[ref] = resource
+        return resolved
+
     @classmethod
     def host(cls, cfg=None, **kwargs):
         """Build new or retrieve preconfigured host object"""
@@ -4,6 +4,8 @@ import jwt
 import json
 import datetime
 import subprocess
+import threading
+import time
 import requests
 from pathlib import Path
 
@@ -19,13 +21,25 @@ from google.auth.transport.requests import AuthorizedSession
 import pdb
 
 # these do time-out periodicallly (max lifetime is 1hr)
-# So, you may want to keep this around and regenerate your
-# bearer token
+# So, we keep the token around until shortly before it expires 
+# and only then regenerate the bearer token
 class GoogleAuth(object):
+    # How many seconds before the reported expiry we go ahead and refresh
+    refresh_margin = 60
+
     def __init__(self, target_service = None, oa2_client=None):
         "Optionally choose between target service or open auth2"
         self.target_service = target_service
         self.oa2_client = oa2_client
+
+        # Cached token and the time (epoch seconds) at which it expires. The lock 
+        # makes sure only one thread performs the exchange when it's time to refresh
+        self._token = None
+        self._token_expires = 0
+        self._token_lock = threading.Lock()
+
+        # Number of token exchanges actually performed (i.e. cache misses)
+        self.token_exchanges = 0
         if target_service:
             with open(target_service, 'rt') as f:
                 data=f.read()
@@ -50,60 +64,84 @@ class GoogleAuth(object):
                 self.client_secret = data['installed']['client_secret']
                 self.credentials = None
 
+    def _token_is_fresh(self):
+        return self._token is not None and time.time() < self._token_expires
+
     def access_token(self, lifetime=60):
-        #pdb.set_trace()        
+        """Return a bearer token, only going back to google when the cached one is about to expire"""
         if self.target_service:
-            """
-            This should work, but obviously the token I'm getting back isn't what I expect it 
-            should be. So, rather than continuing to spin my tires on a more elegant solution 
-            for something I have working, I'm going to move on for now. 
-
-            creds = service_auth.IDTokenCredentials.from_service_account_file(self.target_service, target_audience=self.token_uri)
-            authed_session = AuthorizedSession(creds)
-            resp = authed_session.get(self.scope)
-            request = google.auth.transport.requests.Request()
-            token = creds.token
-            print(id_token.verify_token(token, request))
-            print("Returning the token from google's stuff")
-            return token
-
-            pdb.set_trace()
-            from oauth2client import service_account 
-            credentials = service_account.ServiceAccountCredentials.from_json_keyfile_name(self.target_service)
-            """
-            claim_set = {
-                "iss": self.account,
-                "scope": self.scope,
-                "aud": self.token_uri,
-                "exp": datetime.datetime.utcnow() + datetime.timedelta(minutes=lifetime),
-                "iat": datetime.datetime.utcnow()
-            }
-
-            signature = jwt.encode(claim_set, self.private_key, algorithm=self.algorithm)
-            req = requests.post(self.token_uri, 
-                            data={
-                                'grant_type': 'urn:ietf:params:oauth:grant-type:jwt-bearer',
-                                'assertion': signature,
-                                'response_type': 'code'
-                                }
-                            )
-            return req.json()['access_token']
+            # Fast path, no locking required if the cached token is still good
+            if self._token_is_fresh():
+                return self._token
+
+            with self._token_lock:
+                # Someone else may have refreshed while we were waiting on the lock
+                if not self._token_is_fresh():
+                    token, expires_in = self._exchange_token(lifetime)
+                    margin = min(self.refresh_margin, expires_in / 2)
+                    self._token = token
+                    self._token_expires = time.time() + expires_in - margin
+                return self._token
         elif self.oa2_client:
+            with self._token_lock:
+                if self.credentials is None or self.credentials.expired:
+                    #pdb.set_trace()
+                    from google_auth_oauthlib.flow import InstalledAppFlow
+
+                    flow = InstalledAppFlow.from_client_secrets_file(
+                        self.oa2_client,
+                        scopes=[self.scope]) 
+                    self.credentials = flow.run_console()        
+                    self.token_exchanges += 1
+                    # The local server only works if you are running with access to the browser, 
+                    # Which doesn't work right with WSL
+                    """credentials = flow.run_local_server(host='localhost',
+                        port=8080, 
+                        authorization_prompt_message='Please visit this URL: {url}', 
+                        success_message='The auth flow is complete; you may close this window.',
+                        open_browser=True)            """   
+                    #print(credentials)
+                return self.credentials.token
+
+    def _exchange_token(self, lifetime=60):
+        """Sign a fresh JWT and trade it for an access token. Returns (token, expires_in seconds)"""
+        """
+        This should work, but obviously the token I'm getting back isn't what I expect it 
+        should be. So, rather than continuing to spin my tires on a more elegant solution 
+        for something I have working, I'm going to move on for now. 
+
+        creds = service_auth.IDTokenCredentials.from_service_account_file(self.target_service, target_audience=self.token_uri)
+        authed_session = AuthorizedSession(creds)
+        resp = authed_session.get(self.scope)
+        request = google.auth.transport.requests.Request()
+        token = creds.token
+        print(id_token.verify_token(token, request))
+        print("Returning the token from google's stuff")
+        return token
+
+        pdb.set_trace()
+        from oauth2client import service_account 
+        credentials = service_account.ServiceAccountCredentials.from_json_keyfile_name(self.target_service)
+        """
+        claim_set = {
+            "iss": self.account,
+            "scope": self.scope,
+            "aud": self.token_uri,
+            "exp": datetime.datetime.utcnow() + datetime.timedelta(minutes=lifetime),
+            "iat": datetime.datetime.utcnow()
+        }
+
+        signature = jwt.encode(claim_set, self.private_key, algorithm=self.algorithm)
+        req = requests.post(self.token_uri, 
+                        data={
+                            'grant_type': 'urn:ietf:params:oauth:grant-type:jwt-bearer',
+                            'assertion': signature,
+                            'response_type': 'code'
+                            }
+                        )
+        self.token_exchanges += 1
+        payload = req.json()
 
-            if self.credentials is None or self.credentials.expired:
-                #pdb.set_trace()
-                from google_auth_oauthlib.flow import InstalledAppFlow
-
-                flow = InstalledAppFlow.from_client_secrets_file(
-                    self.oa2_client,
-                    scopes=[self.scope]) 
-                self.credentials = flow.run_console()        
-                # The local server only works if you are running with access to the browser, 
-                # Which doesn't work right with WSL
-                """credentials = flow.run_local_server(host='localhost',
-                    port=8080, 
-                    authorization_prompt_message='Please visit this URL: {url}', 
-                    success_message='The auth flow is complete; you may close this window.',
-                    open_browser=True)            """   
-                #print(credentials)
-            return self.credentials.token
+        # Fall back to the lifetime we asked for if google doesn't tell us
+        expires_in = payload.get('expires_in', lifetime * 60)
+        return payload['access_token'], int(expires_in)
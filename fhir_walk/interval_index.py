@@ -0,0 +1,203 @@
+"""Genomic interval index over a VariantTable
+
+Finding the variants that overlap a region shouldn't mean looking at every
+variant in the study. For each chromosome, IntervalIndex keeps the variants
+sorted by start, and the candidates for a query are bounded by two binary
+searches:
+
+    * nothing at or after the first start past the query's end can overlap
+    * nothing starting more than long_interval bases before the query's start
+      can reach it, since no (short) variant is longer than that
+
+and only the rows between the two need their ends checked. Variants longer
+than long_interval (large SVs, say) are kept apart, sorted by start along with
+the running maximum of their ends, which bounds the search among them instead.
+Were they mixed in with everything else, a single long variant would push that
+running maximum past every query for the rest of the chromosome:
+
+    index = study.variant_table().interval_index()
+    rows = index.overlapping('17', 43044295, 43125483)
+    index.query_bed("capture_regions.bed")      # VariantTable of the hits
+
+Positions follow the variants, 1 based and inclusive. BED files are 0 based
+and half open, so their intervals are converted as they are read. Chromosome
+names are compared without any leading 'chr', so 'chr17' and '17' match.
+
+Dependencies: numpy
+"""
+import gzip
+
+from fhir_walk.variant_table import _numpy
+
+def chrom_key(name):
+    """Normalize a chromosome name, so chr1, CHR1 and 1 are all the same"""
+    name = str(name).strip()
+    if name[:3].lower() == 'chr':
+        name = name[3:]
+    if name.upper() in ('M', 'MT'):
+        return 'MT'
+    return name.upper()
+
+def read_bed(path):
+    """Yield (chrom, start, end, name) for each interval in a BED file (gzipped or not)
+
+    start and end are converted to 1 based, inclusive coordinates. name is None
+    when the file doesn't have a fourth column."""
+    opener = gzip.open if str(path).endswith(".gz") else open
+    with opener(path, 'rt') as f:
+        for line in f:
+            if line.strip() == "" or line.startswith(("#", "track", "browser")):
+                continue
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 3:
+                fields = line.split()
+            name = fields[3] if len(fields) > 3 else None
+            yield fields[0], int(fields[1]) + 1, int(fields[2]), name
+
+class _Intervals:
+    def __init__(self, rows, starts, ends, max_length=None):
+        self.rows = rows            # Table rows, in order of start
+        self.starts = starts
+        self.ends = ends
+
+        # With no bound on the length, fall back on the running max of the ends
+        self.max_length = max_length
+        self.max_ends = None
+        if max_length is None:
+            self.max_ends = _numpy().maximum.accumulate(ends)
+
+    def bounds(self, start, end):
+        """The slice of sorted rows that could overlap start-end (scalars or arrays)"""
+        np = _numpy()
+        if self.max_ends is None:
+            low = np.searchsorted(self.starts, np.subtract(start, self.max_length), side='left')
+        else:
+            low = np.searchsorted(self.max_ends, start, side='left')
+        high = np.searchsorted(self.starts, end, side='right')
+        return low, high
+
+class _Chromosome:
+    def __init__(self, rows, starts, ends, long_interval):
+        np = _numpy()
+        self.rows = rows
+        self.parts = []
+
+        long = (ends[rows] - starts[rows]) > long_interval
+        for part, max_length in [(rows[~long], long_interval), (rows[long], None)]:
+            if len(part) > 0:
+                part = part[np.argsort(starts[part], kind='stable')]
+                self.parts.append(_Intervals(part, starts[part], ends[part], max_length=max_length))
+
+class IntervalIndex:
+    def __init__(self, table, long_interval=1000):
+        np = _numpy()
+        self.table = table
+        self.long_interval = long_interval
+        self.chromosomes = {}
+
+        starts = table.start
+        # A variant without an end covers just its start
+        ends = np.where(table.end < 0, starts, table.end)
+        codes = table.codes['chrom']
+
+        for code, name in enumerate(table.categories['chrom']):
+            rows = np.flatnonzero((codes == code) & (starts >= 0))
+            if len(rows) == 0:
+                continue
+
+            key = chrom_key(name)
+            if key in self.chromosomes:
+                # Same chromosome, spelled differently
+                rows = np.concatenate([self.chromosomes[key].rows, rows])
+            self.chromosomes[key] = _Chromosome(rows, starts, ends, long_interval)
+
+    @classmethod
+    def from_variants(cls, variants, patient_id=None, specimen_id=None, long_interval=1000):
+        from fhir_walk.variant_table import VariantTable
+        return cls(VariantTable.from_variants(variants, patient_id=patient_id, specimen_id=specimen_id),
+                   long_interval=long_interval)
+
+    @classmethod
+    def from_snapshot(cls, path, long_interval=1000):
+        from fhir_walk.variant_table import VariantTable
+        return cls(VariantTable.from_snapshot(path), long_interval=long_interval)
+
+    def __len__(self):
+        return sum(len(chromosome.rows) for chromosome in self.chromosomes.values())
+
+    def overlapping(self, chrom, start, end):
+        """Return the (sorted) table rows of the variants overlapping chrom:start-end"""
+        np = _numpy()
+        chromosome = self.chromosomes.get(chrom_key(chrom))
+        if chromosome is None:
+            return np.array([], dtype=np.int64)
+
+        hits = []
+        for part in chromosome.parts:
+            low, high = part.bounds(start, end)
+            if high > low:
+                hits.append(part.rows[low:high][part.ends[low:high] >= start])
+        if len(hits) == 0:
+            return np.array([], dtype=np.int64)
+        return np.sort(np.concatenate(hits))
+
+    def query(self, chrom, start, end):
+        """A VariantTable of the variants overlapping chrom:start-end"""
+        return self.table.take(self.overlapping(chrom, start, end))
+
+    def overlapping_many(self, intervals):
+        """Match many (chrom, start, end[, ...]) intervals at once
+
+        Returns two parallel arrays, the position of the interval in intervals and
+        the table row of each variant overlapping it."""
+        np = _numpy()
+        by_chrom = {}
+        for position, interval in enumerate(intervals):
+            by_chrom.setdefault(chrom_key(interval[0]), []).append((position, interval[1], interval[2]))
+
+        matched_intervals = []
+        matched_rows = []
+        for key, queries in by_chrom.items():
+            chromosome = self.chromosomes.get(key)
+            if chromosome is None:
+                continue
+
+            positions, starts, ends = (np.array(column, dtype=np.int64) for column in zip(*queries))
+            for part in chromosome.parts:
+                low, high = part.bounds(starts, ends)
+                counts = np.maximum(high - low, 0)
+                total = int(counts.sum())
+                if total == 0:
+                    continue
+
+                # Every candidate slot, low[i]..high[i] for each query i, flattened
+                query = np.repeat(np.arange(len(queries)), counts)
+                offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+                candidates = np.repeat(low, counts) + offsets
+
+                keep = part.ends[candidates] >= starts[query]
+                matched_intervals.append(positions[query[keep]])
+                matched_rows.append(part.rows[candidates[keep]])
+
+        if len(matched_rows) == 0:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+        return np.concatenate(matched_intervals), np.concatenate(matched_rows)
+
+    def overlapping_bed(self, path, padding=0):
+        """Return the (sorted, unique) table rows of the variants overlapping any interval in a BED file"""
+        np = _numpy()
+        intervals = [(chrom, start - padding, end + padding) for chrom, start, end, name in read_bed(path)]
+        interval_ids, rows = self.overlapping_many(intervals)
+        return np.unique(rows)
+
+    def query_bed(self, path, padding=0):
+        """A VariantTable of the variants overlapping any of the intervals in a BED file"""
+        return self.table.take(self.overlapping_bed(path, padding=padding))
+
+    def bed_counts(self, path, padding=0):
+        """Return a list of (chrom, start, end, name, variant count) for each interval in a BED file"""
+        np = _numpy()
+        intervals = list(read_bed(path))
+        interval_ids, rows = self.overlapping_many([(chrom, start - padding, end + padding) for chrom, start, end, name in intervals])
+        counts = np.bincount(interval_ids, minlength=len(intervals))
+        return [(chrom, start, end, name, int(count)) for (chrom, start, end, name), count in zip(intervals, counts)]
@@ -0,0 +1,473 @@
+"""A lightweight, in memory stand-in for a FHIR server
+
+This is not a FHIR server. It answers the reads and searches that the walker
+models actually make, with paginated bundles, which is enough to exercise the
+models end to end (and benchmark them) without a real server:
+
+    * reads (Type/id)
+    * searches on _id, identifier, subject, specimen, focus, study, individual,
+      derived-from, code and code:text, where comma separated values are OR'd
+    * _include/_revinclude of the form Type:param
+    * _count, with HAPI style _getpages continuation links
+    * system level Bulk Data $export (kick off, status polling and NDJSON files)
+
+    store = ResourceStore(SyntheticStudy(subjects=1000).resources())
+    with LocalFhirServer(store) as server:
+        host = FhirHost(target_service_url=server.url, username='x', password='x')
+
+StoreTransport answers a FhirHost's requests from a ResourceStore directly,
+without any HTTP at all, which is how FhirHost.load_bulk_export serves the
+exported resources.
+
+It can also be run from the command line, serving a synthetic study:
+
+    python -m fhir_walk.local_server --subjects 1000 --port 8000
+"""
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+from fhir_walk.cassette import relative_url
+
+# search parameter => path to the reference (or list of references) inside the resource
+reference_params = {
+    'subject': 'subject',
+    'specimen': 'specimen',
+    'focus': 'focus',
+    'study': 'study',
+    'individual': 'individual',
+    'derived-from': 'derivedFrom',
+    'patient': 'subject'
+}
+
+def _key(ref):
+    return "/".join(ref.split("/_history/")[0].rstrip("/").split("/")[-2:])
+
+def _references(resource, path):
+    value = resource.get(path)
+    if value is None:
+        return []
+    if isinstance(value, dict):
+        value = [value]
+    return [_key(ref['reference']) for ref in value if 'reference' in ref]
+
+def _codes(resource):
+    return [coding['code'] for coding in resource.get('code', {}).get('coding', []) if 'code' in coding]
+
+def _identifiers(resource):
+    return [identifier['value'] for identifier in resource.get('identifier', []) if 'value' in identifier]
+
+def outcome(status, message):
+    return status, {
+        "resourceType": "OperationOutcome",
+        "issue": [{"severity": "error", "code": "processing", "diagnostics": message}]
+    }
+
+class ResourceStore:
+    """Resources indexed by type and id, with lazily built indexes for the search parameters"""
+    def __init__(self, resources=None, max_searches=1000):
+        self.resources = {}         # type => OrderedDict(id => resource)
+        self._indexes = {}          # (type, param) => value => [ids]
+        self._lock = threading.Lock()
+
+        # Search results waiting on someone to ask for the next page
+        self.max_searches = max_searches
+        self._searches = OrderedDict()
+
+        if resources is not None:
+            self.add_all(resources)
+
+    def add(self, resource):
+        self.resources.setdefault(resource['resourceType'], OrderedDict())[resource['id']] = resource
+        self._indexes = {}
+
+    def add_all(self, resources):
+        for resource in resources:
+            self.resources.setdefault(resource['resourceType'], OrderedDict())[resource['id']] = resource
+        self._indexes = {}
+
+    def count(self, resource_type=None):
+        if resource_type is not None:
+            return len(self.resources.get(resource_type, {}))
+        return sum(len(resources) for resources in self.resources.values())
+
+    def read(self, resource_type, id):
+        return self.resources.get(resource_type, {}).get(id)
+
+    def _values(self, resource, param):
+        if param in reference_params:
+            return _references(resource, reference_params[param])
+        if param == 'code':
+            return _codes(resource)
+        if param == 'identifier':
+            return _identifiers(resource)
+        if param == 'code:text':
+            return [resource.get('code', {}).get('text', '').lower()]
+        return []
+
+    def _index(self, resource_type, param):
+        with self._lock:
+            index = self._indexes.get((resource_type, param))
+            if index is None:
+                index = {}
+                for position, (id, resource) in enumerate(self.resources.get(resource_type, {}).items()):
+                    if param == '_order':
+                        index[id] = position
+                        continue
+                    for value in self._values(resource, param):
+                        index.setdefault(value, []).append(id)
+                self._indexes[(resource_type, param)] = index
+            return index
+
+    def _match_ids(self, resource_type, param, values):
+        """Return the set of ids matching any of the values for param"""
+        resources = self.resources.get(resource_type, {})
+
+        if param == '_id':
+            return set(id for id in values if id in resources)
+
+        index = self._index(resource_type, param)
+        ids = set()
+
+        if param == 'code:text':
+            # Like most servers, :text matches the start of the text
+            prefixes = tuple(value.lower() for value in values)
+            for text, text_ids in index.items():
+                if text.startswith(prefixes):
+                    ids.update(text_ids)
+            return ids
+
+        if param in reference_params:
+            values = [_key(value) for value in values]
+
+        for value in values:
+            ids.update(index.get(value, []))
+        return ids
+
+    def _order(self, resource_type):
+        """Position of each id within the store, so results come back in a stable order"""
+        return self._index(resource_type, '_order')
+
+    def search(self, resource_type, params):
+        """Return the list of matching resources for a dict of param => [comma separated values]"""
+        resources = self.resources.get(resource_type, {})
+        ids = None
+
+        for param, values in params.items():
+            if param.startswith("_") and param != '_id':
+                continue
+            matched = self._match_ids(resource_type, param, ",".join(values).split(","))
+            if ids is None:
+                ids = matched
+            else:
+                ids &= matched
+
+        if ids is None:
+            return list(resources.values())
+
+        order = self._order(resource_type)
+        return [resources[id] for id in sorted(ids, key=order.get)]
+
+    def includes(self, matches, params):
+        """Resources pulled in by _include and _revinclude for a page of matches"""
+        included = OrderedDict()
+
+        for spec in params.get('_include', []):
+            source_type, param = spec.split(":")[:2]
+            path = reference_params.get(param, param)
+            for resource in matches:
+                if resource['resourceType'] == source_type:
+                    for key in _references(resource, path):
+                        target_type, target_id = key.split("/")
+                        target = self.read(target_type, target_id)
+                        if target is not None:
+                            included[key] = target
+
+        for spec in params.get('_revinclude', []):
+            source_type, param = spec.split(":")[:2]
+            index = self._index(source_type, param)
+            for resource in matches:
+                for id in index.get(f"{resource['resourceType']}/{resource['id']}", []):
+                    included[f"{source_type}/{id}"] = self.resources[source_type][id]
+
+        return list(included.values())
+
+    def _bundle(self, base_url, search_id, matches, offset, count, params):
+        page = matches[offset:offset + count]
+        entries = [{"fullUrl": f"{base_url}/{r['resourceType']}/{r['id']}", "resource": r, "search": {"mode": "match"}} for r in page]
+        entries += [{"fullUrl": f"{base_url}/{r['resourceType']}/{r['id']}", "resource": r, "search": {"mode": "include"}}
+                        for r in self.includes(page, params)]
+
+        bundle = {
+            "resourceType": "Bundle",
+            "id": str(uuid.uuid4()),
+            "type": "searchset",
+            "total": len(matches),
+            "link": [{"relation": "self", "url": f"{base_url}?_getpages={search_id}&_getpagesoffset={offset}&_count={count}"}]
+        }
+        if offset + count < len(matches):
+            bundle['link'].append({"relation": "next",
+                                   "url": f"{base_url}?_getpages={search_id}&_getpagesoffset={offset + count}&_count={count}&_bundletype=searchset"})
+        if len(entries) > 0:
+            bundle['entry'] = entries
+        return bundle
+
+    def get(self, base_url, path, query):
+        """Answer a GET, returning (status, body)"""
+        params = parse_qs(query, keep_blank_values=True)
+        count = int(params.get('_count', ['100'])[0])
+        parts = [part for part in path.split("/") if part]
+
+        # Continuation of an earlier search
+        if len(parts) == 0 and '_getpages' in params:
+            with self._lock:
+                # Searches still being paged through are the ones to keep around
+                search = self._searches.get(params['_getpages'][0])
+                if search is not None:
+                    self._searches.move_to_end(params['_getpages'][0])
+            if search is None:
+                return outcome(410, "The search has expired")
+            matches, search_params = search
+            return 200, self._bundle(base_url, params['_getpages'][0], matches, int(params.get('_getpagesoffset', ['0'])[0]), count, search_params)
+
+        if len(parts) == 2:
+            resource = self.read(parts[0], parts[1])
+            if resource is None:
+                return outcome(404, f"Resource {parts[0]}/{parts[1]} is not known")
+            return 200, resource
+
+        if len(parts) != 1:
+            return outcome(400, f"Unsupported request: {path}")
+
+        matches = self.search(parts[0], params)
+        search_id = str(uuid.uuid4())
+
+        # Only searches with more than one page will ever be asked for again
+        if len(matches) > count:
+            with self._lock:
+                self._searches[search_id] = (matches, params)
+                while len(self._searches) > self.max_searches:
+                    self._searches.popitem(last=False)
+        return 200, self._bundle(base_url, search_id, matches, 0, count, params)
+
+class StoreTransport:
+    """A FhirHost transport which answers GETs straight from a ResourceStore"""
+    offline = True
+
+    def __init__(self, store, base_url=None):
+        self.store = store
+        self.base_url = base_url
+
+    def send_request(self, method, url, **kwargs):
+        if method.upper() != 'GET':
+            status, body = outcome(405, f"{method.upper()} isn't supported against a local store")
+        else:
+            path, sep, query = relative_url(self.base_url, url).partition("?")
+            status, body = self.store.get(self.base_url, path, query)
+        return status == 200, {'status_code': status, 'request_url': url, 'response': body}
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    # The headers and body go out as separate writes. With Nagle on, the body
+    # sits waiting on the client's delayed ACK (~40ms) on every kept-alive request
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_ndjson(self, resources):
+        """Stream resources, one per line, using chunked encoding"""
+        self.send_response(200)
+        self.send_header("Content-Type", "application/fhir+ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        size = 0
+        lines = []
+        buffered = 0
+        for resource in resources:
+            line = (json.dumps(resource) + "\n").encode('utf8')
+            lines.append(line)
+            buffered += len(line)
+            if buffered >= 65536:
+                size += self._write_chunk(b"".join(lines))
+                lines = []
+                buffered = 0
+        if len(lines) > 0:
+            size += self._write_chunk(b"".join(lines))
+        self.wfile.write(b"0\r\n\r\n")
+        self.server.count_response(size)
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+        return len(data)
+
+    def _export(self, url):
+        """Bulk Data $export: kick off, status and file downloads"""
+        server = self.server
+        params = parse_qs(url.query)
+
+        if url.path.rstrip("/").endswith("$export"):
+            if url.path.strip("/") != "$export":
+                self._send(*outcome(400, "Only system level exports are supported"))
+            elif self.headers.get('Prefer') != 'respond-async':
+                self._send(*outcome(400, "Exports require Prefer: respond-async"))
+            else:
+                types = ",".join(params.get('_type', [])).split(",")
+                job = server.start_export([t for t in types if t])
+                self._send(202, outcome(202, "Accepted")[1], {"Content-Location": f"{server.url}/$export-status/{job}"})
+            return
+
+        parts = [part for part in url.path.split("/") if part]
+        if parts[0] == '$export-status' and len(parts) == 2:
+            status, body, headers = server.export_status(parts[1])
+            self._send(status, body, headers)
+        elif parts[0] == '$export-files' and len(parts) == 3:
+            resources = server.export_file(parts[1], parts[2].split(".")[0])
+            if resources is None:
+                self._send(*outcome(404, "No such export file"))
+            else:
+                self._send_ndjson(resources)
+        else:
+            self._send(*outcome(404, f"Unknown export path {url.path}"))
+
+    def do_DELETE(self):
+        parts = [part for part in urlparse(self.path).path.split("/") if part]
+        if len(parts) == 2 and parts[0] == '$export-status' and self.server.cancel_export(parts[1]):
+            self._send(202, outcome(202, "Cancelled")[1])
+        else:
+            self._send(*outcome(404, "No such export"))
+
+    def _send(self, status, body, headers=None):
+        payload = json.dumps(body).encode('utf8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/fhir+json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+        self.server.count_response(len(payload))
+
+    def do_GET(self):
+        if self.server.latency > 0:
+            time.sleep(self.server.latency)
+
+        url = urlparse(self.path)
+        if "$export" in url.path:
+            self._export(url)
+            return
+
+        status, body = self.server.store.get(self.server.url, url.path, url.query)
+        self._send(status, body)
+
+class LocalFhirServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, store, host="127.0.0.1", port=0, latency=0, export_polls=1):
+        super().__init__((host, port), _Handler)
+        self.store = store
+
+        # Number of times an export's status reports 'in progress' before it completes
+        self.export_polls = export_polls
+        self.exports = {}
+
+        # Seconds to wait before answering each request, to mimic a remote server
+        self.latency = latency
+        self.url = f"http://{host}:{self.server_address[1]}"
+        self._thread = None
+
+        self._stats_lock = threading.Lock()
+        self.requests = 0
+        self.bytes_sent = 0
+
+    def count_response(self, size):
+        with self._stats_lock:
+            self.requests += 1
+            self.bytes_sent += size
+
+    def start_export(self, resource_types):
+        job = str(uuid.uuid4())
+        if len(resource_types) == 0:
+            resource_types = sorted(self.store.resources.keys())
+        with self._stats_lock:
+            self.exports[job] = {'types': resource_types, 'polls': self.export_polls}
+        return job
+
+    def export_status(self, job):
+        """Return (status, body, headers) for an export's status url"""
+        with self._stats_lock:
+            export = self.exports.get(job)
+            if export is None:
+                return outcome(404, "No such export") + ({},)
+            if export['polls'] > 0:
+                export['polls'] -= 1
+                return 202, outcome(202, "Export in progress")[1], {"X-Progress": "in progress", "Retry-After": "0"}
+
+        output = []
+        for resource_type in export['types']:
+            count = self.store.count(resource_type)
+            if count > 0:
+                output.append({"type": resource_type, "url": f"{self.url}/$export-files/{job}/{resource_type}.ndjson", "count": count})
+        return 200, {
+            "transactionTime": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "request": f"{self.url}/$export",
+            "requiresAccessToken": True,
+            "output": output,
+            "error": []
+        }, {}
+
+    def export_file(self, job, resource_type):
+        export = self.exports.get(job)
+        if export is None or resource_type not in export['types']:
+            return None
+        return list(self.store.resources.get(resource_type, {}).values())
+
+    def cancel_export(self, job):
+        with self._stats_lock:
+            return self.exports.pop(job, None) is not None
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self.requests = 0
+            self.bytes_sent = 0
+
+    def start(self):
+        """Serve from a background thread"""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    from fhir_walk.synthetic import SyntheticStudy
+
+    parser = ArgumentParser()
+    parser.add_argument("--subjects", type=int, default=100, help="Number of subjects in the synthetic study")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0, help="Seconds to wait before answering each request")
+    args = parser.parse_args()
+
+    store = ResourceStore(SyntheticStudy(subjects=args.subjects, seed=args.seed).resources())
+    server = LocalFhirServer(store, port=args.port, latency=args.latency)
+    print(f"Serving {store.count()} resources at {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -0,0 +1,133 @@
+"""Per-request instrumentation for FhirHost
+
+Every call a host makes (a read or a search, along with all of the pages it
+follows) produces a CallRecord which is handed to each of the host's hooks:
+
+    host.add_hook(lambda record: print(record.pattern, record.latency))
+
+RequestMetrics is a hook that aggregates the records by search pattern (the
+resource with the parameter values stripped out, e.g. "Observation?specimen=")
+so that N+1 hot spots stand out:
+
+    metrics = host.enable_metrics()
+    ...
+    print(metrics.summary())
+"""
+import threading
+from urllib.parse import parse_qsl
+
+# These parameters' values describe the shape of the query rather than the data
+shape_params = set(['_include', '_revinclude', 'code', 'code:text'])
+
+def search_pattern(resource):
+    """Reduce a resource request down to the shape of the request, minus the ids"""
+    path, sep, query = resource.partition("?")
+    parts = [part for part in path.strip("/").split("/") if part]
+
+    pattern = parts[0] if len(parts) > 0 else ""
+    if len(parts) > 1:
+        pattern += "/{id}"
+
+    if sep:
+        params = []
+        for name, value in parse_qsl(query, keep_blank_values=True):
+            if name == '_count':
+                continue
+            if name in shape_params:
+                params.append(f"{name}={value}")
+            else:
+                params.append(f"{name}=")
+        pattern += "?" + "&".join(params)
+    return pattern
+
+def percentile(values, pct):
+    if len(values) == 0:
+        return 0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+class CallRecord:
+    def __init__(self, resource):
+        self.resource = resource
+        self.resource_type = resource.strip("/").split("?")[0].split("/")[0]
+        self.pattern = search_pattern(resource)
+        self.latency = 0.0          # seconds spent waiting on (and parsing) pages
+        self.bytes = 0
+        self.pages = 0
+        self.entries = 0
+        self.cache_hits = 0
+
+    def add_page(self, latency, size, entries):
+        self.latency += latency
+        self.bytes += size
+        self.pages += 1
+        self.entries += entries
+
+class PatternStats:
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.calls = 0
+        self.latencies = []
+        self.bytes = 0
+        self.pages = 0
+        self.entries = 0
+        self.cache_hits = 0
+
+    def add(self, record):
+        self.calls += 1
+        self.latencies.append(record.latency)
+        self.bytes += record.bytes
+        self.pages += record.pages
+        self.entries += record.entries
+        self.cache_hits += record.cache_hits
+
+    @property
+    def total_latency(self):
+        return sum(self.latencies)
+
+    def describe(self):
+        return (f"{self.pattern} called {self.calls:,} times, "
+                f"p50 {percentile(self.latencies, 50) * 1000:.0f}ms, "
+                f"p99 {percentile(self.latencies, 99) * 1000:.0f}ms, "
+                f"total {self.total_latency:.2f}s, "
+                f"{self.pages:,} pages, {self.entries:,} entries, "
+                f"{self.bytes / (1024 * 1024):.1f} MB, {self.cache_hits:,} cache hits")
+
+class RequestMetrics:
+    """Aggregate CallRecords by their search pattern"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.patterns = {}
+
+    def __call__(self, record):
+        with self._lock:
+            if record.pattern not in self.patterns:
+                self.patterns[record.pattern] = PatternStats(record.pattern)
+            self.patterns[record.pattern].add(record)
+
+    def reset(self):
+        with self._lock:
+            self.patterns = {}
+
+    @property
+    def calls(self):
+        return sum(stats.calls for stats in self.patterns.values())
+
+    @property
+    def requests(self):
+        """Pages actually pulled from the server (cache hits don't count)"""
+        return sum(stats.pages for stats in self.patterns.values())
+
+    def summary(self, limit=None):
+        """One line per search pattern, most expensive first"""
+        with self._lock:
+            ordered = sorted(self.patterns.values(), key=lambda stats: stats.total_latency, reverse=True)
+
+        if limit is not None:
+            ordered = ordered[:limit]
+
+        lines = [f"{self.calls:,} calls, {self.requests:,} requests"]
+        for stats in ordered:
+            lines.append(stats.describe())
+        return "\n".join(lines)
@@ -1,5 +1,15 @@
 
 import pdb
+import sys
+
+def intern(value):
+    """Intern strings which repeat across many resources (codes, systems, displays...)
+
+    Thousands of objects then share one copy of each, rather than each holding its own"""
+    if isinstance(value, str):
+        return sys.intern(value)
+    return value
+
 def unwrap_bundle(response):
     """If the resource type is 'Bundle', return the contents of that bundle. 
 
@@ -1,7 +1,10 @@
 """Disease (conditions) associated with a patient"""
 from pprint import pformat
+from fhir_walk.model import intern
 
 class Disease:
+	__slots__ = ('host', 'id', 'status', 'code', 'text')
+
 	def __init__(self, host, data):
 		# this is the fhir_server object, which will be used to pull related entities
 		self.host = host		
@@ -9,31 +12,38 @@ class Disease:
 		self.status = ""
 
 		if 'verificationStatus' in data:
-			self.status = data['verificationStatus']['text']
+			self.status = intern(data['verificationStatus']['text'])
 
 		self.code = ""
 		self.text = ""
 
 		if 'code' in data:
-			self.text = data['code']['text']
+			self.text = intern(data['code']['text'])
 
 			# For now, we are looking only at the first code
 			if 'coding' in data['code']:
-				self.code = data['code']['coding'][0]['code']
+				self.code = intern(data['code']['coding'][0]['code'])
 				if 'display' in data['code']['coding'][0]:
-					self.text = data['code']['coding'][0]['display']
+					self.text = intern(data['code']['coding'][0]['display'])
 
 
 
 	@classmethod
-	def DiseasesByPatient(cls, patient_id, host):
-		payload = host.get(f"Condition?subject=Patient/{patient_id}")
-
+	def _collect(cls, entries, host):
 		diseases = {}
 
-		for data_chunk in payload.entries:
+		for data_chunk in entries:
 			if 'resource' in data_chunk:
 				disease = Disease(host, data_chunk['resource'])
 				diseases[disease.code] = disease
 
-		return diseases
\ No newline at end of file
+		return diseases
+
+	@classmethod
+	def DiseasesByPatient(cls, patient_id, host):
+		return Disease._collect(host.iter_entries(f"Condition?subject=Patient/{patient_id}"), host)
+
+	@classmethod
+	async def DiseasesByPatientAsync(cls, patient_id, ahost):
+		payload = await ahost.get(f"Condition?subject=Patient/{patient_id}")
+		return Disease._collect(payload.entries, ahost.host)
\ No newline at end of file
@@ -13,25 +13,37 @@ dbgap_id
 """
 
 # TODO -- Add support for extended family
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from re import compile
 
 from fhir_walk.model.disease import Disease
 from fhir_walk.model.phenotypes import Phenotype
 from fhir_walk.model.specimen import Specimen
-from fhir_walk.model import unwrap_bundle
+from fhir_walk.model import unwrap_bundle, intern
+from fhir_walk.fhir_host import ReferenceLoader, reference_key, is_resource_key
+from fhir_walk.transport import FhirRequestError
 
 from pprint import pformat
 
+logger = logging.getLogger(__name__)
 
 
 class Patient:
+	# There can be a great many of these, so no per-instance __dict__
+	__slots__ = ('host', 'research_subject_id', '_parents', '_specimens', '_diseases', '_phenotypes',
+				 'id', 'sex', 'race', 'eth', 'study', 'dbgap_study_id', 'dbgap_id', 'subject_id')
+
 	study_regex = compile("https://ncpi-api-dataservice.kidsfirstdrc.org/(participants|research_subjects)\?study_id=(?P<study>[A-Za-z0-9-]+)&external_id=")
 	dbgap_regex = compile("https://dbgap-api.ncbi.nlm.nih.gov/participants\?study_id=(?P<study>[a-zA-Z0-9-]+)&external_id=")
 
-	def __init__(self, host, data):
+	def __init__(self, host, data, patient_data=None):
 		# We can arrive here by one of two ways: 1) ResearchSubject and 2) Patient
 		# so we may need to perform an additional pull for the actual patient
-		# data
+		# data (unless the caller has already pulled it and passes it along as
+		# patient_data)
 
 		# this is the fhir_server object, which will be used to pull related entities
 		self.host = host		
@@ -39,8 +51,11 @@ class Patient:
 		
 		self._parents = None
 		self._specimens = None
+		self._diseases = None
+		self._phenotypes = None
 		if data['resourceType'] == 'ResearchSubject':
-			patient_data = host.get(data['individual']['reference']).entries[0]
+			if patient_data is None:
+				patient_data = host.get(data['individual']['reference']).entries[0]
 
 			first_value = None
 			for identifier in data['identifier']:
@@ -62,7 +77,7 @@ class Patient:
 		self.id = patient_data['id']
 		self.sex = ""
 		if 'gender' in patient_data:
-			self.sex = patient_data['gender']
+			self.sex = intern(patient_data['gender'])
 		self.race = ""
 		self.eth = ""
 		self.study = ""
@@ -79,13 +94,13 @@ class Patient:
 			g = Patient.study_regex.search(identifier['system'])
 
 			if g is not None:
-				self.study = g.group('study')
+				self.study = intern(g.group('study'))
 				self.subject_id = identifier['value']
 
 			else:
 				g = Patient.dbgap_regex.search(identifier['system'])
 				if g is not None:
-					self.dbgap_study_id = g.group('study')
+					self.dbgap_study_id = intern(g.group('study'))
 					self.dbgap_id = identifier['value']
 		if self.subject_id is None:
 			self.subject_id = first_value
@@ -93,22 +108,43 @@ class Patient:
 		if "extension" in patient_data:
 			for ex in patient_data['extension']:
 				if ex['url'] == "http://hl7.org/fhir/us/core/StructureDefinition/us-core-race":
-					self.race = ex['extension'][0]['valueCoding']['display']
+					self.race = intern(ex['extension'][0]['valueCoding']['display'])
 				if ex['url'] == "http://hl7.org/fhir/us/core/StructureDefinition/us-core-ethnicity":
-					self.eth = ex['extension'][0]['valueCoding']['display']
+					self.eth = intern(ex['extension'][0]['valueCoding']['display'])
 
 	def parents(self):
-		"""Return the parents for a given patient"""
+		"""Return the parents for a given patient
+
+		For more than a handful of patients, a Pedigree (see fhir_walk.model.pedigree)
+		fills this in for the entire study with a single search"""
 		if self._parents is None:
 			self._parents = {}
 			qry = f"Observation?code:text=Family&focus=Patient/{self.id}"
-			payload = self.host.get(f"Observation?code:text=Family&focus=Patient/{self.id}")
-
-			for data_chunk in payload.entries:
-				if 'resource' in data_chunk:
-					parent_chunk = data_chunk['resource']
-					parent_data = self.host.get(parent_chunk['subject']['reference'])
-					patient = Patient(self.host, parent_data.entries[0])
+			if self.host.supports_include:
+				qry += "&_include=Observation:subject"
+
+			relationships = []
+			included = {}
+			for page in self.host.iter_pages(qry):
+				relationships += [data_chunk['resource'] for data_chunk in page.matches if 'resource' in data_chunk]
+				included.update(page.included('Patient'))
+
+			# Pull any parents the server didn't include all at once rather than one at a time
+			loader = ReferenceLoader(self.host)
+			for parent_chunk in relationships:
+				ref = parent_chunk['subject']['reference']
+				if reference_key(ref) not in included:
+					loader.load(ref)
+
+			for parent_chunk in relationships:
+				ref = parent_chunk['subject']['reference']
+				parent_data = included.get(reference_key(ref))
+				if parent_data is None:
+					parent_data = loader[ref]
+				if parent_data is None:
+					parent_data = self._read_parent(ref)
+				if parent_data is not None:
+					patient = Patient(self.host, parent_data)
 
 					for codeable in parent_chunk['valueCodeableConcept']['coding']:
 						if codeable['code'] in ['FTH', 'MTH']:
@@ -116,6 +152,19 @@ class Patient:
 
 		return self._parents
 
+	def _read_parent(self, ref):
+		"""Fall back on a direct GET for a parent the batch couldn't resolve, logging it if that fails too"""
+		if is_resource_key(reference_key(ref)):
+			try:
+				payload = self.host.get(ref)
+				if payload is not None and payload.entry_count > 0 and payload.entries[0].get('resourceType') == 'Patient':
+					return payload.entries[0]
+			except FhirRequestError as e:
+				logger.warning(f"Unable to pull parent {ref} of Patient/{self.id}: {e}")
+				return None
+		logger.warning(f"Unable to resolve parent {ref} of Patient/{self.id}, leaving them out of parents()")
+		return None
+
 	def specimens(self):
 		"""Pull specimens for the current patient"""
 		if self._specimens is None:
@@ -125,25 +174,184 @@ class Patient:
 
 	def diseases(self):
 		"""Pull diseases associated with the current patient"""
-		return Disease.DiseasesByPatient(self.id, self.host)
+		if self._diseases is None:
+			self._diseases = Disease.DiseasesByPatient(self.id, self.host)
+		return self._diseases
 
 	def phenotypes(self):
 		"""Returns the list of HPOs present and absent (hpos_present, hpos_absent) tuple"""
-		return Phenotype.PhenotypesByPatient(self.id, self.host)
+		if self._phenotypes is None:
+			self._phenotypes = Phenotype.PhenotypesByPatient(self.id, self.host)
+		return self._phenotypes
+
+	def hydrate(self, variants=True, parents=True):
+		"""Pull everything about the patient: specimens (and their tissue status and variants), 
+		diseases, phenotypes and parents. Anything already loaded isn't pulled again"""
+		self.diseases()
+		self.phenotypes()
+		specimens = list(self.specimens().values())
+		for specimen in specimens:
+			# Loads the status for the specimen's whole batch, if it's not already loaded
+			specimen.tissue_affected_status
+		if variants:
+			for specimen in specimens:
+				specimen.variants()
+		if parents:
+			self.parents()
+		return self
+
+	async def hydrate_async(self, ahost):
+		"""Concurrently pull specimens, diseases and phenotypes using an AsyncFhirHost"""
+		self._specimens, self._diseases, self._phenotypes = await asyncio.gather(
+				Specimen.SpecimenByPatientAsync(self.id, ahost),
+				Disease.DiseasesByPatientAsync(self.id, ahost),
+				Phenotype.PhenotypesByPatientAsync(self.id, ahost))
+		return self
+
+	def _set_children(self, specimens, conditions, observations):
+		"""Populate the specimens, diseases and phenotypes from entries that have already been pulled"""
+		self._specimens = {}
+		for data_chunk in specimens:
+			specimen = Specimen(self.host, data_chunk['resource'])
+			self._specimens[specimen.sample_id] = specimen
+		Specimen.Batch(self._specimens.values())
+
+		self._diseases = Disease._collect(conditions, self.host)
+		self._phenotypes = Phenotype._collect(observations, self.host)
 
 	@classmethod
-	def PatientsByStudy(cls, study_id, host):
-		#print(f"--> ResearchSubject?study=ResearchStudy/{study_id}")
-		payload = host.get(f"ResearchSubject?study=ResearchStudy/{study_id}")
+	def _include_children(cls, patients, host):
+		"""Use _revinclude to pull the Specimens, Conditions and Observations for a batch of patients"""
+		children = dict((f"Patient/{patient.id}", {'Specimen': [], 'Condition': [], 'Observation': []}) for patient in patients)
+		ids = sorted(patient.id for patient in patients)
+
+		for i in range(0, len(ids), host.reference_batch_size):
+			id_list = ",".join(ids[i:i + host.reference_batch_size])
+			qry = f"Patient?_id={id_list}&_revinclude=Specimen:subject&_revinclude=Condition:subject&_revinclude=Observation:subject"
+
+			for data_chunk in host.iter_entries(qry):
+				if data_chunk.get('search', {}).get('mode') == 'include' and 'resource' in data_chunk:
+					resource = data_chunk['resource']
+					if 'subject' in resource:
+						owner = children.get(reference_key(resource['subject']['reference']))
+						if owner is not None and resource['resourceType'] in owner:
+							owner[resource['resourceType']].append(data_chunk)
+
+		for patient in patients:
+			owner = children[f"Patient/{patient.id}"]
+			patient._set_children(owner['Specimen'], owner['Condition'], owner['Observation'])
+
+		# Let the whole batch's tissue status be pulled together, should anyone ask
+		Specimen.Batch([specimen for patient in patients for specimen in patient._specimens.values()])
 
+	@classmethod
+	def IterPatientsByStudy(cls, study_id, host, children=False):
+		"""Yield the patients one at a time as each page of research subjects arrives
+
+		If children is True (and the host supports _revinclude) the specimens, diseases
+		and phenotypes are pulled alongside each page of patients."""
+		qry = f"ResearchSubject?study=ResearchStudy/{study_id}"
+		if host.supports_include:
+			qry += "&_include=ResearchSubject:individual"
+
+		for page in host.iter_pages(qry):
+			subjects = [data_chunk['resource'] for data_chunk in page.matches if 'resource' in data_chunk]
+			included = page.included('Patient')
+
+			# To get the patient, we have to use the research subject's individual. Anything 
+			# the server didn't include for us is pulled for the entire page in bulk
+			missing = [subject['individual']['reference'] for subject in subjects if reference_key(subject['individual']['reference']) not in included]
+			resolved = {}
+			if len(missing) > 0:
+				resolved = host.resolve_references(missing)
+
+			patients = []
+			for subject in subjects:
+				ref = subject['individual']['reference']
+				patient_data = included.get(reference_key(ref), resolved.get(ref))
+				patients.append(Patient(host, subject, patient_data=patient_data))
+
+			if children and host.supports_include and len(patients) > 0:
+				Patient._include_children(patients, host)
+
+			for patient in patients:
+				yield patient
+
+	@classmethod
+	def PatientsByStudy(cls, study_id, host, children=False):
 		patients = {}
 
-		for data_chunk in payload.entries:
-			# To get the patient, we have to use the research subject's individual
-			patient = Patient(host, data_chunk['resource'])
+		for patient in Patient.IterPatientsByStudy(study_id, host, children=children):
+			patients[patient.subject_id] = patient
+		return patients
+
+	@classmethod
+	async def PatientsByStudyAsync(cls, study_id, ahost):
+		"""Asynchronous version of PatientsByStudy where the patient pulls are made concurrently"""
+		subjects = []
+		async for data_chunk in ahost.iter_entries(f"ResearchSubject?study=ResearchStudy/{study_id}"):
+			subjects.append(data_chunk['resource'])
+
+		payloads = await ahost.gather([subject['individual']['reference'] for subject in subjects])
+
+		patients = {}
+		for subject, payload in zip(subjects, payloads):
+			patient = Patient(ahost.host, subject, patient_data=payload.entries[0])
 			patients[patient.subject_id] = patient
 		return patients
 
+	@classmethod
+	async def HydrateAsync(cls, patients, ahost):
+		"""Hydrate every patient in the iterable concurrently (bounded by the host's connection limit)"""
+		return await asyncio.gather(*[patient.hydrate_async(ahost) for patient in patients])
+
+	@classmethod
+	def Hydrate(cls, patients, workers=8, variants=True, parents=True, progress=None):
+		"""Hydrate each of the patients (any iterable, such as IterPatientsByStudy) on a pool of threads
+
+		A failure only costs the patient it happened to, the rest carry on. Returns
+		the patients (by subject_id) and a dict of subject_id => exception for any
+		that failed. Those keep whatever did load, so hydrating them again later only
+		pulls what is missing. progress(count, patient) is called as each finishes.
+
+		The requests are still bounded by the host's max_concurrency, when it has one.
+		The tissue status of any specimens already pulled (such as those IterPatientsByStudy 
+		brings in with children) is loaded for all of the patients up front, one search
+		per reference_batch_size specimens, rather than patient by patient"""
+		hydrated = {}
+		failures = {}
+		lock = threading.Lock()
+
+		patients = list(patients)
+		specimens = [specimen for patient in patients if patient._specimens is not None for specimen in patient._specimens.values()]
+		if len(specimens) > 0:
+			try:
+				Specimen.LoadTissueAffectedStatus(specimens, patients[0].host)
+			except Exception:
+				# Each patient will try again for its own specimens
+				logger.exception("Unable to load the tissue affected status up front")
+
+		def hydrate(patient):
+			error = None
+			try:
+				patient.hydrate(variants=variants, parents=parents)
+			except Exception as e:
+				logger.exception(f"Unable to hydrate Patient/{patient.id}")
+				error = e
+
+			with lock:
+				hydrated[patient.subject_id] = patient
+				if error is not None:
+					failures[patient.subject_id] = error
+				count = len(hydrated)
+			if progress:
+				progress(count, patient)
+
+		with ThreadPoolExecutor(max_workers=workers) as pool:
+			for future in [pool.submit(hydrate, patient) for patient in patients]:
+				future.result()
+		return hydrated, failures
+
 	@classmethod
 	def PatientByRef(cls, ref, host):
 		return Patient.PatientByID(ref.split("/")[-1], host)
@@ -0,0 +1,158 @@
+"""Study wide pedigree, built from a single pull of the family Observations
+
+Patient.parents() costs a search per patient (and pulls for each parent, who
+end up as new Patient objects even when they are part of the study already).
+A Pedigree instead pulls the study's family relationship Observations with a
+focus search per reference_batch_size patients, links them up with the
+patients that have already been loaded and answers parents(), children(),
+siblings() and trios() from that graph:
+
+	pedigree = study.pedigree(patients)
+	for proband, father, mother in pedigree.trios():
+		...
+
+Each relationship is an Observation whose subject is the parent, whose focus
+is the proband and whose value carries the role code (FTH or MTH). Once built,
+each of the study's patients has its parents filled in, so patient.parents()
+no longer goes back to the server. Since the search is by proband, children()
+only knows about children who are among the patients.
+"""
+
+from fhir_walk.model.patient import Patient
+from fhir_walk.fhir_host import ReferenceLoader, reference_key
+
+parent_codes = ['FTH', 'MTH']
+
+class Pedigree:
+	def __init__(self, host, patients=None):
+		self.host = host
+
+		# Patient id => Patient, for the study's patients and any parents pulled in for them
+		self.patients = {}
+		self._parents = {}			# child id => {'FTH': parent id, 'MTH': parent id}
+		self._children = {}			# parent id => [child ids]
+
+		# The patients whose relationships we've pulled (as opposed to parents
+		# from outside the study, whose own parents we know nothing about)
+		self._members = set()
+		if patients is not None:
+			self.add_patients(patients)
+
+	def __len__(self):
+		return len(self.patients)
+
+	def add_patients(self, patients):
+		"""Add patients (a list or the dict PatientsByStudy returns) to the pedigree"""
+		if isinstance(patients, dict):
+			patients = patients.values()
+		for patient in patients:
+			self.patients[patient.id] = patient
+			self._members.add(patient.id)
+
+	def add_relationship(self, resource):
+		"""Add a family relationship Observation to the graph. Returns the child's id (or None if it isn't one)"""
+		if 'subject' not in resource or len(resource.get('focus', [])) == 0:
+			return None
+
+		parent_id = reference_key(resource['subject']['reference']).split("/")[-1]
+		child_id = reference_key(resource['focus'][0]['reference']).split("/")[-1]
+		for codeable in resource.get('valueCodeableConcept', {}).get('coding', []):
+			if codeable.get('code') in parent_codes:
+				self._parents.setdefault(child_id, {})[codeable['code']] = parent_id
+				children = self._children.setdefault(parent_id, [])
+				if child_id not in children:
+					children.append(child_id)
+				return child_id
+		return None
+
+	def load(self, qry="Observation?code:text=Family"):
+		"""Pull the family relationships of the patients, with one search per batch of them
+
+		Any parents who aren't among the patients already are pulled in batches and
+		built once each. With no patients at all, every relationship on the server is
+		pulled, along with all of the patients they mention. Returns the pedigree"""
+		members = set(self._members)
+
+		queries = [qry]
+		if len(members) > 0:
+			refs = sorted(f"Patient/{id}" for id in members)
+			batch_size = self.host.reference_batch_size
+			queries = [f"{qry}&focus={','.join(refs[i:i + batch_size])}" for i in range(0, len(refs), batch_size)]
+
+		for query in queries:
+			for data_chunk in self.host.iter_entries(query):
+				if 'resource' in data_chunk:
+					self.add_relationship(data_chunk['resource'])
+
+		loader = ReferenceLoader(self.host)
+		missing = set()
+		for child_id, parents in self._parents.items():
+			# Without any patients to start from, everyone in the graph is pulled
+			if len(members) == 0 and child_id not in self.patients:
+				missing.add(child_id)
+			for parent_id in parents.values():
+				if parent_id not in self.patients:
+					missing.add(parent_id)
+		loader.load_many(f"Patient/{id}" for id in missing)
+		for id in sorted(missing):
+			data = loader[f"Patient/{id}"]
+			if data is not None:
+				self.patients[id] = Patient(self.host, data)
+
+		if len(members) == 0:
+			self._members = set(self.patients)
+
+		# From here on, parents() is answered from the graph for everyone we pulled relationships for
+		for id in self._members:
+			patient = self.patients.get(id)
+			if patient is not None:
+				patient._parents = self.parents(id)
+		return self
+
+	def _id(self, patient):
+		if isinstance(patient, Patient):
+			return patient.id
+		return patient
+
+	def patient(self, id):
+		return self.patients.get(id)
+
+	def parents(self, patient):
+		"""Return a dict of role (FTH/MTH) => Patient, just as Patient.parents() does"""
+		parents = {}
+		for code, parent_id in self._parents.get(self._id(patient), {}).items():
+			if parent_id in self.patients:
+				parents[code] = self.patients[parent_id]
+		return parents
+
+	def children(self, patient):
+		"""Return the list of the patient's children"""
+		return [self.patients[id] for id in self._children.get(self._id(patient), []) if id in self.patients]
+
+	def siblings(self, patient, full=False):
+		"""Return the list of patients sharing a parent with patient (both parents, if full)"""
+		id = self._id(patient)
+		parents = self._parents.get(id, {})
+
+		sibling_ids = []
+		for parent_id in parents.values():
+			for child_id in self._children.get(parent_id, []):
+				if child_id != id and child_id not in sibling_ids:
+					sibling_ids.append(child_id)
+
+		if full:
+			sibling_ids = [sibling_id for sibling_id in sibling_ids if self._parents.get(sibling_id) == parents]
+		return [self.patients[sibling_id] for sibling_id in sibling_ids if sibling_id in self.patients]
+
+	def trios(self):
+		"""Yield (proband, father, mother) for each patient with both parents in the pedigree"""
+		for child_id, parents in self._parents.items():
+			if child_id in self.patients and parents.get('FTH') in self.patients and parents.get('MTH') in self.patients:
+				yield self.patients[child_id], self.patients[parents['FTH']], self.patients[parents['MTH']]
+
+	@classmethod
+	def ForStudy(cls, study, patients=None):
+		"""Build the pedigree for a study, reusing patients if they've already been pulled"""
+		if patients is None:
+			patients = study.Patients()
+		return Pedigree(study.host, patients).load()
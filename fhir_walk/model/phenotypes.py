@@ -6,29 +6,39 @@ HP Code.
 """
 
 from pprint import pformat
+from fhir_walk.model import intern
 
 class Phenotype:
+	__slots__ = ('host', 'id', 'code', 'name', 'status')
+
 	def __init__(self, host, data):
 		# this is the fhir_server object, which will be used to pull related entities
 		self.host = host		
 
 		self.id = data['id']
-		self.code = data['code']['coding'][0]['code']
+		self.code = intern(data['code']['coding'][0]['code'])
 		if 'display' in data['code']['coding'][0]:
-			self.name = data['code']['coding'][0]['display']
+			self.name = intern(data['code']['coding'][0]['display'])
 		else:
 			self.name = ""
-		self.status = data['interpretation'][0]['coding'][0]['display']
+		self.status = intern(data['interpretation'][0]['coding'][0]['display'])
 
 	@classmethod
 	def PhenotypesByPatient(cls, patient_id, host):
-		payload = host.get(f"Observation?subject=Patient/{patient_id}")
+		return Phenotype._collect(host.iter_entries(f"Observation?subject=Patient/{patient_id}"), host)
+
+	@classmethod
+	async def PhenotypesByPatientAsync(cls, patient_id, ahost):
+		payload = await ahost.get(f"Observation?subject=Patient/{patient_id}")
+		return Phenotype._collect(payload.entries, ahost.host)
 
+	@classmethod
+	def _collect(cls, entries, host):
 		phenotypes_present = {}
 		phenotypes_absent = {}
 
 
-		for data_chunk in payload.entries:
+		for data_chunk in entries:
 			# There will be a lot of observations, and currently, I'm not seeing a way
 			# to filter on the types we want for Phenotypes. So, we'll do that here
 
@@ -1,14 +1,22 @@
 """Parse research study objects"""
 
 from fhir_walk.model.patient import Patient
+from fhir_walk.model.pedigree import Pedigree
 from fhirwood.identifier import Identifier
 from pprint import pformat
 
 class ResearchStudy:
-	def __init__(self, host, data):
+	__slots__ = ('host', '_raw', 'id', 'identifier', 'title')
+
+	def __init__(self, host, data, keep_raw=False):
 		# this is the fhir_server object, which will be used to pull related entities
 		self.host = host		
-		self.raw = data
+
+		# The entry we were built from is only held on to if the caller asks. Otherwise,
+		# raw will pull it again (from the host's cache, more often than not)
+		self._raw = None
+		if keep_raw:
+			self._raw = data
 		self.id = data['resource']['id']
 		self.identifier = Identifier(block=data['resource']['identifier'])
 
@@ -16,17 +24,86 @@ class ResearchStudy:
 		if 'title' in data['resource']:
 			self.title = data['resource']['title']
 
+	@property
+	def raw(self):
+		if self._raw is not None:
+			return self._raw
+		return {'resource': self.host.get(f"ResearchStudy/{self.id}").entries[0]}
+
 	@classmethod
-	def Studies(cls, host):
+	def Studies(cls, host, keep_raw=False):
 		"""Return all research studies found at a given host"""
-		data = host.get("ResearchStudy")
+		studies = {}
+		for data_chunk in host.iter_entries("ResearchStudy"):
+			study = ResearchStudy(host, data_chunk, keep_raw=keep_raw)
+			studies[study.title] = study
+		return studies
 
+	@classmethod
+	async def StudiesAsync(cls, ahost, keep_raw=False):
+		"""Asynchronous version of Studies"""
 		studies = {}
-		for data_chunk in data.entries:
-			study = ResearchStudy(host, data_chunk)
+		async for data_chunk in ahost.iter_entries("ResearchStudy"):
+			study = ResearchStudy(ahost.host, data_chunk, keep_raw=keep_raw)
 			studies[study.title] = study
 		return studies
 
-	def Patients(self):
-		"""Pull all of the patients associated with a given study"""
-		return Patient.PatientsByStudy(self.id, self.host)
\ No newline at end of file
+	def Patients(self, children=False):
+		"""Pull all of the patients associated with a given study
+
+		children will also pull each patient's specimens, diseases and phenotypes
+		using _revinclude (when supported by the host)"""
+		return Patient.PatientsByStudy(self.id, self.host, children=children)
+
+	async def PatientsAsync(self, ahost):
+		"""Pull the study's patients using an AsyncFhirHost"""
+		return await Patient.PatientsByStudyAsync(self.id, ahost)
+
+	def IterPatients(self, children=False):
+		"""Yield the study's patients as they arrive rather than waiting on the entire study"""
+		return Patient.IterPatientsByStudy(self.id, self.host, children=children)
+
+	def hydrate(self, workers=None, variants=True, parents=True, progress=None):
+		"""Pull the study's patients and everything about them, hydrating workers patients at a time
+
+		workers defaults to the host's max_concurrency (or 8). Returns the patients (by 
+		subject_id) and a dict of subject_id => exception for those that failed
+		(see Patient.Hydrate). The parents come from a pedigree pull (a search per
+		batch of patients) rather than a search per patient"""
+		if workers is None:
+			workers = self.host.max_concurrency or 8
+
+		patients = list(self.IterPatients(children=self.host.supports_include))
+		if parents:
+			self.pedigree(patients)
+		return Patient.Hydrate(patients, 
+							   workers=workers, 
+							   variants=variants, 
+							   parents=parents, 
+							   progress=progress)
+
+	def pedigree(self, patients=None):
+		"""Build the study's Pedigree from one pull of the family relationships (see fhir_walk.model.pedigree)
+
+		patients, if given, are reused (and have their parents filled in) rather than pulled again"""
+		return Pedigree.ForStudy(self, patients=patients)
+
+	def export_snapshot(self, path, format='parquet', variants=True, sequencing=True, progress=None):
+		"""Write the entire study out as a set of columnar files (see fhir_walk.snapshot)"""
+		from fhir_walk.snapshot import export_snapshot
+		return export_snapshot(self, path, format=format, variants=variants, sequencing=sequencing, progress=progress)
+
+	def variant_table(self, progress=None):
+		"""Collect every variant in the study into a columnar VariantTable (see fhir_walk.variant_table)"""
+		from fhir_walk.variant_table import VariantTable
+		return VariantTable.from_study(self, progress=progress)
+
+	def phenotype_matrix(self, progress=None):
+		"""Collect every patient's phenotypes into a PhenotypeMatrix (see fhir_walk.phenotype_matrix)"""
+		from fhir_walk.phenotype_matrix import PhenotypeMatrix
+		return PhenotypeMatrix.from_study(self, progress=progress)
+
+	def cohort_index(self, progress=None):
+		"""Index the study's patients for local cohort queries (see fhir_walk.cohort)"""
+		from fhir_walk.cohort import CohortIndex
+		return CohortIndex.from_study(self, progress=progress)
@@ -2,9 +2,12 @@
 
 from pprint import pformat
 from fhir_walk.model.specimen import Specimen
+from fhir_walk.model import intern
 import pdb 
 
 class SequencingFile:
+	__slots__ = ('host', 'id', '_author', '_subject', 'filename', '_infos')
+
 	def __init__(self, host, data=None, ref=None):
 		self.host = host
 
@@ -28,9 +31,7 @@ class SequencingFile:
 		if self._infos is None:
 			self._infos = []
 
-			payload = self.host.get(f"Observation?focus=DocumentReference/{self.id}")
-
-			for data_chunk in payload.entries:
+			for data_chunk in self.host.iter_entries(f"Observation?focus=DocumentReference/{self.id}"):
 				if 'resource' in data_chunk:
 					info = SequencingFileInfo(self.host, data_chunk['resource'])
 					self._infos.append(info)
@@ -38,6 +39,8 @@ class SequencingFile:
 		return self._infos
 
 class SequencingFileInfo:
+	__slots__ = ('host', 'id', '_subject', '_doc', '_data')
+
 	def __init__(self, host, data):
 		self.host = host
 		self.id = data['id']
@@ -50,7 +53,7 @@ class SequencingFileInfo:
 		for component in data['component']:
 			# Currently, this is all we have
 			if 'valueString' in component:
-				self._data[component['code']['text']] = component['valueString']	
+				self._data[intern(component['code']['text'])] = intern(component['valueString'])
 
 	@property
 	def reference_genome(self):
@@ -70,7 +73,12 @@ class SequencingFileInfo:
 
 
 class SequencingData:
-	def __init__(self, host, data):
+	__slots__ = ('host', 'id', '_owner', '_specimen_id', '_docs', '_data', '_sample', '_specimen',
+				 'analyte_type', 'lib_prep_kit', 'exome_capture_platform', 'capture_region_bed_file')
+
+	def __init__(self, host, data, docs=None):
+		# docs is an optional dict of reference => DocumentReference resource, 
+		# for callers that have already pulled the files down
 		# this is the fhir_server object, which will be used to pull related entities
 		self.host = host		
 
@@ -81,25 +89,37 @@ class SequencingData:
 		self._docs = []
 		self._data = {}
 
-		for outp in data['output']:
-			if 'text' in outp['type'] and 'valueReference' in outp:
-				if outp['type']['text'] == 'Sequence Data Filename':
-					self._docs.append(SequencingFile(self.host, ref=outp['valueReference']['reference']))
+		for ref in SequencingData._file_refs(data):
+			if docs is not None and ref in docs:
+				self._docs.append(SequencingFile(self.host, data=docs[ref]))
+			else:
+				self._docs.append(SequencingFile(self.host, ref=ref))
 
 		for inp in data['input']:
 			if 'text' in inp['type']:
 				if 'valueString' in inp:
-					self._data[inp['type']['text']] = inp['valueString']
+					self._data[intern(inp['type']['text'])] = intern(inp['valueString'])
 
 		# Let's treat sample differently. No need to make a call to fhir if 
 		# no one needs the object, but we can make it easy to get to if
 		# they need it
 		self._sample = None
+		self._specimen = None
 		self.analyte_type = self._data.get('Analyte Type')
 		self.lib_prep_kit = self._data.get('Library Prep Kit')
 		self.exome_capture_platform = self._data.get('Exome Capture Platform')
 		self.capture_region_bed_file = self._data.get('Capture Region Bed File')
 
+	@classmethod
+	def _file_refs(cls, data):
+		"""References to the sequence data files listed as the task's output"""
+		refs = []
+		for outp in data['output']:
+			if 'text' in outp['type'] and 'valueReference' in outp:
+				if outp['type']['text'] == 'Sequence Data Filename':
+					refs.append(outp['valueReference']['reference'])
+		return refs
+
 	@property
 	def sequencing_files(self):
 		return self._docs
@@ -107,7 +127,7 @@ class SequencingData:
 	@property
 	def specimen(self):
 		if self._specimen is None:
-			self._specimen = Specimen(self.host, self._specimen_id)
+			self._specimen = Specimen(self.host, ref=self._specimen_id)
 		return self._specimen
 
 	@property
@@ -120,18 +140,35 @@ class SequencingData:
 			sample_id = self.sample_id
 
 			if sample_id:
-				payload = host.get(sample_id)
-				self._sample = Specimen(host, payload['resource'])
+				payload = self.host.get(sample_id)
+				self._sample = Specimen(self.host, payload.entries[0])
 
 		return self._sample
 
 	@classmethod
 	def SequencingDataBySpecimen(cls, specimen_id, host):
-		payload = host.get(f"Task?focus=Specimen/{specimen_id}")
 		sequence_data = []
 
-		for data_chunk in payload.entries:
-			if 'resource' in data_chunk:
-				seq = SequencingData(host, data_chunk['resource'])
+		for page in host.iter_pages(f"Task?focus=Specimen/{specimen_id}"):
+			tasks = [data_chunk['resource'] for data_chunk in page.entries if 'resource' in data_chunk]
+
+			# Pull each of the page's files in bulk rather than one at a time
+			docs = host.resolve_references([ref for task in tasks for ref in SequencingData._file_refs(task)])
+			for task in tasks:
+				seq = SequencingData(host, task, docs=docs)
 				sequence_data.append(seq)
 		return sequence_data
+
+	@classmethod
+	async def SequencingDataBySpecimenAsync(cls, specimen_id, ahost):
+		"""Asynchronous version of SequencingDataBySpecimen. The file pulls are made concurrently"""
+		tasks = []
+		async for data_chunk in ahost.iter_entries(f"Task?focus=Specimen/{specimen_id}"):
+			if 'resource' in data_chunk:
+				tasks.append(data_chunk['resource'])
+
+		refs = sorted(set(ref for task in tasks for ref in SequencingData._file_refs(task)))
+		payloads = await ahost.gather(refs)
+		docs = dict((ref, payload.entries[0]) for ref, payload in zip(refs, payloads))
+
+		return [SequencingData(ahost.host, task, docs=docs) for task in tasks]
@@ -3,16 +3,21 @@ from re import compile
 
 from pprint import pformat
 from fhir_walk.model.variants import Variant
+from fhir_walk.fhir_host import reference_key
+from fhir_walk.model import intern
 
 class Specimen:
+	__slots__ = ('host', 'id', 'dbgap_id', 'study', 'sample_id', 'subject_id', 'body_site',
+				 '_tissue_affected_status', '_batch', '_variants')
+
 	sample_id_regex = compile("http://ncpi-api-dataservice.kidsfirstdrc.org/biospecimens\?study_id=(?P<study>[A-Za-z0-9-]+)&external_aliquot_id=")
-	def __init__(self, host, data=None, ref=None):
+	def __init__(self, host, data=None, ref=None, tissue_affected_status=None):
 		# this is the fhir_server object, which will be used to pull related entities
 		self.host = host		
 
 		if data is None:
 			payload = host.get(ref)
-			data = payload['resource']
+			data = payload.entries[0]
 			
 		self.id = data['id']
 		self.dbgap_id = ""
@@ -23,13 +28,12 @@ class Specimen:
 			g = Specimen.sample_id_regex.search(identifier['system'])
 
 			if g:
-				self.study = g.group('study')
+				self.study = intern(g.group('study'))
 				self.sample_id = identifier['value']
 			elif identifier['system'] == "https://dbgap-api.ncbi.nlm.nih.gov/specimen":
 				self.dbgap_id = identifier['value']
 
 		self.subject_id = None
-		self.tissue_affected_status = ""
 
 		if "subject" in data:
 			self.subject_id = data['subject']['reference']
@@ -40,28 +44,114 @@ class Specimen:
 				site_coding = data['collection']['bodySite']['coding'][0]
 
 				if 'display' not in site_coding:
-					self.body_site = (site_coding['code'], '')
+					self.body_site = (intern(site_coding['code']), '')
 				else:
-					self.body_site = (site_coding['code'], site_coding['display'])
+					self.body_site = (intern(site_coding['code']), intern(site_coding['display']))
+
+		# The tissue_affected_status requires another pull, so we'll wait until someone 
+		# actually asks for it (unless the caller has already done that for us). Specimens
+		# loaded together share a batch so that the first one asked loads them all at once
+		self._tissue_affected_status = tissue_affected_status
+		self._batch = None
+		self._variants = None
+
+	@property
+	def tissue_affected_status(self):
+		if self._tissue_affected_status is None:
+			batch = self._batch
+			if batch is None:
+				batch = [self]
+			Specimen.LoadTissueAffectedStatus(batch, self.host)
+		return self._tissue_affected_status
+
+	@tissue_affected_status.setter
+	def tissue_affected_status(self, status):
+		self._tissue_affected_status = status
+
+	@classmethod
+	def Batch(cls, specimens):
+		"""Group specimens so that their tissue affected status is loaded together on first access"""
+		batch = [specimen for specimen in specimens if specimen._tissue_affected_status is None]
+		for specimen in batch:
+			specimen._batch = batch
+		return specimens
+
+	@classmethod
+	def LoadTissueAffectedStatus(cls, specimens, host):
+		"""Fill in the tissue affected status for any number of specimens using batched searches
+
+		This can be used for all of a patient's (or a study's) specimens and costs one search
+		per reference_batch_size specimens, rather than one per specimen"""
+		pending = dict((f"Specimen/{specimen.id}", specimen) for specimen in specimens if specimen._tissue_affected_status is None)
+		refs = sorted(pending)
+
+		for i in range(0, len(refs), host.reference_batch_size):
+			batch = refs[i:i + host.reference_batch_size]
+			observations = dict((ref, []) for ref in batch)
+
+			for data_chunk in host.iter_entries(f"Observation?specimen={','.join(batch)}"):
+				if 'resource' in data_chunk and 'specimen' in data_chunk['resource']:
+					key = reference_key(data_chunk['resource']['specimen']['reference'])
+					if key in observations:
+						observations[key].append(data_chunk)
+
+			for ref in batch:
+				pending[ref]._tissue_affected_status = Specimen._tissue_status(observations[ref])
+				pending[ref]._batch = None
 
-		# Now for the fun part, let's try and get the tissue_affected_status
-		payload = self.host.get(f"Observation?specimen=Specimen/{self.id}")
-		for data_chunk in payload.entries:
+	@classmethod
+	def _tissue_status(cls, entries):
+		"""Pick the tissue affected status out of the specimen's observations"""
+		status = ""
+		for data_chunk in entries:
 			if 'resource' in data_chunk:
 				coding = data_chunk['resource']['code']['coding'][0]
-				self.tissue_affected_status = coding['system']
+				status = intern(coding['system'])
+		return status
 
 	def variants(self):
-		return Variant.VariantsBySpecimen(self.id, self.host)
+		if self._variants is None:
+			self._variants = Variant.VariantsBySpecimen(self.id, self.host)
+		return self._variants
+
+	async def variants_async(self, ahost):
+		if self._variants is None:
+			self._variants = await Variant.VariantsBySpecimenAsync(self.id, ahost)
+		return self._variants
 
 	@classmethod
-	def SpecimenByPatient(cls, patient_id, host):
-		payload = host.get(f"Specimen?subject=Patient/{patient_id}")
+	def IterSpecimenByPatient(cls, patient_id, host):
+		"""Yield the specimens one at a time as each page arrives
 
+		The tissue affected status isn't pulled alongside (an _revinclude of the
+		specimen's Observations would bring every one of its variants, too). Instead,
+		it is loaded for the entire page at once, should anyone ask for it"""
+		qry = f"Specimen?subject=Patient/{patient_id}"
+		for page in host.iter_pages(qry):
+			specimens = [Specimen(host, data_chunk['resource']) for data_chunk in page.entries if 'resource' in data_chunk]
+			for specimen in Specimen.Batch(specimens):
+				yield specimen
+
+	@classmethod
+	def SpecimenByPatient(cls, patient_id, host):
 		specimens = {}
 
-		for data_chunk in payload.entries:
+		for specimen in Specimen.IterSpecimenByPatient(patient_id, host):
+			specimens[specimen.sample_id] = specimen
+		return specimens
+
+	@classmethod
+	async def SpecimenByPatientAsync(cls, patient_id, ahost):
+		"""Asynchronous version of SpecimenByPatient. Tissue status pulls are made concurrently"""
+		resources = []
+		async for data_chunk in ahost.iter_entries(f"Specimen?subject=Patient/{patient_id}"):
 			if 'resource' in data_chunk:
-				specimen = Specimen(host, data_chunk['resource'])
-				specimens[specimen.sample_id] = specimen
+				resources.append(data_chunk['resource'])
+
+		payloads = await ahost.gather([f"Observation?specimen=Specimen/{resource['id']}" for resource in resources])
+
+		specimens = {}
+		for resource, payload in zip(resources, payloads):
+			specimen = Specimen(ahost.host, resource, tissue_affected_status=Specimen._tissue_status(payload.entries))
+			specimens[specimen.sample_id] = specimen
 		return specimens
\ No newline at end of file
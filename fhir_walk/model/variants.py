@@ -4,9 +4,14 @@ When pulling Phenotypes for an individual patient, we'll return two dictionaries
 present and absent (in that order). The key in each of those dicts is the 
 HP Code. 
 """
+import asyncio
 import sys
+import threading
+from weakref import WeakKeyDictionary
 
 from pprint import pformat
+from fhir_walk.fhir_host import reference_key
+from fhir_walk.model import intern
 from fhirwood.identifier import Identifier
 from fhirwood.reference import Reference
 from fhirwood.codeable_concept import CodeableConcept
@@ -28,8 +33,288 @@ class CODES:
 	inheritance = "mode-of-inheritance"
 	significance = "53037-8"
 
+# Component values are held as plain tuples of (interned) strings rather than 
+# fhirwood objects. The objects are only built when someone asks for them
+_CONCEPT = 0
+_RANGE = 1
+
+# Identical values (the same chromosome, zygosity, gene...) share a single tuple. 
+# Once full, new values are simply no longer shared
+_shared = {}
+_max_shared = 100000
+
+def _share(value):
+	shared = _shared.get(value)
+	if shared is not None:
+		return shared
+	if len(_shared) < _max_shared:
+		_shared[value] = value
+	return value
+
+def compact_concept(block):
+	"""Reduce a CodeableConcept block down to (_CONCEPT, text, ((system, code, display), ...))"""
+	codings = tuple(_share((intern(coding.get('system')), intern(coding.get('code')), intern(coding.get('display'))))
+						for coding in block.get('coding', []))
+	return _share((_CONCEPT, intern(block.get('text')), codings))
+
+def compact_range(block):
+	return (_RANGE, block.get('low', {}).get('value'), block.get('high', {}).get('value'))
+
+def expand(value):
+	"""Turn a compact component value back into its fhirwood object (strings are left as they are)"""
+	if not isinstance(value, tuple):
+		return value
+
+	if value[0] == _RANGE:
+		block = {}
+		if value[1] is not None:
+			block['low'] = {'value': value[1]}
+		if value[2] is not None:
+			block['high'] = {'value': value[2]}
+		return Range(block=block)
+
+	block = {}
+	if value[1] is not None:
+		block['text'] = value[1]
+	if len(value[2]) > 0:
+		block['coding'] = [dict((key, item) for key, item in zip(('system', 'code', 'display'), coding) if item is not None) 
+							for coding in value[2]]
+	return CodeableConcept(block=block)
+
+def value_text(value):
+	"""The text (or, failing that, the first code) for a compact value, without building any objects"""
+	if not isinstance(value, tuple):
+		return value
+	if value[0] == _RANGE:
+		return f"{value[1]}-{value[2]}"
+	if value[1]:
+		return value[1]
+	if len(value[2]) > 0:
+		return value[2][0][1]
+	return None
+
+def value_code(value):
+	"""The first code for a compact CodeableConcept, falling back on its text"""
+	if isinstance(value, tuple) and value[0] == _CONCEPT and len(value[2]) > 0 and value[2][0][1]:
+		return value[2][0][1]
+	return value_text(value)
+
+def _resolve(future):
+	if not future.done():
+		future.set_result(None)
+
+class ImplicationIndex:
+	"""Diagnostic implications indexed by the variant (derivedFrom) they describe
+
+	We can't query for a variant's implications directly, so rather than having 
+	each Variant pull (and scan) every implication on the server, there is one index
+	per host which is shared by all of the variants loaded from it. Implications are
+	pulled either for a batch of variants (derived-from) or, for variants we haven't
+	asked about, by pulling the entire set once. 
+
+	The index knows nothing about changes on the server, so call invalidate() 
+	once the implications may have changed. 
+	"""
+	_indexes = WeakKeyDictionary()
+	_indexes_lock = threading.Lock()
+
+	def __init__(self, host):
+		self.host = host
+		self._lock = threading.RLock()
+
+		# Coroutines waiting on a fetch, Event => [(loop, Future)]. These are woken by
+		# the loop rather than holding on to a thread for the wait
+		self._async_waiters = {}
+		self.invalidate()
+
+	@classmethod
+	def for_host(cls, host):
+		"""Return the index shared by all variants loaded from host"""
+		with cls._indexes_lock:
+			if host not in cls._indexes:
+				cls._indexes[host] = ImplicationIndex(host)
+			return cls._indexes[host]
+
+	def invalidate(self):
+		"""Forget everything, forcing the implications to be pulled again as needed"""
+		with self._lock:
+			self._implications = {}		# Observation/id => {code: compact CodeableConcept}
+			self._loaded = set()		# variants we've already asked the server about
+			self._complete = False
+
+			# Fetches happen outside of the lock. These mark what is in flight (variant 
+			# ref => Event, and the Event for a load_all) so that others wait on it 
+			# rather than asking again. A fetch started before an invalidate is dropped
+			self._pending = {}
+			self._loading = None
+			self._generation = getattr(self, '_generation', 0) + 1
+
+	def _parse(self, entries):
+		"""Pull the implications out of entries, returning {ref: {code: compact CodeableConcept}}"""
+		parsed = {}
+		for data_chunk in entries:
+			if 'resource' in data_chunk:
+				data_chunk = data_chunk['resource']
+				ref = reference_key(Reference(block=data_chunk['derivedFrom']).ref)
+				implications = parsed.setdefault(ref, {})
+
+				for component_block in data_chunk['component']:
+					code = intern(component_block['code']['coding'][0]['code'])
+					implications[code] = compact_concept(component_block['valueCodeableConcept'])
+		return parsed
+
+	def _merge(self, parsed):
+		for ref, implications in parsed.items():
+			self._implications.setdefault(ref, {}).update(implications)
+
+	def add(self, entries):
+		"""Index the implication Observations found in entries"""
+		parsed = self._parse(entries)
+		with self._lock:
+			self._merge(parsed)
+
+	@property
+	def complete(self):
+		return self._complete
+
+	def load_all(self, entries=None):
+		"""Pull every implication on the server (unless the caller already has them in entries)"""
+		while True:
+			with self._lock:
+				if self._complete:
+					return
+				loading = self._loading
+				if loading is None:
+					self._loading = loading = threading.Event()
+					generation = self._generation
+					break
+			# Someone else is already pulling everything. If they fail, we try ourselves
+			loading.wait()
+
+		try:
+			if entries is None:
+				entries = self.host.iter_entries("Observation?code=diagnostic-implication")
+			parsed = self._parse(entries)
+			with self._lock:
+				if generation == self._generation:
+					self._merge(parsed)
+					self._complete = True
+		finally:
+			with self._lock:
+				if self._loading is loading:
+					self._loading = None
+			loading.set()
+
+	def _claim(self, variant_ids):
+		"""Mark the refs nobody has pulled yet as ours to fetch
+
+		Returns those refs, the Event that marks them, the Events of anything someone
+		else is already fetching and the current generation (None once complete)"""
+		with self._lock:
+			if self._complete:
+				return [], None, set(), None
+
+			refs = sorted(set(f"Observation/{id}" for id in variant_ids) - self._loaded)
+			waiting = set(self._pending[ref] for ref in refs if ref in self._pending)
+			refs = [ref for ref in refs if ref not in self._pending]
+
+			fetching = threading.Event()
+			for ref in refs:
+				self._pending[ref] = fetching
+			return refs, fetching, waiting, self._generation
+
+	def _store(self, batch, parsed, generation):
+		with self._lock:
+			if generation == self._generation:
+				self._merge(parsed)
+				self._loaded.update(batch)
+
+	def _release(self, refs, fetching):
+		with self._lock:
+			for ref in refs:
+				if self._pending.get(ref) is fetching:
+					del self._pending[ref]
+			fetching.set()
+			waiters = self._async_waiters.pop(fetching, [])
+
+		for loop, future in waiters:
+			loop.call_soon_threadsafe(_resolve, future)
+
+	async def _wait_async(self, event):
+		loop = asyncio.get_running_loop()
+		with self._lock:
+			if event.is_set():
+				return
+			future = loop.create_future()
+			self._async_waiters.setdefault(event, []).append((loop, future))
+		await future
+
+	def _derived_from(self, batch):
+		return f"Observation?code=diagnostic-implication&derived-from={','.join(batch)}"
+
+	def prefetch(self, variant_ids):
+		"""Pull the implications for a batch of variants using derived-from"""
+		refs, fetching, waiting, generation = self._claim(variant_ids)
+		if fetching is None:
+			return
+
+		try:
+			batch_size = self.host.reference_batch_size
+			for i in range(0, len(refs), batch_size):
+				batch = refs[i:i + batch_size]
+				self._store(batch, self._parse(self.host.iter_entries(self._derived_from(batch))), generation)
+		finally:
+			self._release(refs, fetching)
+
+		# Whatever someone else was already pulling for us
+		for event in waiting:
+			event.wait()
+
+	async def prefetch_async(self, variant_ids, ahost):
+		"""Asynchronous version of prefetch, with each batch pulled concurrently through ahost"""
+		refs, fetching, waiting, generation = self._claim(variant_ids)
+		if fetching is None:
+			return
+
+		try:
+			batch_size = self.host.reference_batch_size
+			batches = [refs[i:i + batch_size] for i in range(0, len(refs), batch_size)]
+			payloads = await ahost.gather([self._derived_from(batch) for batch in batches])
+			for batch, payload in zip(batches, payloads):
+				self._store(batch, self._parse(payload.entries), generation)
+		finally:
+			self._release(refs, fetching)
+
+		# Whatever someone else (a thread or another coroutine) was already pulling for us
+		for event in waiting:
+			await self._wait_async(event)
+
+	def get(self, variant_id):
+		"""Return the {code: compact CodeableConcept} implications for the variant (see expand)"""
+		ref = f"Observation/{variant_id}"
+		while True:
+			with self._lock:
+				if self._complete or ref in self._loaded:
+					return self._implications.get(ref, {})
+				pending = self._pending.get(ref)
+
+			if pending is None:
+				self.load_all()
+			else:
+				pending.wait()
+				with self._lock:
+					if ref not in self._loaded and not self._complete:
+						# That fetch failed, so fall back to pulling everything
+						pending = None
+				if pending is None:
+					self.load_all()
+
 class VariantReport:
-	def __init__(self, host, data):
+	__slots__ = ('host', 'id', 'identifier', 'result', 'patient_url')
+
+	def __init__(self, host, data, results=None):
+		# results is an optional dict of reference => Observation for callers 
+		# that have already pulled them down
 		self.host = host
 		self.id = data['id']
 		self.identifier = Identifier(block=data['identifier'])
@@ -38,10 +323,17 @@ class VariantReport:
 
 		self.patient_url = Reference(data['subject'])
 
+		if results is None:
+			results = host.resolve_references([Reference(block=result).ref for result in data['result']])
+
 		for result in data['result']:
 			ref = Reference(block=result)
-			payload = host.get(ref.ref)
-			for data_chunk in payload.entries:
+			if ref.ref in results:
+				entries = [results[ref.ref]]
+			else:
+				entries = host.get(ref.ref).entries
+
+			for data_chunk in entries:
 
 				coding = Coding(block=data_chunk['code']['coding'])
 
@@ -53,120 +345,187 @@ class VariantReport:
 
 	@classmethod
 	def VariantReportsBySubject(cls, subject_id, host):
-		payload = host.get(f"DiagnosticReport?subject=Patient/{subject_id}")
-
 		reports = []
-		for data_chunk in payload.entries:
-			if 'resource' in data_chunk:
-				variant_report = VariantReport(host, data_chunk['resource'])
+		for page in host.iter_pages(f"DiagnosticReport?subject=Patient/{subject_id}"):
+			resources = [data_chunk['resource'] for data_chunk in page.entries if 'resource' in data_chunk]
+
+			# Resolve every result on the page at once
+			results = host.resolve_references([Reference(block=result).ref for resource in resources for result in resource['result']])
+			for resource in resources:
+				variant_report = VariantReport(host, resource, results=results)
 				reports.append(variant_report)
 		return reports
 
 class Variant:
-	def __init__(self, host, data):
+	# Studies can have a great many variants, so these are kept lean: no __dict__,
+	# and the components are held as compact tuples (see expand) rather than 
+	# fhirwood objects
+	__slots__ = ('host', 'id', '_identifier', '_specimen', '_components', 'start', 'end', '_implications')
+
+	def __init__(self, host, data, implications=None):
 		# this is the fhir_server object, which will be used to pull related entities
 		self.host = host		
 		self.id = data['id']
-		self.identifier = Identifier(block=data['identifier'])
+		self._identifier = tuple((intern(identifier.get('system')), identifier.get('value')) for identifier in data['identifier'])
 
-		self.specimen = None
+		self._specimen = None
 		if "specimen" in data:
-			self.specimen = Reference(block=data['specimen'])
+			self._specimen = data['specimen']['reference']
 
 		# We'll map the code:coding:code as key and the value as the value
-		self.components = {}
+		self._components = {}
+
+		# Plain integer copies of the position range, for anyone who needs to 
+		# do arithmetic on them
+		self.start = None
+		self.end = None
 
 		for component in data['component']:
-			coding = Coding(block=component['code']['coding'])
+			code = intern(component['code']['coding'][0]['code'])
 			if "valueCodeableConcept" in component:
-				self.components[coding.code] = CodeableConcept(block=component['valueCodeableConcept'])
+				self._components[code] = compact_concept(component['valueCodeableConcept'])
 			elif "valueRange" in component:
-				self.components[coding.code] = Range(block=component['valueRange'])
+				self._components[code] = compact_range(component['valueRange'])
+				if code == CODES.pos:
+					self.start = component['valueRange'].get('low', {}).get('value')
+					self.end = component['valueRange'].get('high', {}).get('value', self.start)
 			elif "valueString" in component:
-				self.components[coding.code] = component['valueString']
+				self._components[code] = intern(component['valueString'])
 			else:
 				print(f"I'm not sure what to do with this component: {component.keys()}")
 				sys.exit(1)
 
-		# Now let's pull together any diagnostic implications, should there be any
-		payload = host.get(f"Observation?code=diagnostic-implication")
-		self.implications = {}
+		# Now let's pull together any diagnostic implications, should there be any. 
+		# These come from the host's shared index unless the caller provides them
+		if implications is None:
+			implications = ImplicationIndex.for_host(host).get(self.id)
+		self._implications = implications
+
+	@property
+	def identifier(self):
+		return Identifier(block=[{'system': system, 'value': value} for system, value in self._identifier])
 
-		# We can't query for these implications directly, so we have to filter 
-		# the right ones out of the list by considering the derivedFrom property
-		id_ref = f"Observation/{self.id}"
+	@property
+	def specimen(self):
+		if self._specimen is None:
+			return None
+		return Reference(block={'reference': self._specimen})
 
-		for data_chunk in payload.entries:
-			if 'resource' in data_chunk:
-				data_chunk = data_chunk['resource']
-				ref = Reference(block=data_chunk['derivedFrom'])
-				if ref == id_ref:
-					for component_block in data_chunk['component']:
-						coding = Coding(block=component_block['code']['coding'])
-						valuecc = CodeableConcept(block=component_block['valueCodeableConcept'])
-						self.implications[coding.code] = valuecc
+	@property
+	def components(self):
+		"""The components as {code: fhirwood value}. These are rebuilt from the compact values
+		on every access (holding onto them would undo the savings), so keep the result
+		rather than asking again in a loop, or use component_text"""
+		return dict((code, expand(value)) for code, value in self._components.items())
+
+	@property
+	def implications(self):
+		"""The implications as {code: CodeableConcept}, rebuilt on every access just like components"""
+		return dict((code, expand(value)) for code, value in self._implications.items())
 
+	def component_text(self, code):
+		"""The text for a component (or implication) without building any fhirwood objects"""
+		if code in self._components:
+			return value_text(self._components[code])
+		return value_code(self._implications.get(code))
 
 	@property
 	def hgvsc(self):
-		return self.components.get(CODES.hgvsc)
+		return expand(self._components.get(CODES.hgvsc))
 	
 	@property
 	def hgvsp(self):
-		return self.components.get(CODES.hgvsp)
+		return expand(self._components.get(CODES.hgvsp))
 	
 	@property
 	def sv_type(self):
-		return self.components.get(CODES.sv_type)
+		return expand(self._components.get(CODES.sv_type))
 	
 	@property
 	def pos(self):
-		return self.components.get(CODES.pos)
+		return expand(self._components.get(CODES.pos))
 
 	@property
 	def ref_allele(self):
-		return self.components.get(CODES.ref_allele)
+		return expand(self._components.get(CODES.ref_allele))
 
 	@property
 	def alt_allele(self):
-		return self.components.get(CODES.alt_allele)
+		return expand(self._components.get(CODES.alt_allele))
 
 	@property
 	def zygosity(self):
-		return self.components.get(CODES.zygosity)
+		return expand(self._components.get(CODES.zygosity))
 
 	@property
 	def ref_seq(self):
-		return self.components.get(CODES.ref_seq)
+		return expand(self._components.get(CODES.ref_seq))
 
 	@property
 	def transcript(self):
-		return self.components.get(CODES.transcript)
+		return expand(self._components.get(CODES.transcript))
 
 	@property
 	def chrom(self):
-		return self.components.get(CODES.chrom)
+		return expand(self._components.get(CODES.chrom))
 	
 	@property
 	def inheritance(self):
-		return self.implications.get(CODES.inheritance)
+		return expand(self._implications.get(CODES.inheritance))
 
 	@property
 	def significance(self):
-		return self.implications.get(CODES.significance)		
+		return expand(self._implications.get(CODES.significance))		
 	
 
 	@property
 	def gene(self):
-		return self.components.get(CODES.gene)
+		return expand(self._components.get(CODES.gene))
+
+	@classmethod
+	def IterVariantsBySpecimen(cls, specimen_id, host):
+		"""Yield the variants one at a time as the entries arrive"""
+		index = ImplicationIndex.for_host(host)
+
+		# Pull the implications a page's worth of variants at a time. Going by entries
+		# rather than pages lets a streaming host avoid holding the page itself
+		batch_size = host.page_sizer.count_for('Observation')
+		resources = []
+		for data_chunk in host.iter_entries(f"Observation?specimen=Specimen/{specimen_id}"):
+			if 'resource' in data_chunk:
+				resources.append(data_chunk['resource'])
+
+			if len(resources) >= batch_size:
+				index.prefetch([resource['id'] for resource in resources])
+				for resource in resources:
+					yield Variant(host, resource)
+				resources = []
+
+		if len(resources) > 0:
+			index.prefetch([resource['id'] for resource in resources])
+			for resource in resources:
+				yield Variant(host, resource)
 
 	@classmethod
 	def VariantsBySpecimen(cls, specimen_id, host):
-		payload = host.get(f"Observation?specimen=Specimen/{specimen_id}")
+		variants = {}
+		for variant in Variant.IterVariantsBySpecimen(specimen_id, host):
+			variants[variant.identifier.value] = variant
+
+		return variants
+
+	@classmethod
+	async def VariantsBySpecimenAsync(cls, specimen_id, ahost):
+		"""Asynchronous version of VariantsBySpecimen. The specimen's implications are pulled into the shared index using derived-from"""
+		payload = await ahost.get(f"Observation?specimen=Specimen/{specimen_id}")
+
+		index = ImplicationIndex.for_host(ahost.host)
+		await index.prefetch_async([data_chunk['resource']['id'] for data_chunk in payload.entries if 'resource' in data_chunk], ahost)
+
 		variants = {}
 		for data_chunk in payload.entries:
 			if 'resource' in data_chunk:
-				variant = Variant(host, data_chunk['resource'])
+				variant = Variant(ahost.host, data_chunk['resource'])
 				variants[variant.identifier.value] = variant
 
 		return variants
\ No newline at end of file
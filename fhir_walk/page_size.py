@@ -0,0 +1,88 @@
+"""Choose the _count for each search
+
+Page size can be set for the host as a whole and overridden per resource type:
+
+    host = FhirHost(..., page_size=250, page_sizes={'Observation': 500})
+
+In adaptive mode, the latency and size of each page we get back are used to
+tune the _count for that resource type. The goal is to fetch as many entries
+per round trip as we can while each page stays under target_latency seconds
+and target_bytes bytes, which means that types with small bodies end up with
+larger pages. Changes are gradual (at most doubling or halving per page) and
+always stay within [min_count, max_count].
+"""
+import threading
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+class PageSizer:
+    def __init__(self, default=250, per_type=None, adaptive=False, min_count=50, max_count=1000,
+                 target_latency=2.0, target_bytes=4 * 1024 * 1024, smoothing=0.3):
+        self.default = default
+        self.per_type = dict(per_type or {})
+        self.adaptive = adaptive
+        self.min_count = min_count
+        self.max_count = max_count
+        self.target_latency = target_latency
+        self.target_bytes = target_bytes
+
+        # Weight given to each new observation in the moving averages
+        self.smoothing = smoothing
+
+        self._lock = threading.Lock()
+        self._tuned = {}            # resource type => current _count
+        self._observed = {}         # resource type => (seconds per entry, bytes per entry)
+
+    def count_for(self, resource_type):
+        with self._lock:
+            if resource_type in self._tuned:
+                return self._tuned[resource_type]
+        return self.per_type.get(resource_type, self.default)
+
+    def observe(self, resource_type, latency, size, entries):
+        """Fold a page's latency (seconds) and size (bytes) into the _count for resource_type"""
+        if not self.adaptive or entries == 0:
+            return
+
+        per_entry = (latency / entries, size / entries)
+        with self._lock:
+            if resource_type in self._observed:
+                old = self._observed[resource_type]
+                per_entry = tuple(old[i] + self.smoothing * (per_entry[i] - old[i]) for i in range(2))
+            self._observed[resource_type] = per_entry
+
+            # Latency includes the fixed cost of the round trip, so this errs on
+            # the side of smaller pages
+            seconds, size = per_entry
+            candidates = []
+            if seconds > 0:
+                candidates.append(self.target_latency / seconds)
+            if size > 0:
+                candidates.append(self.target_bytes / size)
+            if len(candidates) == 0:
+                return
+
+            current = self._tuned.get(resource_type, self.per_type.get(resource_type, self.default))
+            count = min(candidates + [current * 2])
+            count = max(count, current / 2)
+            self._tuned[resource_type] = int(max(self.min_count, min(self.max_count, count)))
+
+    def apply(self, url, resource_type):
+        """Rewrite the _count of a next link to the current page size for resource_type
+
+        Only next links which already carry a _count are touched, since those are the
+        ones the server lets us resize."""
+        if not self.adaptive:
+            return url
+
+        parts = urlsplit(url)
+        params = parse_qsl(parts.query, keep_blank_values=True)
+        if not any(name == '_count' for name, value in params):
+            return url
+
+        count = str(self.count_for(resource_type))
+        params = [(name, count if name == '_count' else value) for name, value in params]
+        return urlunsplit(parts._replace(query=urlencode(params, safe=":/,|")))
+
+    def stats(self):
+        with self._lock:
+            return dict(self._tuned)
@@ -0,0 +1,246 @@
+"""A study wide, sparse matrix of patients by HPO code
+
+Phenotype.PhenotypesByPatient answers questions about one patient at a time.
+PhenotypeMatrix holds every patient in a study as a row and every HPO code
+as a column, with each patient's present and absent codes stored sparsely
+(CSR: for each row, the column numbers of its codes). Cohort questions and
+similarity rankings are then a handful of numpy operations over the whole
+study:
+
+    matrix = study.phenotype_matrix()
+    matrix.cohort(present=['HP:0001250'], absent=['HP:0000707'])
+    matrix.similar(['HP:0001250', 'HP:0001263'], limit=10)
+
+A code can be present, absent or, when the patient has no Observation for it
+at all, unknown. not_present matches absent and unknown alike.
+
+Dependencies: numpy (and pyarrow, for snapshots)
+"""
+from fhir_walk.variant_table import _numpy
+
+class _Rows:
+    """CSR style rows: the column numbers of row i are indices[indptr[i]:indptr[i+1]]"""
+    def __init__(self, rows, row_count):
+        np = _numpy()
+        sizes = np.array([len(row) for row in rows] + [0] * (row_count - len(rows)), dtype=np.int64)
+        self.indptr = np.concatenate([[0], np.cumsum(sizes)])
+        self.indices = np.array([column for row in rows for column in row], dtype=np.int32)
+        self.sizes = sizes
+
+        # The row each of indices belongs to, used to sum per row with bincount
+        self.row_of = np.repeat(np.arange(row_count), sizes)
+        self._by_column = None
+
+    def column_mask(self, column, row_count):
+        """A boolean array of the rows containing column"""
+        np = _numpy()
+        if self._by_column is None:
+            # CSC, for column lookups
+            order = np.argsort(self.indices, kind='stable')
+            self._by_column = (self.indices[order], self.row_of[order])
+        columns, rows = self._by_column
+
+        mask = np.zeros(row_count, dtype=bool)
+        low = np.searchsorted(columns, column, side='left')
+        high = np.searchsorted(columns, column, side='right')
+        mask[rows[low:high]] = True
+        return mask
+
+    def hits(self, wanted, row_count):
+        """Count, for each row, how many of its columns are set in the boolean array wanted"""
+        np = _numpy()
+        return np.bincount(self.row_of, weights=wanted[self.indices], minlength=row_count)
+
+class PhenotypeMatrixBuilder:
+    def __init__(self):
+        self.patient_ids = []
+        self.patient_index = {}
+        self.codes = []
+        self.code_index = {}
+        self.names = {}
+        self.present = []
+        self.absent = []
+
+    def _row(self, patient_id):
+        row = self.patient_index.get(patient_id)
+        if row is None:
+            row = len(self.patient_ids)
+            self.patient_index[patient_id] = row
+            self.patient_ids.append(patient_id)
+            self.present.append([])
+            self.absent.append([])
+        return row
+
+    def _column(self, code, name=None):
+        column = self.code_index.get(code)
+        if column is None:
+            column = len(self.codes)
+            self.code_index[code] = column
+            self.codes.append(code)
+        if name and code not in self.names:
+            self.names[code] = name
+        return column
+
+    def add(self, patient_id, code=None, present=True, name=None):
+        """Add a phenotype for patient_id. With no code, the patient is added as a row without any"""
+        row = self._row(patient_id)
+        if code is not None:
+            column = self._column(code, name)
+            if present:
+                self.present[row].append(column)
+            else:
+                self.absent[row].append(column)
+
+    def add_patient(self, patient):
+        self._row(patient.id)
+        present, absent = patient.phenotypes()
+        for phenotypes, is_present in [(present, True), (absent, False)]:
+            for pheno in phenotypes.values():
+                self.add(patient.id, pheno.code, present=is_present, name=pheno.name)
+
+    def build(self):
+        count = len(self.patient_ids)
+        return PhenotypeMatrix(self.patient_ids, self.codes, _Rows(self.present, count), _Rows(self.absent, count),
+                               names=self.names)
+
+class PhenotypeMatrix:
+    def __init__(self, patient_ids, codes, present, absent, names=None):
+        np = _numpy()
+        self.patient_ids = np.array(patient_ids, dtype=object)
+        self.codes = list(codes)
+        self.names = names or {}
+        self.present = present
+        self.absent = absent
+
+        self._patient_index = dict((patient_id, row) for row, patient_id in enumerate(patient_ids))
+        self._code_index = dict((code, column) for column, code in enumerate(self.codes))
+
+    def __len__(self):
+        return len(self.patient_ids)
+
+    @classmethod
+    def from_patients(cls, patients, progress=None):
+        """Build the matrix from Patient objects (a list or the dict PatientsByStudy returns)"""
+        if isinstance(patients, dict):
+            patients = patients.values()
+
+        builder = PhenotypeMatrixBuilder()
+        for count, patient in enumerate(patients, 1):
+            builder.add_patient(patient)
+            if progress:
+                progress(count, patient)
+        return builder.build()
+
+    @classmethod
+    def from_study(cls, study, progress=None):
+        """Walk the study's patients, pulling their phenotypes alongside each page"""
+        return cls.from_patients(study.IterPatients(children=True), progress=progress)
+
+    @classmethod
+    def from_snapshot(cls, path):
+        """Build the matrix from a snapshot's patients and phenotypes"""
+        from fhir_walk.snapshot import load_snapshot
+        tables = load_snapshot(path, tables=['patients', 'phenotypes'])
+
+        builder = PhenotypeMatrixBuilder()
+        for patient_id in tables['patients'].column('id').to_pylist():
+            builder.add(patient_id)
+
+        phenotypes = tables['phenotypes']
+        for patient_id, code, name, present in zip(*(phenotypes.column(name).to_pylist()
+                                                     for name in ['patient_id', 'code', 'name', 'present'])):
+            builder.add(patient_id, code, present=present, name=name)
+        return builder.build()
+
+    def _column(self, code):
+        return self._code_index.get(code)
+
+    def _codes_mask(self, codes):
+        """A boolean array over the columns, True for each of codes"""
+        np = _numpy()
+        wanted = np.zeros(len(self.codes), dtype=bool)
+        for code in codes:
+            column = self._column(code)
+            if column is not None:
+                wanted[column] = True
+        return wanted
+
+    def has(self, code, present=True):
+        """A boolean array of the patients with code present (or, with present=False, absent)"""
+        np = _numpy()
+        column = self._column(code)
+        if column is None:
+            return np.zeros(len(self), dtype=bool)
+        rows = self.present if present else self.absent
+        return rows.column_mask(column, len(self))
+
+    def mask(self, present=(), absent=(), not_present=(), any_present=()):
+        """A boolean array of the patients matching every criterion
+
+        present and absent codes must each be observed as such, not_present codes
+        must be absent or unknown, and at least one of any_present (if given) must
+        be present."""
+        np = _numpy()
+        mask = np.ones(len(self), dtype=bool)
+        for code in present:
+            mask &= self.has(code)
+        for code in absent:
+            mask &= self.has(code, present=False)
+        for code in not_present:
+            mask &= ~self.has(code)
+        if len(any_present) > 0:
+            mask &= self.present.hits(self._codes_mask(any_present), len(self)) > 0
+        return mask
+
+    def cohort(self, present=(), absent=(), not_present=(), any_present=()):
+        """Return the ids of the patients matching every criterion (see mask)"""
+        return self.patient_ids[self.mask(present=present, absent=absent, not_present=not_present,
+                                          any_present=any_present)].tolist()
+
+    def codes_for(self, patient_id, present=True):
+        """Return the codes present (or absent) for a single patient"""
+        rows = self.present if present else self.absent
+        row = self._patient_index[patient_id]
+        return [self.codes[column] for column in rows.indices[rows.indptr[row]:rows.indptr[row + 1]]]
+
+    def jaccard(self, codes):
+        """The Jaccard similarity between codes and each patient's present codes, as an array over the patients"""
+        np = _numpy()
+        codes = set(codes)
+        intersection = self.present.hits(self._codes_mask(codes), len(self))
+        union = self.present.sizes + len(codes) - intersection
+
+        scores = np.zeros(len(self), dtype=np.float64)
+        np.divide(intersection, union, out=scores, where=union > 0)
+        return scores
+
+    def similar(self, codes, limit=10, exclude=None):
+        """Return up to limit (patient id, score) pairs, most similar first, by Jaccard over present codes
+
+        codes can also be a patient id, in which case that patient's present codes
+        are used and they are left out of the results."""
+        np = _numpy()
+        if isinstance(codes, str):
+            exclude = codes
+            codes = self.codes_for(codes)
+
+        scores = self.jaccard(codes)
+        if exclude is not None and exclude in self._patient_index:
+            scores[self._patient_index[exclude]] = -1
+
+        limit = min(limit, len(self))
+        if limit <= 0:
+            return []
+        top = np.argpartition(-scores, limit - 1)[:limit]
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return [(self.patient_ids[row], float(scores[row])) for row in top if scores[row] > 0]
+
+    def frequencies(self, present=True, mask=None):
+        """Return a dict of code => number of patients (optionally those in mask) with that code present (or absent)"""
+        np = _numpy()
+        rows = self.present if present else self.absent
+        indices = rows.indices
+        if mask is not None:
+            indices = indices[mask[rows.row_of]]
+        counts = np.bincount(indices, minlength=len(self.codes))
+        return dict((self.codes[column], int(count)) for column, count in enumerate(counts) if count > 0)
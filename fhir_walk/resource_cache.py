@@ -0,0 +1,92 @@
+"""In memory identity map for resources pulled from a FHIR server
+
+Resources are keyed by ResourceType/id and the least recently used are evicted
+once max_size is reached. An optional ttl (seconds) prevents us from handing
+back something that has been sitting around too long. The cache is populated
+from everything the host pulls down, searches included, so anything we've
+already seen can be handed back without another trip to the server.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+class ResourceCache:
+    # These describe the response itself rather than data on the server
+    skip_types = set(['Bundle', 'OperationOutcome'])
+
+    def __init__(self, max_size=10000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self._resources = OrderedDict()         # key => (resource, time stored)
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._resources)
+
+    def __contains__(self, key):
+        return self.get(key, count=False) is not None
+
+    def get(self, key, count=True):
+        """Return the resource for ResourceType/id or None if we don't have it"""
+        with self._lock:
+            cached = self._resources.get(key)
+
+            if cached is not None and self.ttl is not None and time.monotonic() - cached[1] > self.ttl:
+                del self._resources[key]
+                cached = None
+
+            if cached is None:
+                if count:
+                    self.misses += 1
+                return None
+
+            self._resources.move_to_end(key)
+            if count:
+                self.hits += 1
+            return cached[0]
+
+    def put(self, resource):
+        if self.max_size < 1:
+            return
+
+        resource_type = resource.get('resourceType')
+        if resource_type is None or resource_type in ResourceCache.skip_types or 'id' not in resource:
+            return
+
+        key = f"{resource_type}/{resource['id']}"
+        with self._lock:
+            self._resources[key] = (resource, time.monotonic())
+            self._resources.move_to_end(key)
+
+            while len(self._resources) > self.max_size:
+                self._resources.popitem(last=False)
+                self.evictions += 1
+
+    def add_entries(self, entries):
+        """Cache the full resources from a page of entries (or a resource read directly)"""
+        for entry in entries:
+            if 'resource' in entry:
+                self.put(entry['resource'])
+            else:
+                self.put(entry)
+
+    def invalidate(self, key=None):
+        """Drop a single ResourceType/id or, if key is None, everything"""
+        with self._lock:
+            if key is None:
+                self._resources.clear()
+            else:
+                self._resources.pop(key, None)
+
+    def stats(self):
+        return {
+            'size': len(self._resources),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
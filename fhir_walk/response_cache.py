@@ -0,0 +1,103 @@
+"""Persistent (sqlite backed) cache of GET responses
+
+Responses are keyed by host and the full request url and stored along with
+their ETag/Last-Modified headers. When the same url is requested again (even
+from a later run) we send If-None-Match/If-Modified-Since, and if the server
+answers with a 304 the stored body is used and nothing else comes across the
+wire.
+
+Search bundles usually come back without any validators. Those are only
+stored if max_age is set, in which case any stored response younger than
+max_age seconds is used without contacting the server at all. Keep that short,
+since servers will eventually expire the search ids embedded in 'next' links.
+"""
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+class ResponseCache:
+    def __init__(self, path, max_age=0):
+        self.path = Path(path)
+        self.max_age = max_age
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS responses (
+                                host TEXT,
+                                url TEXT,
+                                etag TEXT,
+                                last_modified TEXT,
+                                stored REAL,
+                                body TEXT,
+                                PRIMARY KEY (host, url))""")
+        self._db.commit()
+
+        self.fresh_hits = 0             # served without contacting the server
+        self.revalidated = 0            # server answered 304
+        self.misses = 0
+
+    def lookup(self, host, url):
+        """Return the stored response as a dict (etag, last_modified, stored, body) or None"""
+        with self._lock:
+            row = self._db.execute("SELECT etag, last_modified, stored, body FROM responses WHERE host=? AND url=?",
+                                    (host, url)).fetchone()
+        if row is None:
+            return None
+        return {
+            'etag': row[0],
+            'last_modified': row[1],
+            'stored': row[2],
+            'body': json.loads(row[3])
+        }
+
+    def is_fresh(self, cached):
+        return self.max_age > 0 and time.time() - cached['stored'] < self.max_age
+
+    def validators(self, cached):
+        """Conditional request headers for a stored response"""
+        headers = {}
+        if cached['etag']:
+            headers['If-None-Match'] = cached['etag']
+        if cached['last_modified']:
+            headers['If-Modified-Since'] = cached['last_modified']
+        return headers
+
+    def store(self, host, url, headers, body):
+        etag = headers.get('ETag')
+        last_modified = headers.get('Last-Modified')
+
+        # Without validators there is no way to revalidate, so only keep it if we're
+        # allowed to serve it blind for a while
+        if etag is None and last_modified is None and self.max_age <= 0:
+            return
+
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                                (host, url, etag, last_modified, time.time(), json.dumps(body)))
+            self._db.commit()
+
+    def touch(self, host, url):
+        """Mark a stored response as having just been revalidated"""
+        with self._lock:
+            self._db.execute("UPDATE responses SET stored=? WHERE host=? AND url=?", (time.time(), host, url))
+            self._db.commit()
+
+    def clear(self, host=None):
+        with self._lock:
+            if host is None:
+                self._db.execute("DELETE FROM responses")
+            else:
+                self._db.execute("DELETE FROM responses WHERE host=?", (host,))
+            self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+    def stats(self):
+        return {
+            'fresh_hits': self.fresh_hits,
+            'revalidated': self.revalidated,
+            'misses': self.misses
+        }
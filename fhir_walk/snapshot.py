@@ -0,0 +1,290 @@
+"""Columnar snapshots of a study for local analytics
+
+A snapshot is a directory containing one file per entity type:
+    * patients
+    * specimens
+    * conditions
+    * phenotypes
+    * variants (with each of the CODES components as its own column)
+    * sequencing_data
+
+along with a small manifest.json describing where the data came from. Each
+file is either parquet (the default) or arrow (Feather/IPC) with typed columns,
+so cohort analytics and QA scans can read a few megabytes from disk rather
+than walking the live server.
+
+    study.export_snapshot("snapshots/my-study")
+    tables = load_snapshot("snapshots/my-study")
+    tables['variants'].to_pandas()
+
+Dependencies: pyarrow
+"""
+import json
+import datetime
+from pathlib import Path
+
+from fhir_walk.model.sequencing_data import SequencingData
+from fhir_walk.model.variants import CODES
+
+formats = {
+    'parquet': '.parquet',
+    'arrow': '.arrow'
+}
+
+def _pyarrow():
+    try:
+        import pyarrow
+        return pyarrow
+    except ImportError:
+        raise ImportError("Snapshots require pyarrow. Please install it with: pip install fhir-walk[snapshot]")
+
+def _schemas(pa):
+    string = pa.string()
+    return {
+        'patients': [
+            ('id', string),
+            ('subject_id', string),
+            ('research_subject_id', string),
+            ('sex', string),
+            ('race', string),
+            ('eth', string),
+            ('study', string),
+            ('dbgap_study_id', string),
+            ('dbgap_id', string)
+        ],
+        'specimens': [
+            ('id', string),
+            ('patient_id', string),
+            ('sample_id', string),
+            ('study', string),
+            ('dbgap_id', string),
+            ('tissue_affected_status', string),
+            ('body_site_code', string),
+            ('body_site_display', string)
+        ],
+        'conditions': [
+            ('id', string),
+            ('patient_id', string),
+            ('code', string),
+            ('text', string),
+            ('status', string)
+        ],
+        'phenotypes': [
+            ('id', string),
+            ('patient_id', string),
+            ('code', string),
+            ('name', string),
+            ('status', string),
+            ('present', pa.bool_())
+        ],
+        'variants': [
+            ('id', string),
+            ('identifier', string),
+            ('patient_id', string),
+            ('specimen_id', string),
+            ('chrom', string),
+            ('start', pa.int64()),
+            ('end', pa.int64()),
+            ('ref_allele', string),
+            ('alt_allele', string),
+            ('gene', string),
+            ('zygosity', string),
+            ('ref_seq', string),
+            ('transcript', string),
+            ('hgvsc', string),
+            ('hgvsp', string),
+            ('sv_type', string),
+            ('inheritance', string),
+            ('significance', string)
+        ],
+        'sequencing_data': [
+            ('id', string),
+            ('patient_id', string),
+            ('specimen_id', string),
+            ('analyte_type', string),
+            ('lib_prep_kit', string),
+            ('exome_capture_platform', string),
+            ('capture_region_bed_file', string),
+            ('files', pa.list_(string))
+        ]
+    }
+
+def variant_row(variant, patient_id, specimen_id):
+    # component_text reads the variant's compact values directly, rather than 
+    # building (and then flattening) fhirwood objects for each of them
+    text = variant.component_text
+    return {
+        'id': variant.id,
+        'identifier': variant.identifier.value,
+        'patient_id': patient_id,
+        'specimen_id': specimen_id,
+        'chrom': text(CODES.chrom),
+        'start': variant.start,
+        'end': variant.end,
+        'ref_allele': text(CODES.ref_allele),
+        'alt_allele': text(CODES.alt_allele),
+        'gene': text(CODES.gene),
+        'zygosity': text(CODES.zygosity),
+        'ref_seq': text(CODES.ref_seq),
+        'transcript': text(CODES.transcript),
+        'hgvsc': text(CODES.hgvsc),
+        'hgvsp': text(CODES.hgvsp),
+        'sv_type': text(CODES.sv_type),
+        'inheritance': text(CODES.inheritance),
+        'significance': text(CODES.significance)
+    }
+
+class SnapshotWriter:
+    """Accumulate rows for each of the entity types, column by column"""
+    def __init__(self):
+        self.pa = _pyarrow()
+        self.schemas = _schemas(self.pa)
+        self.columns = {}
+        for name, fields in self.schemas.items():
+            self.columns[name] = dict((field, []) for field, _ in fields)
+
+    def add(self, table, row):
+        columns = self.columns[table]
+        for field in columns:
+            columns[field].append(row.get(field))
+
+    def add_patient(self, patient, variants=True, sequencing=True):
+        self.add('patients', {
+            'id': patient.id,
+            'subject_id': patient.subject_id,
+            'research_subject_id': patient.research_subject_id,
+            'sex': patient.sex,
+            'race': patient.race,
+            'eth': patient.eth,
+            'study': patient.study,
+            'dbgap_study_id': patient.dbgap_study_id,
+            'dbgap_id': patient.dbgap_id
+        })
+
+        for disease in patient.diseases().values():
+            self.add('conditions', {
+                'id': disease.id,
+                'patient_id': patient.id,
+                'code': disease.code,
+                'text': disease.text,
+                'status': disease.status
+            })
+
+        present, absent = patient.phenotypes()
+        for phenotypes, is_present in [(present, True), (absent, False)]:
+            for pheno in phenotypes.values():
+                self.add('phenotypes', {
+                    'id': pheno.id,
+                    'patient_id': patient.id,
+                    'code': pheno.code,
+                    'name': pheno.name,
+                    'status': pheno.status,
+                    'present': is_present
+                })
+
+        for specimen in patient.specimens().values():
+            body_site = specimen.body_site or ('', '')
+            self.add('specimens', {
+                'id': specimen.id,
+                'patient_id': patient.id,
+                'sample_id': specimen.sample_id,
+                'study': specimen.study,
+                'dbgap_id': specimen.dbgap_id,
+                'tissue_affected_status': specimen.tissue_affected_status,
+                'body_site_code': body_site[0],
+                'body_site_display': body_site[1]
+            })
+
+            if variants:
+                for variant in specimen.variants().values():
+                    self.add('variants', variant_row(variant, patient.id, specimen.id))
+
+            if sequencing:
+                for seq in SequencingData.SequencingDataBySpecimen(specimen.id, specimen.host):
+                    self.add('sequencing_data', {
+                        'id': seq.id,
+                        'patient_id': patient.id,
+                        'specimen_id': specimen.id,
+                        'analyte_type': seq.analyte_type,
+                        'lib_prep_kit': seq.lib_prep_kit,
+                        'exome_capture_platform': seq.exome_capture_platform,
+                        'capture_region_bed_file': seq.capture_region_bed_file,
+                        'files': [doc.filename for doc in seq.sequencing_files]
+                    })
+
+    def table(self, name):
+        pa = self.pa
+        schema = pa.schema(self.schemas[name])
+        return pa.Table.from_pydict(self.columns[name], schema=schema)
+
+    def write(self, path, format='parquet', manifest=None):
+        """Write each table to path (a directory), returning the row counts"""
+        if format not in formats:
+            raise ValueError(f"Unknown snapshot format, '{format}'. Choose from: {', '.join(sorted(formats))}")
+
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+
+        counts = {}
+        for name in self.schemas:
+            table = self.table(name)
+            filename = path / f"{name}{formats[format]}"
+
+            if format == 'parquet':
+                import pyarrow.parquet as pq
+                pq.write_table(table, str(filename), compression='zstd')
+            else:
+                import pyarrow.feather as feather
+                feather.write_feather(table, str(filename), compression='zstd')
+            counts[name] = table.num_rows
+
+        if manifest is None:
+            manifest = {}
+        manifest['format'] = format
+        manifest['created'] = datetime.datetime.utcnow().isoformat()
+        manifest['tables'] = counts
+        with open(path / "manifest.json", 'wt') as f:
+            json.dump(manifest, f, indent=2)
+
+        return counts
+
+def export_snapshot(study, path, format='parquet', variants=True, sequencing=True, progress=None):
+    """Walk the entire study and write it to path as a columnar snapshot
+
+    progress, if provided, is called with each patient once it has been added"""
+    writer = SnapshotWriter()
+
+    for patient in study.IterPatients(children=True):
+        writer.add_patient(patient, variants=variants, sequencing=sequencing)
+        if progress:
+            progress(patient)
+
+    manifest = {
+        'study_id': study.id,
+        'title': study.title,
+        'host': study.host.target_service_url
+    }
+    return writer.write(path, format=format, manifest=manifest)
+
+def load_snapshot(path, tables=None):
+    """Read a snapshot back in, returning a dict of name => pyarrow.Table"""
+    _pyarrow()
+    path = Path(path)
+
+    with open(path / "manifest.json", 'rt') as f:
+        manifest = json.load(f)
+    format = manifest['format']
+
+    if tables is None:
+        tables = list(manifest['tables'].keys())
+
+    snapshot = {}
+    for name in tables:
+        filename = str(path / f"{name}{formats[format]}")
+        if format == 'parquet':
+            import pyarrow.parquet as pq
+            snapshot[name] = pq.read_table(filename)
+        else:
+            import pyarrow.feather as feather
+            snapshot[name] = feather.read_table(filename)
+    return snapshot
@@ -0,0 +1,96 @@
+"""Incremental parsing of search bundles
+
+A page of variant Observations at a large _count can run to many megabytes of
+JSON, and decoding it in one go means holding the entire page (twice over, the
+text and the dicts) just to hand the entries out one at a time. BundleStream
+parses the bundle as the bytes arrive instead, yielding each entry as soon as
+it is complete:
+
+    bundle = BundleStream(response.raw)
+    for entry in bundle:
+        ...
+    bundle.next         # the 'next' link, once the entries have been consumed
+
+FhirHost uses this for iter_entries when stream_entries is set.
+
+Dependencies: ijson
+"""
+import sys
+
+def _ijson():
+    try:
+        import ijson
+        return ijson
+    except ImportError:
+        raise ImportError("Streaming bundles requires ijson. Please install it with: pip install fhir-walk[stream]")
+
+class CountingReader:
+    """Wrap a file-like object, keeping track of the bytes read from it"""
+    def __init__(self, source):
+        self.source = source
+        self.bytes = 0
+
+    def read(self, size=-1):
+        data = self.source.read(size)
+        self.bytes += len(data)
+        return data
+
+class BundleStream:
+    """Iterate over a bundle's entries as they are parsed
+
+    Top level properties (resourceType, total, ...) end up in meta and the links
+    in links. Since servers are free to put the links after the entries, next is
+    only reliable once the entries have all been consumed.
+    """
+    def __init__(self, source):
+        self.source = CountingReader(source)
+        self.meta = {}
+        self.links = []
+        self.entry_count = 0
+        self.match_count = 0
+
+    @property
+    def bytes(self):
+        return self.source.bytes
+
+    @property
+    def next(self):
+        for link in self.links:
+            if link.get('relation') == 'next':
+                return link['url']
+        return None
+
+    def __iter__(self):
+        ijson = _ijson()
+        builder = None
+        target = None
+
+        for prefix, event, value in ijson.parse(self.source, use_float=True):
+            if builder is not None:
+                # json.loads shares the keys across a document. Without this, every
+                # entry would carry its own copy of each of them
+                if event == 'map_key':
+                    value = sys.intern(value)
+                builder.event(event, value)
+                if prefix == target and event in ('end_map', 'end_array'):
+                    if target == 'link':
+                        self.links = builder.value
+                    else:
+                        self.entry_count += 1
+                        if builder.value.get('search', {}).get('mode', 'match') == 'match':
+                            self.match_count += 1
+                        yield builder.value
+                    builder = None
+                continue
+
+            if prefix == 'entry.item' and event == 'start_map':
+                target = prefix
+            elif prefix == 'link' and event == 'start_array':
+                target = prefix
+            else:
+                if "." not in prefix and event in ('string', 'number', 'boolean', 'null'):
+                    self.meta[prefix] = value
+                continue
+
+            builder = ijson.ObjectBuilder()
+            builder.event(event, value)
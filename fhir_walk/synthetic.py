@@ -0,0 +1,284 @@
+"""Generate synthetic NCPI/CMG studies in the shape the walker models expect
+
+This is strictly for testing and benchmarking. The contents are random, but
+the structure follows what we ingest for the CMG studies:
+
+    * ResearchStudy
+    * ResearchSubject (one per patient) pointing to the Patient
+    * Patient with kidsfirst and dbgap identifiers, race and ethnicity
+    * Family Observations linking each proband to their parents
+    * Specimen with a tissue affected status Observation
+    * Condition and HPO Observations (present and absent)
+    * Variant Observations with diagnostic implications
+    * Sequencing Tasks and their DocumentReferences
+
+Patients are generated in trios (proband, father, mother), all of whom are
+subjects in the study.
+
+    study = SyntheticStudy(subjects=1000, seed=1)
+    for resource in study.resources():
+        ...
+"""
+import random
+
+kf_participants = "https://ncpi-api-dataservice.kidsfirstdrc.org/participants?study_id={study}&external_id="
+kf_research_subjects = "https://ncpi-api-dataservice.kidsfirstdrc.org/research_subjects?study_id={study}&external_id="
+kf_specimens = "http://ncpi-api-dataservice.kidsfirstdrc.org/biospecimens?study_id={study}&external_aliquot_id="
+dbgap_participants = "https://dbgap-api.ncbi.nlm.nih.gov/participants?study_id={study}&external_id="
+dbgap_specimens = "https://dbgap-api.ncbi.nlm.nih.gov/specimen"
+
+race_url = "http://hl7.org/fhir/us/core/StructureDefinition/us-core-race"
+ethnicity_url = "http://hl7.org/fhir/us/core/StructureDefinition/us-core-ethnicity"
+loinc = "http://loinc.org"
+
+races = ["White", "Black or African American", "Asian", "American Indian or Alaska Native", "Other"]
+ethnicities = ["Hispanic or Latino", "Not Hispanic or Latino"]
+body_sites = [("UBERON:0000178", "Blood"), ("UBERON:0001836", "Saliva"), ("UBERON:0002097", "Skin")]
+diseases = [("MONDO:0005015", "diabetes mellitus"), ("MONDO:0008315", "prostate cancer"),
+            ("MONDO:0007254", "breast cancer"), ("MONDO:0011122", "obesity"), ("MONDO:0005147", "type 1 diabetes")]
+genes = ["BRCA1", "BRCA2", "TP53", "CFTR", "DMD", "MECP2", "SCN1A", "PKD1", "FBN1", "COL1A1"]
+chromosomes = [str(c) for c in range(1, 23)] + ["X", "Y"]
+zygosities = ["Heterozygous", "Homozygous", "Hemizygous"]
+significances = [("LA6668-3", "Pathogenic"), ("LA26332-9", "Likely pathogenic"),
+                 ("LA26333-7", "Uncertain significance"), ("LA26334-5", "Likely benign")]
+inheritances = [("AD", "Autosomal dominant"), ("AR", "Autosomal recessive"), ("XL", "X-linked")]
+alleles = ["A", "C", "G", "T"]
+
+# CODES from the variant model
+variant_codes = {
+    'gene': "48018-6",
+    'chrom': "48001-2",
+    'pos': "exact-start-end",
+    'ref_allele': "69547-8",
+    'alt_allele': "69551-0",
+    'zygosity': "53034-5",
+    'transcript': "51958-7",
+    'hgvsc': "48004-6",
+    'hgvsp': "48005-3",
+    'inheritance': "mode-of-inheritance",
+    'significance': "53037-8"
+}
+
+def ref(resource_type, id):
+    return {"reference": f"{resource_type}/{id}"}
+
+def concept(code, display=None, system=None, text=None):
+    coding = {"code": code}
+    if display is not None:
+        coding['display'] = display
+    if system is not None:
+        coding['system'] = system
+
+    block = {"coding": [coding]}
+    if text is not None:
+        block['text'] = text
+    return block
+
+def component(code, **value):
+    block = {"code": concept(code, system=loinc)}
+    block.update(value)
+    return block
+
+class SyntheticStudy:
+    def __init__(self, subjects=100, seed=1, study_id="SD-SYNTH", dbgap_study="phs000000",
+                 specimens_per_patient=2, variants_per_specimen=2, phenotypes_per_patient=4,
+                 conditions_per_patient=1, sequencing=True):
+        self.subjects = subjects
+        self.seed = seed
+        self.study_id = study_id
+        self.dbgap_study = dbgap_study
+        self.specimens_per_patient = specimens_per_patient
+        self.variants_per_specimen = variants_per_specimen
+        self.phenotypes_per_patient = phenotypes_per_patient
+        self.conditions_per_patient = conditions_per_patient
+        self.sequencing = sequencing
+
+        # HPO codes are sampled from a fixed vocabulary so that cohorts overlap
+        self.hpo_codes = [f"HP:{code:07d}" for code in range(1, 501)]
+
+    def resources(self):
+        """Yield every resource in the study, one at a time"""
+        rng = random.Random(self.seed)
+        study_key = self.study_id.lower()
+
+        yield {
+            "resourceType": "ResearchStudy",
+            "id": study_key,
+            "identifier": [{"system": "https://ncpi-api-dataservice.kidsfirstdrc.org/studies", "value": self.study_id}],
+            "title": f"Synthetic Study {self.study_id}",
+            "status": "completed"
+        }
+
+        family = []
+        for index in range(self.subjects):
+            yield from self.patient(rng, index, study_key)
+
+            family.append(f"pt-{index}")
+            if len(family) == 3 or index == self.subjects - 1:
+                yield from self.family(family)
+                family = []
+
+    def patient(self, rng, index, study_key):
+        patient_id = f"pt-{index}"
+        subject_id = f"SUBJ-{index:06d}"
+
+        yield {
+            "resourceType": "Patient",
+            "id": patient_id,
+            "identifier": [
+                {"system": kf_participants.format(study=self.study_id), "value": subject_id},
+                {"system": dbgap_participants.format(study=self.dbgap_study), "value": f"dbgap-{index}"}
+            ],
+            "gender": rng.choice(["male", "female"]),
+            "extension": [
+                {"url": race_url, "extension": [{"url": "ombCategory", "valueCoding": {"display": rng.choice(races)}}]},
+                {"url": ethnicity_url, "extension": [{"url": "ombCategory", "valueCoding": {"display": rng.choice(ethnicities)}}]}
+            ]
+        }
+
+        yield {
+            "resourceType": "ResearchSubject",
+            "id": f"rs-{index}",
+            "identifier": [{"system": kf_research_subjects.format(study=self.study_id), "value": subject_id}],
+            "status": "on-study",
+            "study": ref("ResearchStudy", study_key),
+            "individual": ref("Patient", patient_id)
+        }
+
+        for c in range(self.conditions_per_patient):
+            code, display = rng.choice(diseases)
+            yield {
+                "resourceType": "Condition",
+                "id": f"cond-{index}-{c}",
+                "subject": ref("Patient", patient_id),
+                "code": {"text": display, "coding": [{"system": "http://purl.obolibrary.org/obo/mondo.owl", "code": code, "display": display}]},
+                "verificationStatus": {"text": rng.choice(["Affected", "Unaffected"])}
+            }
+
+        for p, hpo in enumerate(rng.sample(self.hpo_codes, self.phenotypes_per_patient)):
+            present = rng.random() < 0.7
+            yield {
+                "resourceType": "Observation",
+                "id": f"hpo-{index}-{p}",
+                "status": "final",
+                "subject": ref("Patient", patient_id),
+                "code": concept(hpo, display=f"Phenotype {hpo}", system="http://purl.obolibrary.org/obo/hp.owl"),
+                "interpretation": [concept("POS" if present else "NEG", display="Present" if present else "Absent")]
+            }
+
+        for s in range(self.specimens_per_patient):
+            yield from self.specimen(rng, index, s, patient_id)
+
+    def specimen(self, rng, index, s, patient_id):
+        specimen_id = f"sp-{index}-{s}"
+        site = rng.choice(body_sites)
+
+        yield {
+            "resourceType": "Specimen",
+            "id": specimen_id,
+            "identifier": [
+                {"system": kf_specimens.format(study=self.study_id), "value": f"SAMPLE-{index:06d}-{s}"},
+                {"system": dbgap_specimens, "value": f"dbgap-sample-{index}-{s}"}
+            ],
+            "subject": ref("Patient", patient_id),
+            "collection": {"bodySite": concept(site[0], display=site[1])}
+        }
+
+        for v in range(self.variants_per_specimen):
+            variant_id = f"var-{index}-{s}-{v}"
+            start = rng.randrange(1, 100000000)
+            gene = rng.choice(genes)
+            significance = rng.choice(significances)
+            inheritance = rng.choice(inheritances)
+
+            yield {
+                "resourceType": "Observation",
+                "id": variant_id,
+                "status": "final",
+                "identifier": [{"system": "urn:synthetic:variants", "value": f"VAR-{index}-{s}-{v}"}],
+                "code": concept("69548-6", display="Genetic variant assessment", system=loinc),
+                "subject": ref("Patient", patient_id),
+                "specimen": ref("Specimen", specimen_id),
+                "component": [
+                    component(variant_codes['gene'], valueCodeableConcept={"text": gene}),
+                    component(variant_codes['chrom'], valueCodeableConcept={"text": rng.choice(chromosomes)}),
+                    component(variant_codes['pos'], valueRange={"low": {"value": start}, "high": {"value": start + rng.randrange(0, 50)}}),
+                    component(variant_codes['ref_allele'], valueString=rng.choice(alleles)),
+                    component(variant_codes['alt_allele'], valueString=rng.choice(alleles)),
+                    component(variant_codes['zygosity'], valueCodeableConcept={"text": rng.choice(zygosities)}),
+                    component(variant_codes['transcript'], valueCodeableConcept={"text": f"NM_{rng.randrange(1000, 99999):06d}.1"}),
+                    component(variant_codes['hgvsc'], valueCodeableConcept={"text": f"c.{rng.randrange(1, 5000)}A>G"}),
+                    component(variant_codes['hgvsp'], valueCodeableConcept={"text": f"p.Arg{rng.randrange(1, 1500)}Gly"})
+                ]
+            }
+
+            yield {
+                "resourceType": "Observation",
+                "id": f"impl-{index}-{s}-{v}",
+                "status": "final",
+                "code": concept("diagnostic-implication", system="http://hl7.org/fhir/uv/genomics-reporting/CodeSystem/tbd-codes"),
+                "subject": ref("Patient", patient_id),
+                "derivedFrom": [ref("Observation", variant_id)],
+                "component": [
+                    component(variant_codes['significance'], valueCodeableConcept=concept(significance[0], display=significance[1])),
+                    component(variant_codes['inheritance'], valueCodeableConcept=concept(inheritance[0], display=inheritance[1]))
+                ]
+            }
+
+        # The tissue status is read from the system of the specimen's observation
+        affected = rng.choice(["Affected", "Unaffected"])
+        yield {
+            "resourceType": "Observation",
+            "id": f"tissue-{index}-{s}",
+            "status": "final",
+            "identifier": [{"system": "urn:synthetic:tissue", "value": f"TISSUE-{index}-{s}"}],
+            "code": {"text": "Tissue Affected Status", "coding": [{"system": affected, "code": affected.lower()}]},
+            "specimen": ref("Specimen", specimen_id),
+            "component": []
+        }
+
+        if self.sequencing:
+            doc_id = f"doc-{index}-{s}"
+            yield {
+                "resourceType": "DocumentReference",
+                "id": doc_id,
+                "status": "current",
+                "author": [ref("Organization", "synthetic-center")],
+                "subject": ref("Patient", patient_id),
+                "content": [{"attachment": {"title": f"SAMPLE-{index:06d}-{s}.cram"}, "format": {"display": "Sequence Filename"}}]
+            }
+
+            yield {
+                "resourceType": "Task",
+                "id": f"task-{index}-{s}",
+                "status": "completed",
+                "intent": "order",
+                "owner": ref("Organization", "synthetic-center"),
+                "focus": ref("Specimen", specimen_id),
+                "input": [
+                    {"type": {"text": "Analyte Type"}, "valueString": "DNA"},
+                    {"type": {"text": "Library Prep Kit"}, "valueString": "Synthetic Prep"},
+                    {"type": {"text": "Exome Capture Platform"}, "valueString": "Synthetic Exome v1"},
+                    {"type": {"text": "Capture Region Bed File"}, "valueString": "synthetic_exome_v1.bed"}
+                ],
+                "output": [
+                    {"type": {"text": "Sequence Data Filename"}, "valueReference": ref("DocumentReference", doc_id)}
+                ]
+            }
+
+    def family(self, members):
+        """The first member is the proband, followed by father and mother"""
+        if len(members) < 3:
+            return
+
+        proband = members[0]
+        for parent, code, display in [(members[1], "FTH", "father"), (members[2], "MTH", "mother")]:
+            yield {
+                "resourceType": "Observation",
+                "id": f"fam-{proband}-{code.lower()}",
+                "status": "final",
+                "code": {"text": "Family Relationship", "coding": [{"system": loinc, "code": "FAMMEMB"}]},
+                "subject": ref("Patient", parent),
+                "focus": [ref("Patient", proband)],
+                "valueCodeableConcept": concept(code, display=display, system="http://terminology.hl7.org/CodeSystem/v3-RoleCode")
+            }
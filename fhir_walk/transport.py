@@ -0,0 +1,166 @@
+"""A pooled, retrying transport for FhirHost
+
+PooledTransport keeps a single requests.Session (and so, keep-alive connections)
+with a configurable pool size, and retries anything that looks transient:
+
+    * 429 and 5xx responses, honoring Retry-After when the server sends one
+    * connection errors and timeouts
+
+Retries back off exponentially with full jitter. Requests that aren't safe to
+repeat (POST and PATCH) are only retried when the server told us it didn't
+process them (429) or we never managed to connect at all.
+
+Like the FhirApiClient, send_request returns a (success, result) tuple, so it
+can be used anywhere a transport is expected:
+
+    host = FhirHost(..., pooled_transport={'pool_size': 16, 'retries': 8})
+
+When a page still fails after every retry, FhirHost raises a FhirRequestError
+whose resume_url can be handed back to iter_pages/get (resume_from) to carry
+on from that page rather than starting the search over.
+"""
+import logging
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# Methods which are safe to send again after the server may have seen them
+idempotent_methods = set(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+
+class FhirRequestError(Exception):
+    """A request failed (after any retries). resume_url is the page to pick the search back up from"""
+    def __init__(self, url, result, resume_url=None):
+        self.url = url
+        self.result = result
+        self.status_code = result.get('status_code') if isinstance(result, dict) else None
+        self.resume_url = resume_url
+
+        # FhirHost.get hangs whatever it had gathered before the failure here
+        self.partial = None
+        super().__init__(f"Request for {url} failed with status {self.status_code}")
+
+def retry_after(response):
+    """Seconds the server asked us to wait, or None"""
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class PooledTransport:
+    def __init__(self, auth=None, pool_size=10, retries=5, backoff=0.5, max_backoff=60,
+                 timeout=(10, 120), retry_statuses=(429, 500, 502, 503, 504)):
+        self.auth = auth
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        # Either seconds or a (connect, read) tuple, as requests expects
+        self.timeout = timeout
+        self.retry_statuses = set(retry_statuses)
+
+        self._session = None
+        self._lock = threading.Lock()
+        self.retries_made = 0
+
+    def session(self):
+        """Return the shared session, creating it if necessary"""
+        with self._lock:
+            if self._session is None:
+                session = requests.Session()
+                session.auth = self.auth
+
+                # We do our own retrying, so the adapter shouldn't
+                adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size, max_retries=0)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._session = session
+            return self._session
+
+    def _delay(self, attempt, response=None):
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * (2 ** attempt)))
+        if response is not None:
+            requested = retry_after(response)
+            if requested is not None:
+                delay = max(delay, requested)
+        return delay
+
+    def retry_delay(self, method, url, attempt, reason, response=None):
+        """Log the retry and return how long to wait before making it"""
+        delay = self._delay(attempt, response)
+        with self._lock:
+            self.retries_made += 1
+        logger.warning(f"{method} {url} failed ({reason}). Retrying in {delay:.1f}s ({attempt + 1}/{self.retries})")
+        return delay
+
+    def _wait(self, method, url, attempt, reason, response=None):
+        time.sleep(self.retry_delay(method, url, attempt, reason, response))
+
+    def request(self, method, url, **kwargs):
+        """Send the request, retrying as needed, and return the final requests.Response
+
+        Connection errors and timeouts on the final attempt are raised as is."""
+        method = method.upper()
+        kwargs.setdefault('timeout', self.timeout)
+        session = self.session()
+
+        attempt = 0
+        while True:
+            try:
+                response = session.request(method, url, **kwargs)
+            except requests.exceptions.ConnectionError as e:
+                # Unless we never connected, the server may have acted on the request
+                repeatable = method in idempotent_methods or isinstance(e, requests.exceptions.ConnectTimeout)
+                if attempt >= self.retries or not repeatable:
+                    raise
+                self._wait(method, url, attempt, type(e).__name__)
+            except requests.exceptions.Timeout as e:
+                if attempt >= self.retries or method not in idempotent_methods:
+                    raise
+                self._wait(method, url, attempt, type(e).__name__)
+            else:
+                repeatable = response.status_code == 429 or method in idempotent_methods
+                if response.status_code not in self.retry_statuses or attempt >= self.retries or not repeatable:
+                    return response
+                self._wait(method, url, attempt, f"status {response.status_code}", response)
+                response.close()
+            attempt += 1
+
+    def send_request(self, method, url, **kwargs):
+        """Mirrors FhirApiClient.send_request, returning a (success, result) tuple"""
+        try:
+            response = self.request(method, url, **kwargs)
+        except requests.exceptions.RequestException as e:
+            return False, {'status_code': None, 'request_url': url, 'response': str(e)}
+
+        try:
+            content = response.json()
+        except ValueError:
+            content = response.text
+
+        result = {
+            'status_code': response.status_code,
+            'request_url': url,
+            'response': content,
+            'bytes': len(response.content)
+        }
+        return response.status_code in (200, 201, 204), result
+
+    def close(self):
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
@@ -0,0 +1,243 @@
+"""A columnar, study wide table of variants
+
+Rather than a dict of Variant objects per specimen, a VariantTable holds one
+numpy array per column for an entire study (or any other set of variants).
+String columns are dictionary encoded: an int32 array of codes indexing into
+a list of the distinct values, with -1 for missing. Filters are then simple
+vectorized comparisons against those codes:
+
+    table = study.variant_table()
+    hits = table.where(gene='BRCA1', significance='Pathogenic')
+    hits.column('patient_id')
+
+Tables can be built from Variant objects, by walking a study or from a
+snapshot (see fhir_walk.snapshot) without touching the server at all:
+
+    table = VariantTable.from_snapshot("snapshots/my-study")
+
+Dependencies: numpy (and pyarrow, for snapshots)
+"""
+from fhir_walk.snapshot import variant_row
+
+string_columns = ['identifier', 'patient_id', 'specimen_id', 'chrom', 'ref_allele', 'alt_allele', 'gene',
+                  'zygosity', 'ref_seq', 'transcript', 'hgvsc', 'hgvsp', 'sv_type', 'inheritance', 'significance']
+int_columns = ['start', 'end']
+
+# Significance is stored as its (LOINC answer) code, but it's nicer to ask by name
+significance_codes = {
+    'pathogenic': 'LA6668-3',
+    'likely pathogenic': 'LA26332-9',
+    'uncertain significance': 'LA26333-7',
+    'likely benign': 'LA26334-5',
+    'benign': 'LA6675-8'
+}
+
+def _numpy():
+    try:
+        import numpy
+        return numpy
+    except ImportError:
+        raise ImportError("Variant tables require numpy. Please install it with: pip install fhir-walk[analytics]")
+
+class VariantTableBuilder:
+    """Accumulate rows (as produced by snapshot.variant_row), encoding the strings as we go"""
+    def __init__(self):
+        self.codes = dict((name, []) for name in string_columns)
+        self.lookups = dict((name, {}) for name in string_columns)
+        self.categories = dict((name, []) for name in string_columns)
+        self.positions = dict((name, []) for name in int_columns)
+
+    def add(self, row):
+        for name in string_columns:
+            value = row.get(name)
+            if value is None:
+                self.codes[name].append(-1)
+                continue
+
+            lookup = self.lookups[name]
+            code = lookup.get(value)
+            if code is None:
+                code = len(self.categories[name])
+                lookup[value] = code
+                self.categories[name].append(value)
+            self.codes[name].append(code)
+
+        for name in int_columns:
+            value = row.get(name)
+            self.positions[name].append(-1 if value is None else value)
+
+    def add_variant(self, variant, patient_id=None, specimen_id=None):
+        if specimen_id is None and variant.specimen is not None:
+            specimen_id = variant.specimen.ref.split("/")[-1]
+        self.add(variant_row(variant, patient_id, specimen_id))
+
+    def build(self):
+        np = _numpy()
+        codes = dict((name, np.array(values, dtype=np.int32)) for name, values in self.codes.items())
+        positions = dict((name, np.array(values, dtype=np.int64)) for name, values in self.positions.items())
+        return VariantTable(codes, self.categories, positions)
+
+class VariantTable:
+    def __init__(self, codes, categories, positions):
+        self.codes = codes              # column => int32 array of codes (-1 is missing)
+        self.categories = categories    # column => list of distinct values
+        self.positions = positions      # start/end => int64 array (-1 is missing)
+        self._lookups = {}
+        self._interval_index = None
+
+    def __len__(self):
+        return len(self.positions['start'])
+
+    @property
+    def start(self):
+        return self.positions['start']
+
+    @property
+    def end(self):
+        return self.positions['end']
+
+    @classmethod
+    def from_rows(cls, rows):
+        builder = VariantTableBuilder()
+        for row in rows:
+            builder.add(row)
+        return builder.build()
+
+    @classmethod
+    def from_variants(cls, variants, patient_id=None, specimen_id=None):
+        """Build a table from Variant objects (a list or the dict VariantsBySpecimen returns)"""
+        if isinstance(variants, dict):
+            variants = variants.values()
+
+        builder = VariantTableBuilder()
+        for variant in variants:
+            builder.add_variant(variant, patient_id=patient_id, specimen_id=specimen_id)
+        return builder.build()
+
+    @classmethod
+    def from_study(cls, study, progress=None):
+        """Walk each of the study's patients' specimens, collecting their variants"""
+        builder = VariantTableBuilder()
+        for count, patient in enumerate(study.IterPatients(), 1):
+            for specimen in patient.specimens().values():
+                for variant in specimen.variants().values():
+                    builder.add_variant(variant, patient_id=patient.id, specimen_id=specimen.id)
+            if progress:
+                progress(count, patient)
+        return builder.build()
+
+    @classmethod
+    def from_snapshot(cls, path):
+        """Load the variants from a snapshot directory"""
+        from fhir_walk.snapshot import load_snapshot, _pyarrow
+        pa = _pyarrow()
+        np = _numpy()
+
+        table = load_snapshot(path, tables=['variants'])['variants']
+
+        codes = {}
+        categories = {}
+        for name in string_columns:
+            encoded = table.column(name).combine_chunks().dictionary_encode()
+            codes[name] = encoded.indices.fill_null(-1).to_numpy(zero_copy_only=False).astype(np.int32)
+            categories[name] = encoded.dictionary.to_pylist()
+
+        positions = {}
+        for name in int_columns:
+            positions[name] = table.column(name).fill_null(-1).to_numpy().astype(np.int64)
+        return cls(codes, categories, positions)
+
+    def _code(self, name, value):
+        """The code for value in column name, or None if it never appears"""
+        if name not in self._lookups:
+            self._lookups[name] = dict((category, code) for code, category in enumerate(self.categories[name]))
+        if name == 'significance' and isinstance(value, str):
+            value = significance_codes.get(value.lower(), value)
+        return self._lookups[name].get(value)
+
+    def mask(self, **criteria):
+        """A boolean array of the rows matching every one of criteria
+
+        Each criterion is column=value, where value can be a single value, a list
+        (or set) of values to match any of, or None to match missing values. start and
+        end can also be given as (low, high) ranges, either of which can be None."""
+        np = _numpy()
+        mask = np.ones(len(self), dtype=bool)
+
+        for name, value in criteria.items():
+            if name in int_columns:
+                column = self.positions[name]
+                if isinstance(value, tuple):
+                    low, high = value
+                    if low is not None:
+                        mask &= column >= low
+                    if high is not None:
+                        mask &= column <= high
+                else:
+                    mask &= column == value
+                continue
+
+            if name not in self.codes:
+                raise KeyError(f"Unknown variant column, '{name}'")
+
+            column = self.codes[name]
+            if value is None:
+                mask &= column == -1
+            elif isinstance(value, (list, tuple, set, frozenset)):
+                wanted = [code for code in (self._code(name, item) for item in value) if code is not None]
+                mask &= np.isin(column, np.array(wanted, dtype=np.int32))
+            else:
+                code = self._code(name, value)
+                if code is None:
+                    mask[:] = False
+                else:
+                    mask &= column == code
+        return mask
+
+    def take(self, selection):
+        """A new table with the rows picked out by a boolean mask or an array of indices"""
+        codes = dict((name, column[selection]) for name, column in self.codes.items())
+        positions = dict((name, column[selection]) for name, column in self.positions.items())
+        return VariantTable(codes, self.categories, positions)
+
+    def where(self, **criteria):
+        """A new table with just the rows matching criteria (see mask)"""
+        return self.take(self.mask(**criteria))
+
+    def interval_index(self):
+        """The IntervalIndex (see fhir_walk.interval_index) over this table, built on first use"""
+        if self._interval_index is None:
+            from fhir_walk.interval_index import IntervalIndex
+            self._interval_index = IntervalIndex(self)
+        return self._interval_index
+
+    def overlapping(self, chrom, start, end):
+        """A new table with just the variants overlapping chrom:start-end"""
+        return self.interval_index().query(chrom, start, end)
+
+    def column(self, name):
+        """Decode a column back into a numpy array of its values"""
+        np = _numpy()
+        if name in self.positions:
+            return self.positions[name]
+
+        categories = np.array(self.categories[name] + [None], dtype=object)
+        # -1 (missing) picks up the trailing None
+        return categories[self.codes[name]]
+
+    def value_counts(self, name):
+        """Return a dict of value => number of rows for a string column"""
+        np = _numpy()
+        codes = self.codes[name]
+        counts = np.bincount(codes[codes >= 0], minlength=len(self.categories[name]))
+        return dict((self.categories[name][code], int(count)) for code, count in enumerate(counts) if count > 0)
+
+    def rows(self):
+        """Yield each row as a dict"""
+        columns = dict((name, self.column(name)) for name in string_columns)
+        for i in range(len(self)):
+            row = dict((name, columns[name][i]) for name in string_columns)
+            for name in int_columns:
+                value = int(self.positions[name][i])
+                row[name] = None if value == -1 else value
+            yield row
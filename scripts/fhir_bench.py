@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+"""Benchmark the walker against synthetic studies served locally
+
+Generates a synthetic study of each requested size, serves it with the local
+FHIR stand-in and reports wall time, request count and peak RSS for pulling
+the studies, the patients and fully hydrating the patients. Each scenario can
+be run with each page decoded in full (paged) and parsed incrementally 
+(streamed), to compare their peak memory and throughput.
+
+    fhir_bench.py --sizes 100,1000,10000,100000 --scenarios patients,hydrate
+    fhir_bench.py --scenarios observations --modes paged,streamed
+"""
+
+import json
+from argparse import ArgumentParser
+
+from fhir_walk.benchmark import run_benchmarks, format_results, scenarios, mode_options
+
+if __name__=='__main__':
+    parser = ArgumentParser()
+    parser.add_argument("--sizes", 
+                default="100,1000,10000", 
+                help="Comma separated list of study sizes (number of subjects)")
+    parser.add_argument("--scenarios", 
+                default=",".join(scenarios), 
+                help=f"Comma separated list of scenarios to run ({', '.join(scenarios)})")
+    parser.add_argument("--modes", 
+                default="paged", 
+                help=f"Comma separated list of modes to run each scenario in ({', '.join(mode_options)})")
+    parser.add_argument("--limit", 
+                type=int, 
+                default=None, 
+                help="Only hydrate this many patients for the hydrate scenario")
+    parser.add_argument("--latency", 
+                type=float, 
+                default=0, 
+                help="Seconds the local server waits before answering each request")
+    parser.add_argument("--prefetch", 
+                type=int, 
+                default=0, 
+                help="Prefetch depth for paginated searches")
+    parser.add_argument("--page-size", 
+                type=int, 
+                default=250, 
+                help="_count for paginated searches")
+    parser.add_argument("--no-include", 
+                action='store_true', 
+                help="Don't use _include/_revinclude")
+    parser.add_argument("--json", 
+                action='store_true', 
+                help="Write the results as JSON rather than a table")
+
+    args = parser.parse_args()
+
+    host_options = {
+        'prefetch_depth': args.prefetch,
+        'page_size': args.page_size,
+        'supports_include': not args.no_include
+    }
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    results = run_benchmarks(sizes=sizes, 
+                             scenarios=args.scenarios.split(","), 
+                             host_options=host_options, 
+                             limit=args.limit, 
+                             modes=args.modes.split(","), 
+                             latency=args.latency)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(format_results(results))
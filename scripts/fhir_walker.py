@@ -13,6 +13,7 @@ The philosophy behind the walker library is largely to pull only what is needed.
 """
 
 import sys
+import atexit
 from argparse import ArgumentParser, FileType
 from urllib.parse import urlparse
 
@@ -215,12 +216,57 @@ if __name__=='__main__':
                 choices=env_options, 
                 default='dev', 
                 help=f"Remote configuration to be used")
+    parser.add_argument("--cache", 
+                help="Keep responses in this (sqlite) file and revalidate them on subsequent runs")
+    parser.add_argument("--cache-max-age", 
+                type=float,
+                default=0,
+                help="Seconds a cached response is used as is, without asking the server (default 0, always revalidate). Search bundles, which rarely carry an ETag, are only cached when this is above 0, so keep it short: servers expire the search ids in their next links")
+    parser.add_argument("--record", 
+                help="Write every request and response to this cassette file")
+    parser.add_argument("--replay", 
+                help="Answer every request from this cassette file rather than the server")
+    parser.add_argument("--replay-latency", 
+                default=None,
+                help="Latency to inject while replaying: seconds per request or 'recorded'")
+    parser.add_argument("--retries", 
+                type=int,
+                default=None,
+                help="Use a pooled connection, retrying failed requests up to this many times")
+    parser.add_argument("--bulk", 
+                action='store_true',
+                help="Pull everything down with a Bulk Data $export and walk it locally")
+    parser.add_argument("--metrics", 
+                action='store_true',
+                help="Print a summary of the requests made, by search pattern, on exit")
 
     args = parser.parse_args()
 
     # The host's details are a part of that configured environment
     fhir_host = config.set_host(args.env)
 
+    if args.retries is not None:
+        fhir_host.use_pooled_transport(retries=args.retries)
+
+    if args.cache:
+        fhir_host.use_response_cache(args.cache, max_age=args.cache_max_age)
+
+    if args.replay:
+        latency = args.replay_latency
+        if latency is not None and latency != 'recorded':
+            latency = float(latency)
+        fhir_host.replay(args.replay, latency=latency)
+    elif args.record:
+        fhir_host.record(args.record)
+
+    if args.bulk:
+        store = fhir_host.load_bulk_export(progress=lambda export: print(f"Waiting on export: {export.progress}"))
+        print(f"{store.count()} resources exported")
+
+    if args.metrics:
+        metrics = fhir_host.enable_metrics()
+        atexit.register(lambda: sys.stderr.write(metrics.summary() + "\n"))
+
     # Get a list of each of the research study objects
     studies = ResearchStudy.Studies(fhir_host)
     study_list = sorted(studies.keys())
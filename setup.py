@@ -8,6 +8,15 @@ req_file = os.path.join(root_dir, "requirements.txt")
 with open(req_file) as f:
     requirements = f.read().splitlines()
 
+# Optional features, e.g. pip install fhir-walk[async]
+extras = {
+    'async': ['aiohttp'],                   # AsyncFhirHost
+    'snapshot': ['pyarrow'],                # Snapshots
+    'stream': ['ijson'],                    # stream_entries
+    'analytics': ['numpy']                  # Variant tables, interval index and phenotype matrix
+}
+extras['all'] = sorted(set(package for packages in extras.values() for package in packages))
+
 setup(
     name="fhir-walk",
     version = __version__,
@@ -15,5 +24,6 @@ setup(
     packages=find_packages(),
     include_package_data=True,
     install_requires=requirements,
-    scripts=['scripts/fhir_walker.py'],
+    extras_require=extras,
+    scripts=['scripts/fhir_walker.py', 'scripts/fhir_bench.py'],
 )
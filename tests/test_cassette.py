@@ -0,0 +1,35 @@
+from fhir_walk.fhir_host import FhirHost
+
+base_url = "http://fhir.example.org"
+
+def page(ids, next_url=None):
+    bundle = {'resourceType': 'Bundle',
+              'entry': [{'resource': {'resourceType': 'Patient', 'id': id}} for id in ids]}
+    if next_url:
+        bundle['link'] = [{'relation': 'next', 'url': next_url}]
+    return bundle
+
+class PagedServer:
+    """Three pages of Patients, chained together by their next links"""
+    def send_request(self, method, url, **kwargs):
+        if 'page=3' in url:
+            body = page(['e'])
+        elif 'page=2' in url:
+            body = page(['c', 'd'], f"{base_url}/Patient?page=3")
+        else:
+            body = page(['a', 'b'], f"{base_url}/Patient?page=2")
+        return True, {'status_code': 200, 'request_url': url, 'response': body}
+
+def test_replayed_search_is_the_same_each_time(tmp_path):
+    cassette = str(tmp_path / "walk.jsonl")
+
+    host = FhirHost(target_service_url=base_url, username='user', password='pass')
+    host.transport = PagedServer()
+    host.record(cassette)
+    assert host.get("Patient").entry_count == 5
+
+    host = FhirHost(target_service_url=base_url, username='user', password='pass', resource_cache_size=0)
+    host.replay(cassette)
+    counts = [host.get("Patient").entry_count for i in range(2)]
+    assert counts == [5, 5]
+    assert host.transport.unmatched == 0